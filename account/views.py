@@ -23,6 +23,7 @@ from account.mixins import LogoutRequiredMixin
 from account.utils import account_activation_token, EmailThread
 from account.forms import SignUpForm, SignInForm, ChangePasswordForm, ResetPasswordForm, ResetPasswordConfirmForm
 from account.models import Profile
+from cart.guest import GuestCart, merge_guest_cart
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 import json
@@ -207,10 +208,15 @@ class SignInView(LogoutRequiredMixin, generic.View):
 
                     if user.is_superuser:
                         messages.success(request, 'Admin login successful!')
-                        return JsonResponse({'status': 200})
-
-                    messages.success(request, 'User login successful!')
-                    return JsonResponse({'status': 201})
+                        response = JsonResponse({'status': 200})
+                    else:
+                        messages.success(request, 'User login successful!')
+                        response = JsonResponse({'status': 201})
+
+                    # Carry what was added as a guest over to the account's cart
+                    if merge_guest_cart(request, user):
+                        GuestCart().save(response)  # An empty cart drops the cookie
+                    return response
 
                 return JsonResponse({'status': 400, 'messages': 'Invalid username/email or password!'})
 
@@ -2,27 +2,50 @@ from django.contrib import admin
 from unfold.admin import ModelAdmin
 import admin_thumbnails
 
-from cart.models import Coupon, Cart, CartItem
+from cart.models import Coupon, CouponUsage, Cart, CartItem
+from cart.pricing import pricing_of, line_total
+from stories.admin import CatalogModelAdmin
 
 # Register your models here.
 class CouponAdmin(ModelAdmin):
-    list_display = ['id', 'coupon_code', 'coupon_discount', 'is_expired', 'minimum_amount']
+    list_display = ['id', 'coupon_code', 'coupon_discount', 'is_expired', 'minimum_amount', 'start_date', 'end_date', 'max_uses', 'max_uses_per_user', 'used_count']
     search_fields = ['coupon_code']
     list_filter = ['is_expired']
     list_editable = ['is_expired']
 admin.site.register(Coupon, CouponAdmin)
 
-class CartAdmin(ModelAdmin):
-    list_display = ['id', 'user', 'coupon', 'paid', 'total_amount', 'created_date', 'update_date']
+class CouponUsageAdmin(CatalogModelAdmin):
+    list_display = ['id', 'coupon', 'user', 'used_count', 'created_date', 'update_date']
+    search_fields = ['coupon__coupon_code', 'user__username']
+    list_select_related = ['coupon', 'user']
+    readonly_fields = ['coupon', 'user', 'used_count']
+admin.site.register(CouponUsage, CouponUsageAdmin)
+
+class CartAdmin(CatalogModelAdmin):
+    list_display = ['id', 'user', 'coupon', 'paid', 'item_count', 'total_amount', 'created_date', 'update_date']
     search_fields = ['user__username', 'coupon__coupon_code']
     list_filter = ['paid']  
     list_editable = ['paid', 'coupon']
+    list_select_related = ['user', 'coupon']
+    autocomplete_fields = ['coupon']
+
+    @admin.display(description='Total amount', ordering='subtotal')
+    def total_amount(self, obj):
+        return pricing_of(obj).total
 admin.site.register(Cart, CartAdmin)
 
-class CartItemAdmin(ModelAdmin):
-    list_display = ['id', 'cart', 'product', 'variant', 'quantity', 'total_price_of_items', 'created_date', 'update_date']
+class CartItemAdmin(CatalogModelAdmin):
+    list_display = ['id', 'cart', 'product', 'variant', 'quantity', 'held_quantity', 'hold_expires', 'total_price_of_items', 'created_date', 'update_date']
     search_fields = ['cart__user__username', 'product__title', 'variant__title']
     list_filter = ['cart__paid']
     list_editable = ['cart', 'product', 'variant', 'quantity']
-admin.site.register(CartItem, CartItemAdmin)
+    list_select_related = ['cart__user', 'product', 'variant']
+    autocomplete_fields = ['cart', 'product', 'variant']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(line_total=line_total())
+
+    @admin.display(description='Total price of items', ordering='line_total')
+    def total_price_of_items(self, obj):
+        return obj.line_total
+admin.site.register(CartItem, CartItemAdmin)
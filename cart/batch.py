@@ -0,0 +1,166 @@
+from collections import namedtuple
+from django.utils import timezone
+from stories.caching import bump_versions
+from stories.models import Product, Variants
+from cart.models import Cart, CartItem
+from cart.reservations import get_availability
+
+# Batched cart changes: a list of add / set / remove operations validated together
+# against one product and one variant query, then applied at once.
+MAX_OPERATIONS = 50
+OPERATIONS = ('add', 'set', 'remove')
+
+# lines: {(product_id, variant_id or None): quantity} after the batch;
+# unit_prices: the unit price of every line, for the response;
+# touched: {key: index of the first operation on it} of the lines the batch changes
+BatchPlan = namedtuple('BatchPlan', 'lines unit_prices touched')
+
+
+class BatchError(ValueError):
+    """Raised with one message per invalid operation; nothing of the batch is applied."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(f"operation {error['index']}: {error['messages']}" for error in errors))
+        self.errors = errors
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, '', 0, '0') else None
+
+
+def _parse_operation(operation):
+    """(normalised operation, None), or (None, the message saying why it is invalid)."""
+    if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+        return None, f"op must be one of {', '.join(OPERATIONS)}!"
+    op = operation['op']
+    parsed = {'op': op}
+    try:
+        if op == 'add':
+            parsed['product_id'] = int(operation.get('product_id'))
+            parsed['variant_id'] = _optional_int(operation.get('variant_id'))
+            parsed['size_id'] = _optional_int(operation.get('size_id'))
+            parsed['color_id'] = _optional_int(operation.get('color_id'))
+        elif not operation.get('id'):
+            return None, 'Cart item ID is required!'
+        else:
+            parsed['id'] = str(operation['id'])
+        if op != 'remove':
+            parsed['quantity'] = int(operation.get('quantity', 1))
+    except (TypeError, ValueError):
+        return None, 'Invalid input: ids and quantities must be integers!'
+    if op != 'remove' and parsed['quantity'] < 1:
+        return None, 'Quantity must be greater than 0!'
+    return parsed, None
+
+
+def parse_operations(raw):
+    """Validate the shape of a batch and normalise its operations; raises BatchError."""
+    if not isinstance(raw, list) or not raw:
+        raise BatchError([{'index': 0, 'messages': 'A non-empty list of operations is required!'}])
+    if len(raw) > MAX_OPERATIONS:
+        raise BatchError([{'index': MAX_OPERATIONS, 'messages': f'At most {MAX_OPERATIONS} operations per request!'}])
+    operations, errors = [], []
+    for index, operation in enumerate(raw):
+        parsed, message = _parse_operation(operation)
+        if message:
+            errors.append({'index': index, 'messages': message})
+        else:
+            operations.append({'index': index, **parsed})
+    if errors:
+        raise BatchError(errors)
+    return operations
+
+
+def stock_error(index, max_stock):
+    return {'index': index, 'messages': f"You can't add more than {max_stock} units!" if max_stock > 0 else 'Item out of stock!'}
+
+
+def plan_batch(lines, line_ids, operations, held=None):
+    """Apply operations to the current lines in memory and check the result against availability.
+
+    lines maps (product_id, variant_id) to the current quantity and line_ids maps the
+    ids the client knows the lines by to those keys. Every product and variant the
+    batch touches is loaded with one query each. A changed line may hold the units
+    nobody else holds (cart.reservations.get_availability) plus the units it holds
+    itself, given by held as {key: held units}; the check is on the final quantity
+    of each line, so "+" pressed twice counts as +2.
+    """
+    held = held or {}
+    product_ids = {product_id for product_id, _ in lines} | {op['product_id'] for op in operations if op['op'] == 'add'}
+    products = Product.objects.only('id', 'price').in_bulk(product_ids)
+    variants = list(Variants.objects.filter(product_id__in=product_ids).only('id', 'product_id', 'size_id', 'color_id', 'price'))
+    variants_by_id = {variant.id: variant for variant in variants}
+
+    lines, touched, errors = dict(lines), {}, []
+    for op in operations:
+        if op['op'] == 'add':
+            product = products.get(op['product_id'])
+            if product is None:
+                errors.append({'index': op['index'], 'messages': 'Item not found!'})
+                continue
+            if op['variant_id']:
+                variant = variants_by_id.get(op['variant_id'])
+                variant = variant if variant and variant.product_id == product.id else None
+            else:
+                # Same lookup as AddToCart: the variant with exactly this size and color
+                variant = next((v for v in variants if v.product_id == product.id and v.size_id == op['size_id'] and v.color_id == op['color_id']), None)
+            if (op['variant_id'] or op['size_id'] or op['color_id']) and variant is None:
+                errors.append({'index': op['index'], 'messages': 'Variant not found!'})
+                continue
+            key = (product.id, variant.id if variant else None)
+            lines[key] = lines.get(key, 0) + op['quantity']
+        else:
+            key = line_ids.get(op['id'])
+            if key is None or key not in lines:
+                errors.append({'index': op['index'], 'messages': 'Item not found in cart!'})
+                continue
+            if op['op'] == 'set':
+                lines[key] = op['quantity']
+            else:
+                lines.pop(key)
+        touched.setdefault(key, op['index'])
+
+    unit_prices = {}
+    available = get_availability([key for key in touched if key in lines and key[0] in products])
+    for key, quantity in lines.items():
+        product, variant = products.get(key[0]), variants_by_id.get(key[1])
+        if product is None:
+            continue
+        # Same rule as cart.models.unit_price()
+        unit_prices[key] = variant.price if variant and variant.price else product.price
+        max_stock = available[key] + held.get(key, 0) if key in touched else quantity
+        if quantity > max_stock:
+            errors.append(stock_error(touched[key], max_stock))
+    if errors:
+        raise BatchError(sorted(errors, key=lambda error: error['index']))
+    return BatchPlan(lines, unit_prices, touched)
+
+
+def write_cart_lines(cart, items, lines):
+    """Bring a cart's rows in line with lines using one insert, one update and one delete.
+
+    items maps the keys of lines to the cart's current CartItems. Bulk writes skip
+    CartItem.save() and its signals, so the stored cart totals are rebuilt and the
+    cart's cache version bumped once afterwards. The caller brings the lines' stock
+    holds in line with cart.reservations.sync_holds(). Returns {key: CartItem} of
+    the cart after the write.
+    """
+    now = timezone.now()
+    created, updated = [], []
+    for key, quantity in lines.items():
+        item = items.get(key)
+        if item is None:
+            created.append(CartItem(cart=cart, product_id=key[0], variant_id=key[1], quantity=quantity))
+        elif item.quantity != quantity:
+            item.quantity, item.update_date = quantity, now
+            updated.append(item)
+    removed = [item.id for key, item in items.items() if key not in lines]
+    if removed:
+        CartItem.objects.filter(id__in=removed).delete()
+    CartItem.objects.bulk_create(created)
+    CartItem.objects.bulk_update(updated, ['quantity', 'update_date'])
+    Cart.rebuild_totals(Cart.objects.filter(id=cart.id))
+    bump_versions(f'cart:{cart.user_id}')
+    remaining = {key: item for key, item in items.items() if key in lines}
+    remaining.update({(item.product_id, item.variant_id): item for item in created})
+    return remaining
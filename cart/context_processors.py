@@ -1,40 +1,67 @@
-from django.shortcuts import redirect, get_object_or_404
-from django.db.models import Min, Max, Sum
-from django.utils import timezone
-from cart.models import Cart, CartItem
-from stories.models import (
-    Category, Brand, Product, Images, Color, Size, Variants,
-)
+from django.utils.functional import SimpleLazyObject, new_method_proxy
+from cart.guest import GuestCart
+from cart.pricing import EMPTY_CART, price_cart, price_lines, priced_items
+
+
+class LazyAmount(SimpleLazyObject):
+    """Lazy Decimal that templates can also localize, which formats it."""
+    __format__ = new_method_proxy(format)
+
+
+# Session key remembering the id of the user's open cart
+CART_SESSION_KEY = 'cart_id'
+
+
+def get_cart_summary(request):
+    # Read-only: a cart row is only created when the user actually adds something.
+    # The badge is read by primary key from the remembered cart; the user lookup is
+    # only the fallback when there is none yet or it was checked out.
+    cart_id = request.session.get(CART_SESSION_KEY)
+    pricing = price_cart(request.user, cart_id=cart_id) if cart_id else EMPTY_CART
+    if pricing.cart_id is None:
+        pricing = price_cart(request.user)
+        if pricing.cart_id is not None:
+            request.session[CART_SESSION_KEY] = pricing.cart_id
+    return {
+        'cart_pricing': pricing,
+        # Only queried when a template lists the lines
+        'cart_items': SimpleLazyObject(lambda: list(priced_items(pricing.cart_id)) if pricing.item_count else []),
+        'cart_count': pricing.item_count,
+        'cart_totals': pricing.total,
+        'payable_price': pricing.payable,
+    }
+
+def get_guest_cart_summary(request):
+    """Same values for an anonymous visitor's cookie cart; only the cart views pass them."""
+    items = GuestCart.from_request(request).items()
+    pricing = price_lines(items)
+    return {
+        'cart_pricing': pricing,
+        'cart_items': items,
+        'cart_count': pricing.item_count,
+        'cart_totals': pricing.total,
+        'payable_price': pricing.payable,
+        'shipping_fee': pricing.shipping,
+    }
 
 def get_filters(request):
     if request.user.is_authenticated:
-        cart, _ = Cart.objects.get_or_create(user=request.user, paid=False)
-        cart_items = CartItem.objects.filter(cart=cart)
-        
-        # Count the number of cart items
-        cart_count = cart_items.count()  
-        
-        # Calculate cart totals without discount first
-        cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart_items)
-        
-        # Apply coupon discount if applicable
-        if cart.coupon and cart.coupon.is_valid(cart_totals):
-            # Apply coupon discount percentage if valid
-            cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)
-        
-        # Adding extra charge (e.g., shipping fee)
-        payable_price = cart_totals + 150  # Add extra charge for payable price
-        
+        # Evaluated once, on the first template access to any of the values
+        summary = SimpleLazyObject(lambda: get_cart_summary(request))
         return {
-            'cart_items': cart_items,
-            'cart_count': cart_count,
-            'cart_totals': cart_totals,
-            'payable_price': payable_price 
+            'cart_items': SimpleLazyObject(lambda: summary['cart_items']),
+            'cart_count': SimpleLazyObject(lambda: summary['cart_count']),
+            'cart_totals': LazyAmount(lambda: summary['cart_totals']),
+            'payable_price': LazyAmount(lambda: summary['payable_price']),
+            'shipping_fee': LazyAmount(lambda: summary['cart_pricing'].shipping),
         }
     else:
+        # Anonymous pages are shared between visitors: their cart comes from the
+        # cart views, which pass get_guest_cart_summary() themselves
         return {
             'cart_items': [],
             'cart_count': 0,
             'cart_totals': 0,
-            'payable_price': 0
-        }
\ No newline at end of file
+            'payable_price': 0,
+            'shipping_fee': 0,
+        }
@@ -0,0 +1,90 @@
+from collections import namedtuple
+from decimal import Decimal
+from django.db.models import F, Q
+from django.utils import timezone
+from stories.caching import get_versions
+from cart.models import Coupon, CouponUsage, ZERO
+
+CENT = Decimal('0.01')
+HUNDRED = Decimal(100)
+
+RULE_FIELDS = ('id', 'coupon_code', 'coupon_discount', 'minimum_amount', 'start_date', 'end_date', 'max_uses', 'max_uses_per_user')
+
+
+class CouponLimitReached(Exception):
+    """Raised by redeem() when a coupon ran out of uses, overall or for the user."""
+
+
+class CouponRule(namedtuple('CouponRule', RULE_FIELDS)):
+    """What a coupon allows, compiled from its row: date window, minimum amount, percentage and usage limits."""
+
+    @classmethod
+    def of(cls, coupon):
+        return cls(*(getattr(coupon, field) for field in RULE_FIELDS))
+
+    @property
+    def limited(self):
+        return self.max_uses is not None or self.max_uses_per_user is not None
+
+    def is_live(self, now=None):
+        now = now or timezone.now()
+        return not ((self.start_date and now < self.start_date) or (self.end_date and now > self.end_date))
+
+    def applies(self, subtotal, now=None):
+        return self.is_live(now) and subtotal >= self.minimum_amount
+
+    def discount_on(self, subtotal, now=None):
+        """Discount the coupon gives on subtotal; zero when it does not apply."""
+        if not self.applies(subtotal, now):
+            return ZERO
+        return min((subtotal * self.coupon_discount / HUNDRED).quantize(CENT), subtotal)
+
+
+# Rules of this process, with the version of the coupons they were compiled at.
+# Saving or deleting a coupon bumps that version, so every process recompiles.
+CompiledRules = namedtuple('CompiledRules', 'version by_id by_code')
+_compiled = CompiledRules(None, {}, {})
+
+
+def coupon_rules():
+    """Compiled rules of every coupon not marked expired, loaded with one query when the coupons version moves."""
+    global _compiled
+    version = get_versions('coupons')['coupons']
+    compiled = _compiled
+    if compiled.version != version:
+        rules = [CouponRule(*row) for row in Coupon.objects.filter(is_expired=False).values_list(*RULE_FIELDS)]
+        compiled = _compiled = CompiledRules(version, {rule.id: rule for rule in rules}, {rule.coupon_code: rule for rule in rules})
+    return compiled
+
+
+def coupon_discount(coupon_id, subtotal, now=None):
+    """Discount the coupon coupon_id gives on subtotal right now, from the compiled rules."""
+    rule = coupon_rules().by_id.get(coupon_id) if coupon_id else None
+    return rule.discount_on(subtotal, now) if rule else ZERO
+
+
+def uses_left(rule, user):
+    """Whether rule may still be used by user; only queries when the coupon has usage limits."""
+    if not rule.limited:
+        return True
+    if rule.max_uses is not None and not Coupon.objects.filter(id=rule.id, used_count__lt=rule.max_uses).exists():
+        return False
+    if rule.max_uses_per_user is not None:
+        used = CouponUsage.objects.filter(coupon_id=rule.id, user=user).values_list('used_count', flat=True).first() or 0
+        return used < rule.max_uses_per_user
+    return True
+
+
+def redeem(rule, user):
+    """Count one order with rule for user, with conditional UPDATEs that cannot go past the limits.
+
+    Call inside the order's transaction.atomic(): CouponLimitReached leaves the
+    counters as they were once the caller rolls back.
+    """
+    global_limit = Q() if rule.max_uses is None else Q(used_count__lt=rule.max_uses)
+    if not Coupon.objects.filter(global_limit, id=rule.id).update(used_count=F('used_count') + 1):
+        raise CouponLimitReached(rule.coupon_code)
+    usage, _ = CouponUsage.objects.get_or_create(coupon_id=rule.id, user=user)
+    user_limit = Q() if rule.max_uses_per_user is None else Q(used_count__lt=rule.max_uses_per_user)
+    if not CouponUsage.objects.filter(user_limit, id=usage.id).update(used_count=F('used_count') + 1, update_date=timezone.now()):
+        raise CouponLimitReached(rule.coupon_code)
@@ -0,0 +1,119 @@
+from collections import namedtuple
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from stories.models import Product, Variants
+from cart.models import Cart, CartItem
+from cart.batch import write_cart_lines
+from cart.reservations import get_availability, sync_holds
+
+# Anonymous carts live in a signed cookie, not in the database: browsing and
+# adding to the cart as a guest writes no rows until the visitor signs in.
+GUEST_CART_COOKIE = getattr(settings, 'GUEST_CART_COOKIE_NAME', 'guest_cart')
+GUEST_CART_MAX_AGE = getattr(settings, 'GUEST_CART_MAX_AGE', 60 * 60 * 24 * 30)
+# Keeps the cookie well under the 4 KB browsers accept
+GUEST_CART_MAX_LINES = 50
+GUEST_CART_SALT = 'cart.guest'
+
+# One rendered line of a guest cart; id is the line key the cart endpoints take
+GuestLine = namedtuple('GuestLine', 'id product variant quantity unit_price line_total')
+
+
+def line_key(product_id, variant_id):
+    return f'{product_id}-{variant_id or 0}'
+
+
+def parse_line_key(value):
+    """(product_id, variant_id or None) of a line key, ValueError if it is not one."""
+    product_id, variant_id = (int(part) for part in str(value).split('-'))
+    return product_id, variant_id or None
+
+
+class GuestCart:
+    """Lines of an anonymous visitor's cart: {(product_id, variant_id or None): quantity}."""
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.COOKIES.get(GUEST_CART_COOKIE)
+        if not value:
+            return cls()
+        try:
+            rows = signing.loads(value, salt=GUEST_CART_SALT, max_age=GUEST_CART_MAX_AGE)
+            lines = {(int(product_id), int(variant_id) or None): int(quantity) for product_id, variant_id, quantity in rows}
+        except (signing.BadSignature, TypeError, ValueError):
+            return cls()
+        return cls({key: quantity for key, quantity in lines.items() if quantity > 0})
+
+    def save(self, response):
+        """Store the cart on response, or drop the cookie once it is empty."""
+        if not self.lines:
+            response.delete_cookie(GUEST_CART_COOKIE, samesite='Lax')
+            return
+        rows = [[product_id, variant_id or 0, quantity] for (product_id, variant_id), quantity in self.lines.items()]
+        response.set_cookie(
+            GUEST_CART_COOKIE, signing.dumps(rows, salt=GUEST_CART_SALT, compress=True),
+            max_age=GUEST_CART_MAX_AGE, httponly=True, samesite='Lax', secure=settings.SESSION_COOKIE_SECURE,
+        )
+
+    def quantity(self, product_id, variant_id):
+        return self.lines.get((product_id, variant_id), 0)
+
+    def set(self, product_id, variant_id, quantity):
+        if quantity > 0:
+            self.lines[(product_id, variant_id)] = quantity
+        else:
+            self.lines.pop((product_id, variant_id), None)
+
+    def is_full(self, product_id, variant_id):
+        return (product_id, variant_id) not in self.lines and len(self.lines) >= GUEST_CART_MAX_LINES
+
+    def items(self):
+        """GuestLines with their product and variant, dropping lines whose product is gone."""
+        if not self.lines:
+            return []
+        products = Product.objects.prefetch_related('products_images').in_bulk({product_id for product_id, _ in self.lines})
+        variant_ids = {variant_id for _, variant_id in self.lines if variant_id}
+        variants = Variants.objects.select_related('size', 'color').in_bulk(variant_ids) if variant_ids else {}
+        items = []
+        for (product_id, variant_id), quantity in list(self.lines.items()):
+            product, variant = products.get(product_id), variants.get(variant_id)
+            if product is None or (variant_id and (variant is None or variant.product_id != product_id)):
+                # Gone from the catalog: dropped from the cookie on its next save
+                del self.lines[(product_id, variant_id)]
+                continue
+            # Same rule as cart.models.unit_price()
+            unit_price = variant.price if variant and variant.price else product.price
+            items.append(GuestLine(line_key(product_id, variant_id), product, variant, quantity, unit_price, unit_price * quantity))
+        return items
+
+
+def merge_guest_cart(request, user):
+    """Move the guest cart of request into user's open cart, clamped to availability; True if there was one.
+
+    A line already in the account's cart keeps the larger of its two quantities, so
+    merging the same cookie twice (a repeated sign-in) changes nothing. The lines
+    are written in one transaction with cart.batch.write_cart_lines(), which bulk
+    inserts and updates them, and held where stock still allows. The caller drops
+    the cookie.
+    """
+    items = GuestCart.from_request(request).items()
+    if not items:
+        return False
+    with transaction.atomic():
+        cart = Cart.objects.select_for_update().get(id=Cart.open_for(user, create=True).id)
+        existing = {(item.product_id, item.variant_id): item for item in CartItem.objects.filter(cart=cart)}
+        lines = {key: item.quantity for key, item in existing.items()}
+        keys = [(line.product.id, line.variant.id if line.variant else None) for line in items]
+        available = get_availability(keys)
+        for key, line in zip(keys, items):
+            # Units nobody else holds, plus the ones the account's line already holds
+            stock = available[key] + (existing[key].held_quantity if key in existing else 0)
+            quantity = min(line.quantity, stock)
+            if quantity > lines.get(key, 0):
+                lines[key] = quantity
+        write_cart_lines(cart, existing, lines)
+        sync_holds(cart.id)
+    return True
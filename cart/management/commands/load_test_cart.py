@@ -0,0 +1,101 @@
+import json
+import threading
+from collections import Counter
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, F, Sum
+from django.test import Client
+from django.urls import reverse
+from stories.models import Product, Variants
+from cart.models import Cart, CartItem, ZERO, line_total
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Fire concurrent add-to-cart requests at one cart line and check that no increment is lost or oversold."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, help="Product to add; by default the first one without variants that is in stock.")
+        parser.add_argument('--variant', type=int, help="Variant to add instead of a product without variants.")
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--adds', type=int, default=10, help="Requests per thread.")
+        parser.add_argument('--quantity', type=int, default=1, help="Units per request.")
+        parser.add_argument('--username', default='cart-load-test', help="User whose cart is emptied and filled; created if missing.")
+        parser.add_argument('--host', default='localhost', help="Host header of the requests; must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        threads, adds, quantity = options['threads'], options['adds'], options['quantity']
+        if min(threads, adds, quantity) < 1:
+            raise CommandError('--threads, --adds and --quantity must be at least 1.')
+        user, _ = User.objects.get_or_create(username=options['username'])
+        cart = Cart.open_for(user, create=True)
+        CartItem.objects.filter(cart=cart).delete()
+        # Units other carts hold are not available to this one
+        payload, stock = self.target(options)
+
+        results = Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(threads)
+
+        def worker():
+            client = Client(HTTP_HOST=options['host'])
+            client.force_login(user)
+            start.wait()
+            try:
+                for _ in range(adds):
+                    response = client.post(reverse('addtocart'), json.dumps(payload), content_type='application/json')
+                    messages = response.json().get('messages', '')
+                    outcome = 'added' if response.json().get('status') == 200 else \
+                        'refused' if "can't add more" in messages or 'left' in messages or 'out of stock' in messages else 'failed'
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        lines = list(CartItem.objects.filter(cart=cart).values_list('quantity', flat=True))
+        final = sum(lines)
+        expected = min(threads * adds, stock // quantity) * quantity
+        self.stdout.write(
+            f"{threads * adds} adds of {quantity} on {stock} available: {results['added']} added, "
+            f"{results['refused']} refused, {results['failed']} failed; {len(lines)} line(s), quantity {final}"
+        )
+
+        problems = []
+        if len(lines) > 1:
+            problems.append(f"{len(lines)} lines for one product option.")
+        if final != results['added'] * quantity:
+            problems.append(f"quantity {final} but {results['added']} adds succeeded: increments were lost.")
+        if final > stock:
+            problems.append(f"quantity {final} is over the {stock} units available.")
+        if not results['failed'] and final != expected:
+            problems.append(f"quantity {final}, expected {expected}.")
+        cart.refresh_from_db()
+        live = CartItem.objects.filter(cart=cart).aggregate(count=Count('id'), total=Sum(line_total()))
+        if (cart.item_count, cart.subtotal) != (live['count'], live['total'] or ZERO):
+            problems.append(f"stored totals {cart.item_count} / {cart.subtotal}, live {live['count']} / {live['total'] or ZERO}.")
+        if problems:
+            raise CommandError(' '.join(problems))
+        self.stdout.write(self.style.SUCCESS("Concurrent adds are consistent."))
+
+    def target(self, options):
+        """The add-to-cart payload for the line under test and the units available to it."""
+        if options['variant']:
+            variant = Variants.objects.filter(id=options['variant'], product__isnull=False).first()
+            if variant is None:
+                raise CommandError(f"Variant {options['variant']} not found.")
+            payload = {'product_id': variant.product_id, 'size_id': variant.size_id, 'color_id': variant.color_id}
+            return dict(payload, quantity=options['quantity']), variant.quantity - variant.reserved
+        products = Product.objects.filter(product_variants__isnull=True)
+        product = products.filter(id=options['product']).first() if options['product'] else \
+            products.filter(in_stock_max__gt=F('reserved')).order_by('id').first()
+        if product is None:
+            raise CommandError("No product without variants to add; pass --product or --variant.")
+        return {'product_id': product.id, 'quantity': options['quantity']}, (product.in_stock_max or 0) - product.reserved
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum, Count
+from stories.caching import bump_versions
+from cart.models import Cart, CartItem, ZERO, line_total
+
+
+class Command(BaseCommand):
+    help = "Rebuild the stored item count and subtotal of carts from their items at current prices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Only report carts whose stored totals drifted from their items.")
+        parser.add_argument('--all', action='store_true', help="Include paid carts, not just open ones.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        check_only = options['check']
+        carts = Cart.objects.all() if options['all'] else Cart.objects.filter(paid=False)
+
+        # One grouped query for the live values, keyed by cart id
+        live = {
+            row['cart']: (row['count'], row['total'])
+            for row in CartItem.objects.filter(cart__in=carts).values('cart').annotate(count=Count('id'), total=Sum(line_total())).order_by()
+        }
+
+        drifted = {}
+        for cart in carts.only('id', 'user_id', 'item_count', 'subtotal').order_by('id').iterator(chunk_size=batch_size):
+            count, total = live.get(cart.id, (0, ZERO))
+            if (cart.item_count, cart.subtotal) != (count, total):
+                if check_only:
+                    self.stdout.write(f"Cart {cart.id}: stored {cart.item_count} item(s) / {cart.subtotal}, live {count} / {total}")
+                drifted[cart.id] = cart.user_id
+
+        if check_only:
+            if drifted:
+                raise CommandError(f"{len(drifted)} cart(s) have drifted totals.")
+            self.stdout.write(self.style.SUCCESS("Cart totals are in sync."))
+            return
+
+        # Recomputed inside the UPDATE, so items changed since the scan above are not lost
+        ids = list(drifted)
+        with transaction.atomic():
+            for start in range(0, len(ids), batch_size):
+                Cart.rebuild_totals(Cart.objects.filter(id__in=ids[start:start + batch_size]))
+            bump_versions(*{f'cart:{user_id}' for user_id in drifted.values()})
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt totals for {len(drifted)} cart(s)."))
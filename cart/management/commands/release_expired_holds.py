@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from stories.models import Product, Variants
+from cart.models import CartItem
+from cart.reservations import forget_availability, release_expired
+
+
+class Command(BaseCommand):
+    help = "Release the stock held by cart lines whose hold expired. Run it every minute or so from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Cart lines released per transaction.")
+        parser.add_argument('--check', action='store_true', help="Only report products and variants whose reserved counter drifted from their holds.")
+        parser.add_argument('--rebuild', action='store_true', help="Recount every reserved counter from the held cart lines.")
+
+    def handle(self, *args, **options):
+        if options['check'] or options['rebuild']:
+            return self.recount(check_only=options['check'])
+        released = release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Released the holds of {released} cart line(s)."))
+
+    def recount(self, check_only):
+        held = CartItem.objects.filter(held_quantity__gt=0, product__isnull=False).order_by()
+        counters = (
+            (Variants, 'variant', {row['variant']: row['units'] for row in held.filter(variant__isnull=False).values('variant').annotate(units=Sum('held_quantity'))}),
+            (Product, 'product', {row['product']: row['units'] for row in held.filter(variant__isnull=True).values('product').annotate(units=Sum('held_quantity'))}),
+        )
+        drifted = []
+        with transaction.atomic():
+            for model, name, units in counters:
+                rows = model.objects.filter(reserved__gt=0) | model.objects.filter(id__in=list(units))
+                for row in rows.select_for_update().only('id', 'reserved', *(('product_id',) if model is Variants else ())):
+                    expected = units.get(row.id, 0)
+                    if row.reserved == expected:
+                        continue
+                    drifted.append(row)
+                    if check_only:
+                        self.stdout.write(f"{name.title()} {row.id}: reserved {row.reserved}, held {expected}")
+                    else:
+                        model.objects.filter(id=row.id).update(reserved=expected)
+                        forget_availability((row.product_id, row.id) if model is Variants else (row.id, None))
+
+        if check_only:
+            if drifted:
+                raise CommandError(f"{len(drifted)} reserved counter(s) have drifted.")
+            self.stdout.write(self.style.SUCCESS("Reserved counters are in sync."))
+            return
+        self.stdout.write(self.style.SUCCESS(f"Recounted {len(drifted)} reserved counter(s)."))
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:49
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models.functions import Coalesce, NullIf
+
+
+def backfill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('cart', 'Cart')
+    CartItem = apps.get_model('cart', 'CartItem')
+    money = models.DecimalField(max_digits=14, decimal_places=2)
+    zero = models.Value(Decimal('0.00'))
+    price = Coalesce(NullIf(models.F('variant__price'), zero), models.F('product__price'), zero, output_field=money)
+    items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        item_count=Coalesce(models.Subquery(items.annotate(count=models.Count('id')).values('count')), 0),
+        subtotal=Coalesce(models.Subquery(items.annotate(total=models.Sum(models.F('quantity') * price)).values('total')), zero, output_field=money),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.15 on 2026-10-18 18:20
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models.functions import Coalesce, NullIf
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    """Fold repeated lines of one product option into the oldest line of the cart."""
+    Cart = apps.get_model('cart', 'Cart')
+    CartItem = apps.get_model('cart', 'CartItem')
+    duplicates = (
+        CartItem.objects.filter(product__isnull=False).order_by().values('cart_id', 'product_id', 'variant_id')
+        .annotate(lines=models.Count('id'), quantity=models.Sum('quantity'), keep=models.Min('id'))
+        .filter(lines__gt=1)
+    )
+    cart_ids = set()
+    for line in duplicates:
+        CartItem.objects.filter(id=line['keep']).update(quantity=line['quantity'])
+        CartItem.objects.filter(
+            cart_id=line['cart_id'], product_id=line['product_id'], variant_id=line['variant_id'],
+        ).exclude(id=line['keep']).delete()
+        cart_ids.add(line['cart_id'])
+    if not cart_ids:
+        return
+    money = models.DecimalField(max_digits=14, decimal_places=2)
+    zero = models.Value(Decimal('0.00'))
+    price = Coalesce(NullIf(models.F('variant__price'), zero), models.F('product__price'), zero, output_field=money)
+    items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+    Cart.objects.filter(id__in=cart_ids).update(
+        item_count=Coalesce(models.Subquery(items.annotate(count=models.Count('id')).values('count')), 0),
+        subtotal=Coalesce(models.Subquery(items.annotate(total=models.Sum(models.F('quantity') * price)).values('total')), zero, output_field=money),
+        version=models.F('version') + 1,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_cart_stored_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', False), ('variant__isnull', False)), fields=('cart', 'product', 'variant'), name='cart_item_unique_variant_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', False), ('variant__isnull', True)), fields=('cart', 'product'), name='cart_item_unique_product_line'),
+        ),
+    ]
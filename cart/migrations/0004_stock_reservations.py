@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0003_cart_item_unique_lines'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='held_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='hold_expires',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -1,12 +1,43 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
 from decimal import Decimal
-from stories.models import Product, Variants
+from stories.models import Product, Variants, without_counters
 
 # Custom User model import
 User = get_user_model()
 
+ZERO = Decimal('0.00')
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def unit_price(prefix=''):
+    """Price of one unit of a cart line: its variant's price when it has one, else the product's."""
+    return Coalesce(NullIf(F(f'{prefix}variant__price'), Value(ZERO)), F(f'{prefix}product__price'), Value(ZERO), output_field=MONEY)
+
+
+def line_total(prefix=''):
+    return Coalesce(F(f'{prefix}quantity') * unit_price(prefix), Value(ZERO), output_field=MONEY)
+
+
+def line_amount(product_id, variant_id, quantity):
+    """SQL value of quantity units of a product (or variant) at its current price."""
+    variant_price = Subquery(Variants.objects.filter(id=variant_id).values('price')[:1]) if variant_id else Value(None)
+    product_price = Subquery(Product.objects.filter(id=product_id).values('price')[:1]) if product_id else Value(None)
+    price = Coalesce(NullIf(variant_price, Value(ZERO)), product_price, Value(ZERO), output_field=MONEY)
+    return ExpressionWrapper(price * Value(quantity), output_field=MONEY)
+
+
+def stock_of(product_id, variant_id):
+    """SQL value of the units in stock of a variant, or of a product without variants."""
+    if variant_id:
+        return Coalesce(Subquery(Variants.objects.filter(id=variant_id).values('quantity')[:1]), 0)
+    return Coalesce(Subquery(Product.objects.filter(id=product_id).values('in_stock_max')[:1]), 0)
+
 
 class Coupon(models.Model):
     coupon_code = models.CharField(max_length=10, unique=True)
@@ -15,6 +46,10 @@ class Coupon(models.Model):
     minimum_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     start_date = models.DateTimeField(null=True, blank=True)
     end_date = models.DateTimeField(null=True, blank=True)
+    max_uses = models.PositiveIntegerField(null=True, blank=True, help_text='Orders that may use the coupon in total; unlimited when empty.')
+    max_uses_per_user = models.PositiveIntegerField(null=True, blank=True, help_text='Orders each user may place with the coupon; unlimited when empty.')
+    # Orders placed with the coupon, counted by cart.coupons.redeem()
+    used_count = models.PositiveIntegerField(default=0, editable=False)
     created_date = models.DateTimeField(auto_now_add=True)
     update_date = models.DateTimeField(auto_now=True)
 
@@ -24,18 +59,38 @@ class Coupon(models.Model):
 
     def is_valid(self, total_amount):
         """Check if the coupon is valid based on expiration, minimum amount, and date range."""
-        now = timezone.now()
-        if self.is_expired or (self.start_date and now < self.start_date) or (self.end_date and now > self.end_date):
-            return False
-        return total_amount >= self.minimum_amount
+        from cart.coupons import CouponRule
+        return not self.is_expired and CouponRule.of(self).applies(total_amount)
 
     def __str__(self):
         return self.coupon_code
 
+class CouponUsage(models.Model):
+    """Orders one user placed with one coupon, counted by cart.coupons.redeem()."""
+    coupon = models.ForeignKey(Coupon, related_name='usages', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    used_count = models.PositiveIntegerField(default=0)
+    created_date = models.DateTimeField(auto_now_add=True)
+    update_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = '04. Coupon Usages'
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'user'], name='coupon_usage_unique_user'),
+        ]
+
+    def __str__(self):
+        return f"{self.coupon} used {self.used_count} time(s) by {self.user}"
+
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     coupon = models.ForeignKey(Coupon, on_delete=models.SET_NULL, null=True, blank=True)
     paid = models.BooleanField(default=False)
+    # Denormalized from the items, kept in step by CartItem.save() and delete
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=ZERO, editable=False)
+    version = models.PositiveIntegerField(default=0, editable=False)
     created_date = models.DateTimeField(auto_now_add=True)
     update_date = models.DateTimeField(auto_now=True)
 
@@ -43,22 +98,52 @@ class Cart(models.Model):
         ordering = ['id']
         verbose_name_plural = '02. Carts'
 
-    @property
-    def total_amount(self):
-        """
-        Calculate total price including variants if available.
-        Apply coupon discount if valid.
-        """
-        total = sum(
-            item.total_price_of_items for item in self.items.all()
+    # Maintained by apply_totals_delta() and rebuild_totals(); never written by a save() that does not name them
+    COUNTER_FIELDS = ('item_count', 'subtotal', 'version')
+
+    def save(self, *args, **kwargs):
+        update_fields = without_counters(self, self.COUNTER_FIELDS, kwargs.get('update_fields'))
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def open_for(cls, user, create=False):
+        """The user's open cart, or None; with create, one is made once even under concurrent requests."""
+        cart = cls.objects.filter(user=user, paid=False).order_by('id').first()
+        if cart is None and create:
+            with transaction.atomic():
+                # Concurrent first adds of one user queue up on their user row
+                list(User.objects.select_for_update().filter(pk=user.pk).values_list('pk', flat=True))
+                cart = cls.objects.filter(user=user, paid=False).order_by('id').first() or cls.objects.create(user=user, paid=False)
+        return cart
+
+    @classmethod
+    def apply_totals_delta(cls, cart_id, count_delta, amount):
+        """Shift the stored totals of one cart in a single UPDATE and bump its version."""
+        if not cart_id:
+            return
+        cls.objects.filter(id=cart_id).update(
+            item_count=F('item_count') + count_delta,
+            subtotal=F('subtotal') + amount,
+            version=F('version') + 1,
         )
 
-        # Apply coupon discount if valid
-        if self.coupon and self.coupon.is_valid(total):
-            # Apply percentage discount
-            total -= total * (self.coupon.coupon_discount / 100)
+    @classmethod
+    def rebuild_totals(cls, carts):
+        """Recompute the stored totals of carts from their items and current prices in one UPDATE."""
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        return carts.update(
+            item_count=Coalesce(Subquery(items.annotate(count=Count('id')).values('count')), 0),
+            subtotal=Coalesce(Subquery(items.annotate(total=Sum(line_total())).values('total')), Value(ZERO), output_field=MONEY),
+            version=F('version') + 1,
+        )
 
-        return max(total, Decimal('0.00'))  # Ensure price is never negative
+    @property
+    def total_amount(self):
+        """Total after a valid coupon's discount, before shipping."""
+        from cart.pricing import pricing_of
+        return pricing_of(self).total
 
     def __str__(self):
         return f"Cart for {self.user.username}"
@@ -68,12 +153,99 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
     variant = models.ForeignKey(Variants, on_delete=models.SET_NULL, null=True, blank=True)
     quantity = models.PositiveIntegerField(default=1)
+    # Units of stock reserved for this line until hold_expires (see cart.reservations)
+    held_quantity = models.PositiveIntegerField(default=0, editable=False)
+    hold_expires = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
     created_date = models.DateTimeField(auto_now_add=True)
     update_date = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['id']
         verbose_name_plural = '03. Cart Items'
+        constraints = [
+            # One line per product option in a cart. NULL variants never collide in a
+            # plain unique index, so lines without a variant get their own constraint.
+            models.UniqueConstraint(
+                fields=['cart', 'product', 'variant'], condition=Q(product__isnull=False, variant__isnull=False),
+                name='cart_item_unique_variant_line',
+            ),
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=Q(product__isnull=False, variant__isnull=True),
+                name='cart_item_unique_product_line',
+            ),
+        ]
+
+    @classmethod
+    def add_quantity(cls, cart, product_id, variant_id, quantity):
+        """Add quantity units to a cart line, inserting it if needed, only while it stays within stock.
+
+        The increment is one conditional UPDATE that re-reads the stock in SQL, so
+        concurrent adds neither lose increments nor go past the stock. An insert that
+        races another one for the same line hits the unique constraint and retries as
+        an increment. Returns the line's new quantity, or None if stock does not allow it.
+        """
+        from stories.caching import bump_versions
+        line = cls.objects.filter(cart=cart, product_id=product_id, variant_id=variant_id)
+        for attempt in range(2):
+            with transaction.atomic():
+                updated = line.filter(quantity__lte=stock_of(product_id, variant_id) - quantity).update(
+                    quantity=F('quantity') + quantity, update_date=timezone.now(),
+                )
+                if updated:
+                    # A queryset update skips save() and its signals
+                    Cart.apply_totals_delta(cart.id, 0, line_amount(product_id, variant_id, quantity))
+                    bump_versions(f'cart:{cart.user_id}')
+                    return line.values_list('quantity', flat=True).get()
+            if line.exists():
+                return None
+            stock = Product.objects.filter(id=product_id).values_list('in_stock_max', flat=True) if not variant_id else \
+                Variants.objects.filter(id=variant_id).values_list('quantity', flat=True)
+            if quantity > (stock.first() or 0):
+                return None
+            try:
+                with transaction.atomic():
+                    cls(cart=cart, product_id=product_id, variant_id=variant_id, quantity=quantity).save()
+                return quantity
+            except IntegrityError:
+                # Another request inserted the line first: add to it instead
+                continue
+        return None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._totals_snapshot = instance.totals_contribution()
+        return instance
+
+    def totals_contribution(self):
+        """(cart_id, product_id, variant_id, quantity) this line counts towards, or None without a cart."""
+        if not self.__dict__.get('cart_id') or 'quantity' not in self.__dict__:
+            return None
+        return (self.cart_id, self.__dict__.get('product_id'), self.__dict__.get('variant_id'), self.quantity)
+
+    @staticmethod
+    def move_totals(contribution, delta):
+        """Add (delta=1) or remove (delta=-1) a line contribution from its cart's stored totals."""
+        cart_id, product_id, variant_id, quantity = contribution
+        Cart.apply_totals_delta(cart_id, delta, line_amount(product_id, variant_id, delta * quantity))
+
+    def save(self, *args, **kwargs):
+        """Save the line and move it within the stored cart totals in the same transaction."""
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            previous = getattr(self, '_totals_snapshot', None)
+            current = self.totals_contribution()
+            if previous != current:
+                if previous and current and previous[:3] == current[:3]:
+                    # Same line, new quantity: one UPDATE for the difference
+                    cart_id, product_id, variant_id, quantity = current
+                    Cart.apply_totals_delta(cart_id, 0, line_amount(product_id, variant_id, quantity - previous[3]))
+                else:
+                    if previous:
+                        self.move_totals(previous, -1)
+                    if current:
+                        self.move_totals(current, 1)
+            self._totals_snapshot = current
 
     @property
     def total_price_of_items(self):
@@ -87,3 +259,10 @@ class CartItem(models.Model):
         product_name = self.product.title if self.product else "Unknown Product"
         user_name = self.cart.user.username if self.cart and self.cart.user else "Guest"
         return f"Item {product_name} in {user_name}'s cart"
+
+@receiver(post_delete, sender=CartItem)
+def remove_cart_item_totals(sender, instance, **kwargs):
+    """Take a deleted line out of its cart's totals (also covers cascades and bulk deletes)."""
+    previous = getattr(instance, '_totals_snapshot', instance.totals_contribution())
+    if previous:
+        CartItem.move_totals(previous, -1)
@@ -0,0 +1,64 @@
+from collections import namedtuple
+from decimal import Decimal
+from django.conf import settings
+from cart.models import Cart, CartItem, ZERO, unit_price, line_total
+from cart.coupons import CENT, coupon_discount
+
+# Flat shipping fee added to every cart holding items
+SHIPPING_FEE = Decimal(str(getattr(settings, 'CART_SHIPPING_FEE', '150.00')))
+
+
+class CartPricing(namedtuple('CartPricing', 'cart_id item_count subtotal discount shipping version', defaults=(0,))):
+    """Totals of one cart. total is what the cart pages show, payable what checkout charges."""
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount
+
+    @property
+    def payable(self):
+        return self.total + self.shipping
+
+
+EMPTY_CART = CartPricing(None, 0, ZERO, ZERO, ZERO)
+
+
+def pricing_of(cart):
+    """CartPricing of a cart loaded with its stored totals; the coupon comes from the compiled rules."""
+    subtotal = cart.subtotal.quantize(CENT)
+    return CartPricing(
+        cart_id=cart.id,
+        item_count=cart.item_count,
+        subtotal=subtotal,
+        discount=coupon_discount(cart.coupon_id, subtotal),
+        shipping=SHIPPING_FEE if cart.item_count else ZERO,
+        version=cart.version,
+    )
+
+
+def price_cart(user=None, cart_id=None):
+    """Price the open cart of user, or the cart cart_id, from its stored totals; EMPTY_CART when there is none.
+
+    With both, cart_id is looked up by primary key and only counts if it is still
+    user's open cart.
+    """
+    carts = Cart.objects.all()
+    if cart_id is not None:
+        carts = carts.filter(id=cart_id)
+    if user is not None:
+        carts = carts.filter(user=user, paid=False)
+    cart = carts.order_by('id').only('id', 'item_count', 'subtotal', 'version', 'coupon_id').first()
+    return pricing_of(cart) if cart else EMPTY_CART
+
+
+def price_lines(items):
+    """CartPricing of lines already loaded with their line_total, e.g. a guest cart (coupons need an account)."""
+    subtotal = sum((item.line_total for item in items), ZERO).quantize(CENT)
+    return CartPricing(None, len(items), subtotal, ZERO, SHIPPING_FEE if items else ZERO)
+
+
+def priced_items(cart_id):
+    """Lines of a cart with their unit_price and line_total, product and variant loaded for rendering."""
+    return CartItem.objects.filter(cart_id=cart_id).annotate(unit_price=unit_price(), line_total=line_total()).select_related(
+        'product', 'variant__size', 'variant__color',
+    ).prefetch_related('product__products_images')
@@ -0,0 +1,198 @@
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from stories.caching import FRAGMENT_TIMEOUT, bump_versions, get_versions
+from stories.models import Product, Variants
+from cart.models import CartItem
+
+# Stock put in a cart stays held for this long after the line was last changed.
+# Products and variants count held units in their reserved column, so
+# available = stock - reserved is read from one row and never aggregated from holds.
+HOLD_TTL = timedelta(seconds=getattr(settings, 'CART_HOLD_SECONDS', 15 * 60))
+
+# A cart line checkout could not take from stock, with the units left for it
+ShortLine = namedtuple('ShortLine', 'item available')
+
+
+class OutOfStock(Exception):
+    """Raised by commit_cart_stock() with the ShortLines that do not fit; no stock is committed."""
+
+    def __init__(self, lines):
+        super().__init__(', '.join(f'{line.item.product_id}/{line.item.variant_id}: {line.available} left' for line in lines))
+        self.lines = lines
+
+
+def _counter(product_id, variant_id):
+    """Row holding the stock and reserved counters of a product option, and its stock column."""
+    if variant_id:
+        return Variants.objects.filter(id=variant_id), 'quantity'
+    return Product.objects.filter(id=product_id), 'in_stock_max'
+
+
+def _availability_key(catalog, product_id, variant_id):
+    # Catalog imports rewrite stock in bulk and move the catalog version instead
+    return f'stock-available:{catalog}:{product_id}:{variant_id or 0}'
+
+
+def forget_availability(*options):
+    """Drop the cached availability of (product_id, variant_id) options once the transaction commits."""
+    if options:
+        catalog = get_versions('catalog')['catalog']
+        keys = [_availability_key(catalog, *option) for option in options]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def get_availability(options):
+    """{(product_id, variant_id): units available} of product options, from cached counters.
+
+    Misses are read from the stock and reserved columns, one query per model, and
+    cached until a hold, a checkout or a stock edit changes them.
+    """
+    catalog = get_versions('catalog')['catalog']
+    keys = {_availability_key(catalog, *option): option for option in options}
+    found = cache.get_many(list(keys))
+    missing = [option for key, option in keys.items() if key not in found]
+    loaded = {}
+    variant_ids = [variant_id for _, variant_id in missing if variant_id]
+    product_ids = [product_id for product_id, variant_id in missing if not variant_id]
+    if variant_ids:
+        for row in Variants.objects.filter(id__in=variant_ids).values('id', 'product_id', 'quantity', 'reserved'):
+            loaded[_availability_key(catalog, row['product_id'], row['id'])] = max(row['quantity'] - row['reserved'], 0)
+    if product_ids:
+        for row in Product.objects.filter(id__in=product_ids).values('id', 'in_stock_max', 'reserved'):
+            loaded[_availability_key(catalog, row['id'], None)] = max(row['in_stock_max'] - row['reserved'], 0)
+    if loaded:
+        cache.set_many(loaded, FRAGMENT_TIMEOUT)
+    found.update(loaded)
+    return {option: found.get(key, 0) for key, option in keys.items()}
+
+
+def reserve(product_id, variant_id, quantity):
+    """Take quantity units off a product option's availability in one conditional UPDATE; False when fewer are left."""
+    rows, stock = _counter(product_id, variant_id)
+    reserved = rows.filter(**{f'{stock}__gte': F('reserved') + quantity}).update(reserved=F('reserved') + quantity)
+    if reserved:
+        forget_availability((product_id, variant_id))
+    return bool(reserved)
+
+
+def unreserve(product_id, variant_id, quantity):
+    """Give quantity held units of a product option back to its availability."""
+    rows, _ = _counter(product_id, variant_id)
+    rows.update(reserved=Greatest(F('reserved') - quantity, 0))
+    forget_availability((product_id, variant_id))
+
+
+def release(items):
+    """Release the holds of the CartItems in items, with one UPDATE per product option."""
+    with transaction.atomic():
+        held = list(items.filter(held_quantity__gt=0, product__isnull=False).select_for_update().values_list(
+            'id', 'product_id', 'variant_id', 'held_quantity',
+        ))
+        units = defaultdict(int)
+        for _, product_id, variant_id, quantity in held:
+            units[(product_id, variant_id)] += quantity
+        for (product_id, variant_id), quantity in sorted(units.items(), key=lambda option: (option[0][0], option[0][1] or 0)):
+            unreserve(product_id, variant_id, quantity)
+        CartItem.objects.filter(id__in=[line[0] for line in held]).update(held_quantity=0, hold_expires=None)
+    return len(held)
+
+
+def release_expired(batch_size=1000, now=None):
+    """Release every hold that expired by now, batch_size lines per transaction; returns the lines released."""
+    now = now or timezone.now()
+    released = 0
+    while True:
+        ids = list(CartItem.objects.filter(hold_expires__lte=now).order_by('hold_expires').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return released
+        released += release(CartItem.objects.filter(id__in=ids, hold_expires__lte=now))
+        # Lines whose product is gone hold nothing that can be returned
+        CartItem.objects.filter(id__in=ids, hold_expires__lte=now).update(held_quantity=0, hold_expires=None)
+
+
+def _reserve_reclaiming(product_id, variant_id, quantity, other_than_cart):
+    """reserve(), first releasing expired holds on the same product option when they stand in the way.
+
+    The lines of other_than_cart are left alone: the caller is working on them.
+    """
+    if reserve(product_id, variant_id, quantity):
+        return True
+    expired = CartItem.objects.filter(product_id=product_id, variant_id=variant_id, hold_expires__lte=timezone.now())
+    if not release(expired.exclude(cart_id=other_than_cart)):
+        return False
+    return reserve(product_id, variant_id, quantity)
+
+
+def take_hold(cart, product_id, variant_id, quantity):
+    """Hold quantity more units for a cart line and restart its hold; False when fewer are available.
+
+    Expired holds on the same product option that the sweeper has not released
+    yet are released first when they stand in the way.
+    """
+    if not _reserve_reclaiming(product_id, variant_id, quantity, other_than_cart=cart.id):
+        return False
+    CartItem.objects.filter(cart=cart, product_id=product_id, variant_id=variant_id).update(
+        held_quantity=F('held_quantity') + quantity, hold_expires=timezone.now() + HOLD_TTL,
+    )
+    return True
+
+
+def sync_holds(cart_id):
+    """Match the holds of a cart's lines to their quantities after a change other than add-to-cart.
+
+    Surplus holds are released, missing units are held where stock allows and every
+    held line starts its hold over. Returns the (product_id, variant_id) of the lines
+    that could not be fully held; callers that validated the change against
+    get_availability() roll it back, others leave those lines to the checkout check.
+    """
+    now = timezone.now()
+    short = []
+    with transaction.atomic():
+        lines = list(CartItem.objects.filter(cart_id=cart_id, product__isnull=False).select_for_update().values_list(
+            'id', 'product_id', 'variant_id', 'quantity', 'held_quantity',
+        ))
+        for line_id, product_id, variant_id, quantity, held in lines:
+            if held > quantity:
+                unreserve(product_id, variant_id, held - quantity)
+                held = quantity
+            elif held < quantity and _reserve_reclaiming(product_id, variant_id, quantity - held, other_than_cart=cart_id):
+                held = quantity
+            else:
+                if held < quantity:
+                    short.append((product_id, variant_id))
+                continue
+            CartItem.objects.filter(id=line_id).update(held_quantity=held)
+        CartItem.objects.filter(cart_id=cart_id, held_quantity__gt=0).update(hold_expires=now + HOLD_TTL)
+    return short
+
+
+def commit_cart_stock(cart):
+    """Turn a cart's holds into stock decrements, one conditional UPDATE per product option.
+
+    Each line takes its units from its own hold first and from what nobody holds
+    for the rest. Call inside transaction.atomic(): OutOfStock is raised after
+    every line was tried, and the caller's rollback undoes the ones that fit.
+    """
+    lines = list(CartItem.objects.filter(cart=cart, product__isnull=False).select_for_update().order_by('product_id', 'variant_id'))
+    short = []
+    for line in lines:
+        rows, stock = _counter(line.product_id, line.variant_id)
+        taken = rows.filter(**{f'{stock}__gte': F('reserved') - line.held_quantity + line.quantity}).update(
+            **{stock: F(stock) - line.quantity}, reserved=F('reserved') - line.held_quantity,
+        )
+        if not taken:
+            left = rows.values_list(stock, 'reserved').first() or (0, 0)
+            short.append(ShortLine(line, max(left[0] - left[1] + line.held_quantity, 0)))
+    if short:
+        raise OutOfStock(short)
+    CartItem.objects.filter(id__in=[line.id for line in lines]).update(held_quantity=0, hold_expires=None)
+    forget_availability(*{(line.product_id, line.variant_id) for line in lines})
+    # Product pages, variant matrices and the read API show the stock left
+    bump_versions('api:products', 'api:variants', *{f'variants:{line.product_id}' for line in lines})
+    return lines
@@ -0,0 +1,76 @@
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from stories.caching import bump_versions
+from stories.models import Product, Variants
+from cart.models import Coupon, Cart, CartItem
+from cart.reservations import forget_availability, unreserve
+
+
+# Pages revalidated by their ETag show the user's cart badge and mini-cart
+@receiver(post_save, sender=Cart)
+@receiver(post_delete, sender=Cart)
+def invalidate_cart(sender, instance, **kwargs):
+    bump_versions(f'cart:{instance.user_id}')
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def invalidate_cart_items(sender, instance, **kwargs):
+    user_id = Cart.objects.filter(id=instance.cart_id).values_list('user_id', flat=True).first()
+    if user_id:
+        bump_versions(f'cart:{user_id}')
+
+
+@receiver(post_delete, sender=CartItem)
+def release_deleted_hold(sender, instance, **kwargs):
+    if instance.held_quantity and instance.product_id:
+        unreserve(instance.product_id, instance.variant_id, instance.held_quantity)
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def invalidate_coupons(sender, instance, **kwargs):
+    bump_versions('coupons')
+
+
+def open_carts_with(instance):
+    lookup = 'items__product' if isinstance(instance, Product) else 'items__variant'
+    return Cart.objects.filter(Q(**{lookup: instance}), paid=False)
+
+
+# Stored cart subtotals are priced at current prices: re-price the open carts
+# holding a product or variant whenever it is saved or removed
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Variants)
+def reprice_open_carts(sender, instance, created, **kwargs):
+    if not created:
+        Cart.rebuild_totals(open_carts_with(instance))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Variants)
+def invalidate_availability(sender, instance, **kwargs):
+    # Stock edited in the admin changes what is available
+    forget_availability((instance.product_id, instance.id) if sender is Variants else (instance.id, None))
+
+
+@receiver(pre_delete, sender=Product)
+@receiver(pre_delete, sender=Variants)
+def remember_open_carts(sender, instance, **kwargs):
+    # Their lines lose the reference before post_delete runs
+    instance._open_cart_ids = list(open_carts_with(instance).values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Variants)
+def remove_variant_lines(sender, instance, **kwargs):
+    # SET_NULL would turn them into product lines, colliding with one already in the cart
+    CartItem.objects.filter(variant=instance).delete()
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Variants)
+def reprice_carts_after_delete(sender, instance, **kwargs):
+    cart_ids = getattr(instance, '_open_cart_ids', None)
+    if cart_ids:
+        Cart.rebuild_totals(Cart.objects.filter(id__in=cart_ids))
@@ -1,3 +1,503 @@
-from django.test import TestCase
+import json
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.urls import reverse
+from django.utils import timezone
+
+from stories.caching import get_versions
+from stories.models import Product, Variants
+from cart.models import Cart, CartItem, Coupon, CouponUsage, ZERO
+from cart.pricing import EMPTY_CART, SHIPPING_FEE, price_cart, priced_items
+from cart.guest import GUEST_CART_COOKIE, GuestCart
+from cart.coupons import CouponLimitReached, coupon_rules, redeem, uses_left
+from cart.reservations import OutOfStock, commit_cart_stock, release_expired, reserve, take_hold
 
 # Create your tests here.
+User = get_user_model()
+
+
+def make_user(username):
+    return User.objects.create_user(username, f'{username}@example.com', 'password')
+
+
+class CartPricingTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('shopper')
+        cls.plain = Product.objects.create(title='Plain product', price=Decimal('10.00'), in_stock_max=20)
+        cls.sized = Product.objects.create(title='Sized product', price=Decimal('30.00'), in_stock_max=0)
+        # A variant without its own price is sold at the product's price
+        cls.priced_variant = Variants.objects.create(product=cls.sized, title='Large', price=Decimal('45.00'), quantity=5)
+        cls.unpriced_variant = Variants.objects.create(product=cls.sized, title='Small', price=ZERO, quantity=5)
+        cls.cart = Cart.objects.create(user=cls.user)
+        CartItem.objects.create(cart=cls.cart, product=cls.plain, quantity=3)
+        CartItem.objects.create(cart=cls.cart, product=cls.sized, variant=cls.priced_variant, quantity=2)
+        CartItem.objects.create(cart=cls.cart, product=cls.sized, variant=cls.unpriced_variant, quantity=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def attach_coupon(self, **fields):
+        # Saving a coupon reloads the compiled rules once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = Coupon.objects.create(coupon_discount=Decimal('10.00'), **fields)
+        Cart.objects.filter(id=self.cart.id).update(coupon=coupon)
+        return coupon
+
+    def test_price_matches_the_lines(self):
+        pricing = price_cart(self.user)
+        lines = list(priced_items(self.cart.id))
+        self.assertEqual(pricing.item_count, 3)
+        self.assertEqual(pricing.subtotal, sum(line.line_total for line in lines))
+        self.assertEqual(pricing.subtotal, Decimal('150.00'))
+        self.assertEqual(pricing.shipping, SHIPPING_FEE)
+        self.assertEqual(pricing.payable, Decimal('150.00') + SHIPPING_FEE)
+
+    def test_coupon_discount_is_taken_off_the_total(self):
+        self.attach_coupon(coupon_code='TEN', minimum_amount=Decimal('100.00'))
+        pricing = price_cart(self.user)
+        self.assertEqual(pricing.discount, Decimal('15.00'))
+        self.assertEqual(pricing.total, Decimal('135.00'))
+
+    def test_coupon_below_its_minimum_gives_nothing(self):
+        self.attach_coupon(coupon_code='BIG', minimum_amount=Decimal('500.00'))
+        self.assertEqual(price_cart(self.user).discount, ZERO)
+
+    def test_no_open_cart_prices_as_empty(self):
+        self.assertEqual(price_cart(make_user('browser')), EMPTY_CART)
+        # Someone else's cart does not count as the user's
+        self.assertEqual(price_cart(make_user('other'), cart_id=self.cart.id), EMPTY_CART)
+
+    def test_empty_cart_has_no_shipping(self):
+        pricing = price_cart(cart_id=Cart.objects.create(user=make_user('empty')).id)
+        self.assertEqual((pricing.item_count, pricing.subtotal, pricing.shipping), (0, ZERO, ZERO))
+
+
+class StoredCartTotalsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('counter')
+        cls.product = Product.objects.create(title='Counted product', price=Decimal('12.50'), in_stock_max=50)
+        cls.other = Product.objects.create(title='Other product', price=Decimal('4.00'), in_stock_max=50)
+        cls.variant = Variants.objects.create(product=cls.other, title='Blue', price=Decimal('6.00'), quantity=50)
+
+    def setUp(self):
+        self.cart = Cart.objects.create(user=self.user)
+
+    def assertTotalsRebuilt(self, item_count, subtotal):
+        """The stored totals are the expected ones and a rebuild from the items leaves them as they are."""
+        stored = Cart.objects.values_list('item_count', 'subtotal').get(id=self.cart.id)
+        self.assertEqual(stored, (item_count, Decimal(subtotal)))
+        Cart.rebuild_totals(Cart.objects.filter(id=self.cart.id))
+        self.assertEqual(Cart.objects.values_list('item_count', 'subtotal').get(id=self.cart.id), stored)
+
+    def test_adding_and_changing_lines(self):
+        line = CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.other, variant=self.variant, quantity=1)
+        self.assertTotalsRebuilt(2, '31.00')
+        line.quantity = 5
+        line.save()
+        self.assertTotalsRebuilt(2, '68.50')
+        CartItem.add_quantity(self.cart, self.other.id, self.variant.id, 3)
+        self.assertTotalsRebuilt(2, '86.50')
+
+    def test_moving_a_line_to_another_option(self):
+        line = CartItem.objects.create(cart=self.cart, product=self.other, quantity=2)
+        self.assertTotalsRebuilt(1, '8.00')
+        line.variant = self.variant
+        line.save()
+        self.assertTotalsRebuilt(1, '12.00')
+
+    def test_deleting_lines(self):
+        line = CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.other, quantity=3)
+        line.delete()
+        self.assertTotalsRebuilt(1, '12.00')
+        CartItem.objects.filter(cart=self.cart).delete()
+        self.assertTotalsRebuilt(0, '0.00')
+
+    def test_full_save_of_a_stale_cart_keeps_the_totals(self):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        # The admin changelist holds the cart as it was before the next add
+        stale = Cart.objects.get(id=self.cart.id)
+        CartItem.add_quantity(self.cart, self.other.id, None, 1)
+        stale.paid = True
+        stale.save()
+        self.assertTrue(Cart.objects.get(id=self.cart.id).paid)
+        self.assertTotalsRebuilt(2, '29.00')
+
+    def test_price_change_reprices_open_carts(self):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.other, variant=self.variant, quantity=1)
+        self.product.price = Decimal('20.00')
+        self.product.save()
+        self.variant.price = ZERO
+        self.variant.save()
+        # The variant is now sold at its product's price
+        self.assertTotalsRebuilt(2, '44.00')
+
+    def test_rebuild_command_fixes_drifted_carts(self):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        Cart.objects.filter(id=self.cart.id).update(item_count=0, subtotal=ZERO)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_cart_totals', '--check', stdout=StringIO())
+        # --check only reports
+        self.assertEqual(Cart.objects.values_list('item_count', flat=True).get(id=self.cart.id), 0)
+        before = get_versions(f'cart:{self.user.id}')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_cart_totals', stdout=StringIO())
+        self.assertNotEqual(get_versions(f'cart:{self.user.id}'), before)
+        self.assertTotalsRebuilt(1, '25.00')
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class GuestCartTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('returning')
+        cls.product = Product.objects.create(title='Guest product', price=Decimal('5.00'), in_stock_max=4)
+        cls.other = Product.objects.create(title='Kept product', price=Decimal('8.00'), in_stock_max=10)
+
+    def setUp(self):
+        cache.clear()
+
+    def add(self, product, quantity):
+        return self.client.post(reverse('addtocart'), json.dumps({'product_id': product.id, 'quantity': quantity}), content_type='application/json').json()
+
+    def sign_in(self):
+        return self.client.post(reverse('sign'), json.dumps({'username': 'returning', 'password': 'password'}), content_type='application/json')
+
+    def guest_cart(self):
+        return GuestCart.from_request(SimpleNamespace(COOKIES={name: morsel.value for name, morsel in self.client.cookies.items()}))
+
+    def account_lines(self):
+        return dict(CartItem.objects.filter(cart__user=self.user, cart__paid=False).values_list('product_id', 'quantity'))
+
+    def test_guest_adds_write_no_rows(self):
+        self.assertEqual(self.add(self.product, 1)['cart_count'], 1)
+        self.assertEqual(self.add(self.product, 2)['messages'], 'Quantity updated successfully!')
+        self.assertEqual(self.add(self.product, 2)['status'], 400)
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual(self.guest_cart().lines, {(self.product.id, None): 3})
+
+    def test_sign_in_merges_and_drops_the_cookie(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.other, quantity=2)
+        self.add(self.product, 3)
+        self.add(self.other, 1)
+        response = self.sign_in()
+        self.assertEqual(response.json()['status'], 201)
+        self.assertEqual(response.cookies[GUEST_CART_COOKIE].value, '')
+        # The account's larger quantity is kept
+        self.assertEqual(self.account_lines(), {self.product.id: 3, self.other.id: 2})
+        self.assertEqual(Cart.objects.values_list('item_count', 'subtotal').get(id=cart.id), (2, Decimal('31.00')))
+
+    def test_merging_the_same_cookie_twice_changes_nothing(self):
+        self.add(self.product, 3)
+        cookie = self.client.cookies[GUEST_CART_COOKIE].value
+        self.sign_in()
+        self.client.logout()
+        self.client.cookies[GUEST_CART_COOKIE] = cookie
+        self.sign_in()
+        self.assertEqual(self.account_lines(), {self.product.id: 3})
+
+    def test_merge_is_clamped_to_stock(self):
+        self.add(self.product, 4)
+        Product.objects.filter(id=self.product.id).update(in_stock_max=2)
+        self.sign_in()
+        self.assertEqual(self.account_lines(), {self.product.id: 2})
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class CartBatchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('batcher')
+        cls.product = Product.objects.create(title='Batched product', price=Decimal('3.00'), in_stock_max=10)
+        cls.other = Product.objects.create(title='Second product', price=Decimal('7.00'), in_stock_max=5)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def post(self, url, payload):
+        # Availability is forgotten once the request's transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse(url), json.dumps(payload), content_type='application/json').json()
+
+    def batch(self, *operations):
+        return self.post('cartbatch', {'operations': list(operations)})
+
+    def reserved(self, product):
+        return Product.objects.values_list('reserved', flat=True).get(id=product.id)
+
+    def test_batch_applies_every_operation_and_holds_the_units(self):
+        response = self.batch(
+            {'op': 'add', 'product_id': self.product.id, 'quantity': 2},
+            {'op': 'add', 'product_id': self.product.id, 'quantity': 3},
+            {'op': 'add', 'product_id': self.other.id, 'quantity': 1},
+        )
+        self.assertEqual((response['status'], response['cart_count'], response['cart_totals']), (200, 2, '22.00'))
+        self.assertEqual((self.reserved(self.product), self.reserved(self.other)), (5, 1))
+        line = CartItem.objects.get(product=self.product)
+        response = self.batch({'op': 'set', 'id': line.id, 'quantity': 1}, {'op': 'remove', 'id': CartItem.objects.get(product=self.other).id})
+        self.assertEqual(response['cart_count'], 1)
+        self.assertEqual((self.reserved(self.product), self.reserved(self.other)), (1, 0))
+
+    def test_invalid_operation_applies_nothing(self):
+        response = self.batch(
+            {'op': 'add', 'product_id': self.product.id, 'quantity': 1},
+            {'op': 'set', 'id': 999999, 'quantity': 2},
+        )
+        self.assertEqual(response['status'], 400)
+        self.assertEqual(response['errors'], [{'index': 1, 'messages': 'Item not found in cart!'}])
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_units_held_by_other_carts_are_not_available(self):
+        Product.objects.filter(id=self.product.id).update(reserved=8)
+        response = self.batch(
+            {'op': 'add', 'product_id': self.other.id, 'quantity': 1},
+            {'op': 'add', 'product_id': self.product.id, 'quantity': 3},
+        )
+        self.assertEqual(response['errors'], [{'index': 1, 'messages': "You can't add more than 2 units!"}])
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.reserved(self.other), 0)
+
+    def test_batch_is_rolled_back_when_its_units_cannot_be_held(self):
+        Product.objects.filter(id=self.product.id).update(reserved=9)
+        # Another cart took the units between the availability read and the hold
+        with mock.patch('cart.batch.get_availability', return_value={(self.product.id, None): 10, (self.other.id, None): 5}):
+            response = self.batch(
+                {'op': 'add', 'product_id': self.other.id, 'quantity': 2},
+                {'op': 'add', 'product_id': self.product.id, 'quantity': 3},
+            )
+        self.assertEqual(response['errors'], [{'index': 1, 'messages': "You can't add more than 1 units!"}])
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual((self.reserved(self.product), self.reserved(self.other)), (9, 0))
+
+    def test_a_line_keeps_the_units_it_holds(self):
+        self.batch({'op': 'add', 'product_id': self.product.id, 'quantity': 4})
+        # Everyone else's holds take the rest of the stock
+        Product.objects.filter(id=self.product.id).update(reserved=10)
+        line = CartItem.objects.get(product=self.product)
+        self.assertEqual(self.batch({'op': 'set', 'id': line.id, 'quantity': 3})['status'], 200)
+        # The unit given back is the only one nobody holds
+        self.assertEqual(self.batch({'op': 'set', 'id': line.id, 'quantity': 5})['errors'][0]['messages'], "You can't add more than 4 units!")
+        self.assertEqual(self.batch({'op': 'set', 'id': line.id, 'quantity': 4})['status'], 200)
+        self.assertEqual(self.reserved(self.product), 10)
+
+    def test_increase_stops_at_the_units_nobody_else_holds(self):
+        self.post('addtocart', {'product_id': self.other.id, 'quantity': 2})
+        line = CartItem.objects.get(product=self.other)
+        Product.objects.filter(id=self.other.id).update(reserved=4)
+        cache.clear()
+        increased = self.post('qtyincdec', {'id': line.id, 'action': 'increase'})
+        self.assertEqual((increased['status'], increased['quantity']), (200, 3))
+        refused = self.post('qtyincdec', {'id': line.id, 'action': 'increase'})
+        self.assertEqual(refused, {'status': 400, 'messages': 'Cannot increase beyond 3 units!'})
+        self.assertEqual(CartItem.objects.values_list('quantity', 'held_quantity').get(id=line.id), (3, 3))
+        self.assertEqual(self.reserved(self.other), 5)
+
+
+class ConcurrentAddTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('racer')
+        cls.product = Product.objects.create(title='Raced product', price=Decimal('2.00'), in_stock_max=10)
+        cls.cart = Cart.objects.create(user=cls.user)
+
+    def test_insert_that_loses_the_race_becomes_an_increment(self):
+        exists = QuerySet.exists
+        competitors = []
+
+        def racing_exists(queryset):
+            found = exists(queryset)
+            # Another request inserts the same line right after we saw it missing
+            if not found and not competitors and queryset.model is CartItem:
+                competitors.append(CartItem.objects.create(cart=self.cart, product=self.product, quantity=2))
+            return found
+
+        with mock.patch.object(QuerySet, 'exists', racing_exists):
+            self.assertEqual(CartItem.add_quantity(self.cart, self.product.id, None, 3), 5)
+        self.assertEqual(list(CartItem.objects.filter(cart=self.cart).values_list('quantity', flat=True)), [5])
+        self.assertEqual(Cart.objects.values_list('item_count', 'subtotal').get(id=self.cart.id), (1, Decimal('10.00')))
+
+    def test_increment_past_stock_is_refused(self):
+        CartItem.add_quantity(self.cart, self.product.id, None, 8)
+        self.assertIsNone(CartItem.add_quantity(self.cart, self.product.id, None, 3))
+        self.assertEqual(CartItem.add_quantity(self.cart, self.product.id, None, 2), 10)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class ConcurrentAddToCartTest(TransactionTestCase):
+    THREADS = 4
+    ADDS = 5
+
+    def test_concurrent_adds_make_one_line_with_every_increment(self):
+        user = make_user('crowd')
+        product = Product.objects.create(title='Crowded product', price=Decimal('1.00'), in_stock_max=100)
+        start = threading.Barrier(self.THREADS)
+        statuses = []
+
+        def worker():
+            client = self.client_class()
+            client.force_login(user)
+            start.wait()
+            try:
+                for _ in range(self.ADDS):
+                    payload = json.dumps({'product_id': product.id, 'quantity': 1})
+                    statuses.append(client.post(reverse('addtocart'), payload, content_type='application/json').json()['status'])
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(statuses, [200] * self.THREADS * self.ADDS)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', 'held_quantity')), [(self.THREADS * self.ADDS,) * 2])
+        self.assertEqual(Product.objects.values_list('reserved', flat=True).get(id=product.id), self.THREADS * self.ADDS)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class StockReservationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('holder')
+        cls.rival = make_user('rival')
+        cls.product = Product.objects.create(title='Scarce product', price=Decimal('9.00'), in_stock_max=5)
+        cls.variant = Variants.objects.create(product=Product.objects.create(title='Scarce variant', price=Decimal('9.00')), quantity=5)
+
+    def setUp(self):
+        cache.clear()
+
+    def counters(self, product=None):
+        return Product.objects.values_list('in_stock_max', 'reserved').get(id=(product or self.product).id)
+
+    def hold(self, user, quantity, expires=None):
+        cart = Cart.open_for(user, create=True)
+        CartItem.add_quantity(cart, self.product.id, None, quantity)
+        self.assertTrue(take_hold(cart, self.product.id, None, quantity))
+        if expires:
+            CartItem.objects.filter(cart=cart).update(hold_expires=expires)
+        return cart
+
+    def test_add_beyond_what_others_hold_is_refused_and_rolled_back(self):
+        self.hold(self.rival, 4)
+        self.client.force_login(self.user)
+        payload = json.dumps({'product_id': self.product.id, 'quantity': 2})
+        response = self.client.post(reverse('addtocart'), payload, content_type='application/json').json()
+        self.assertEqual(response, {'status': 400, 'messages': 'Only 1 units left!'})
+        self.assertFalse(CartItem.objects.filter(cart__user=self.user).exists())
+        self.assertEqual(self.counters(), (5, 4))
+
+    def test_full_saves_leave_reserved_alone(self):
+        product, variant = Product.objects.get(id=self.product.id), Variants.objects.get(id=self.variant.id)
+        reserve(self.product.id, None, 2)
+        reserve(self.variant.product_id, self.variant.id, 3)
+        # The admin, the deals scheduler or an import saving what they loaded earlier
+        product.title, variant.price = 'Renamed', Decimal('11.00')
+        product.save()
+        variant.save()
+        self.assertEqual(self.counters(), (5, 2))
+        self.assertEqual(Variants.objects.values_list('price', 'reserved').get(id=self.variant.id), (Decimal('11.00'), 3))
+
+    def test_expired_holds_are_released(self):
+        cart = self.hold(self.rival, 3, expires=timezone.now() - timedelta(minutes=1))
+        self.hold(self.user, 1)
+        self.assertEqual(release_expired(), 1)
+        self.assertEqual(self.counters(), (5, 1))
+        self.assertEqual(CartItem.objects.values_list('quantity', 'held_quantity', 'hold_expires').get(cart=cart), (3, 0, None))
+
+    def test_expired_hold_in_the_way_is_reclaimed(self):
+        self.hold(self.rival, 4, expires=timezone.now() - timedelta(minutes=1))
+        self.hold(self.user, 3)
+        self.assertEqual(self.counters(), (5, 3))
+
+    def test_checkout_turns_holds_into_stock_decrements(self):
+        cart = self.hold(self.user, 3)
+        self.hold(self.rival, 2)
+        before = get_versions('api:products', 'api:variants')
+        with self.captureOnCommitCallbacks(execute=True):
+            commit_cart_stock(cart)
+        self.assertEqual(self.counters(), (2, 2))
+        self.assertEqual(CartItem.objects.values_list('held_quantity', flat=True).get(cart=cart), 0)
+        # The read API shows the stock left
+        after = get_versions('api:products', 'api:variants')
+        self.assertTrue(all(after[key] != before[key] for key in before))
+
+    def test_checkout_refuses_lines_stock_no_longer_covers(self):
+        cart = Cart.open_for(self.user, create=True)
+        CartItem.add_quantity(cart, self.product.id, None, 3)
+        self.hold(self.rival, 4)
+        with self.assertRaises(OutOfStock) as raised:
+            commit_cart_stock(cart)
+        self.assertEqual([line.available for line in raised.exception.lines], [1])
+
+
+class CouponRulesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user('saver')
+        cls.other = make_user('sharer')
+
+    def setUp(self):
+        cache.clear()
+
+    def coupon(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = Coupon.objects.create(coupon_code='SAVE', coupon_discount=Decimal('20.00'), **fields)
+        return coupon_rules().by_id[coupon.id]
+
+    def used(self, rule):
+        return Coupon.objects.values_list('used_count', flat=True).get(id=rule.id)
+
+    def test_redeem_stops_at_max_uses(self):
+        rule = self.coupon(max_uses=2)
+        redeem(rule, self.user)
+        redeem(rule, self.other)
+        self.assertFalse(uses_left(rule, self.user))
+        with self.assertRaises(CouponLimitReached):
+            redeem(rule, self.user)
+        self.assertEqual(self.used(rule), 2)
+
+    def test_redeem_stops_at_max_uses_per_user(self):
+        rule = self.coupon(max_uses_per_user=1)
+        redeem(rule, self.user)
+        self.assertFalse(uses_left(rule, self.user))
+        self.assertTrue(uses_left(rule, self.other))
+        # The global count moved by the refused try is undone with the order's transaction
+        with self.assertRaises(CouponLimitReached), transaction.atomic():
+            redeem(rule, self.user)
+        self.assertEqual(self.used(rule), 1)
+        self.assertEqual(CouponUsage.objects.get(coupon_id=rule.id, user=self.user).used_count, 1)
+
+    def test_saving_a_coupon_recompiles_the_rules(self):
+        rule = self.coupon()
+        self.assertIs(coupon_rules().by_code['SAVE'], rule)
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = Coupon.objects.get(id=rule.id)
+            coupon.minimum_amount = Decimal('50.00')
+            coupon.save()
+        self.assertEqual(coupon_rules().by_code['SAVE'].minimum_amount, Decimal('50.00'))
+        with self.assertNumQueries(0):
+            coupon_rules()
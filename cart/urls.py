@@ -1,12 +1,16 @@
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 from cart.views import (
-    AddToCart, QuantityIncDec, RemoveToCart, CartView, CouponApplyView
+    AddToCart, QuantityIncDec, RemoveToCart, CartBatchView, CartView, CouponApplyView, MiniCartView,
+    StockAvailabilityView
 )
 urlpatterns = [
     path('addtocart/', AddToCart.as_view(), name='addtocart'),
     path('qtyincdec/', QuantityIncDec.as_view(), name='qtyincdec'),
     path('removetocart/', RemoveToCart.as_view(), name='removetocart'),
+    path('batch/', CartBatchView.as_view(), name='cartbatch'),
     path('cartview/', CartView.as_view(), name='cartview'),
     path('couponapplyview/', CouponApplyView.as_view(), name='couponapplyview'),
+    path('minicart/', MiniCartView.as_view(), name='minicart'),
+    path('availability/<int:id>/', StockAvailabilityView.as_view(), name='stockavailability'),
 ]
\ No newline at end of file
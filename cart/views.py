@@ -3,13 +3,15 @@ from django.shortcuts import render,redirect, get_object_or_404
 from django.template.loader import render_to_string
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse_lazy
 from django.contrib import messages
 from django.views import generic
 from django.utils import timezone
 from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
-from django.db.models import Min, Max, Sum
+from django.db import transaction
+from django.db.models import F, Min, Max, Sum
 import json
 from cart.forms import (
     CartItemForm
@@ -20,11 +22,47 @@ from stories.models import (
 from cart.models import (
     Coupon, Cart, CartItem
 )
+from cart.pricing import price_cart, price_lines
+from cart.guest import GUEST_CART_MAX_LINES, GuestCart, GuestLine, line_key, parse_line_key
+from cart.batch import BatchError, parse_operations, plan_batch, stock_error, write_cart_lines
+from cart.reservations import get_availability, sync_holds, take_hold
+from cart.coupons import coupon_rules, uses_left
+from cart.context_processors import get_guest_cart_summary
+from stories.caching import bump_versions, get_variant_matrix
+
+def guest_cart_response(guest, items, payload):
+    """JSON answer of a guest cart change with the cart's new totals, storing the cart in its cookie."""
+    pricing = price_lines(items)
+    response = JsonResponse({
+        'status': 200,
+        **payload,
+        'cart_count': pricing.item_count,
+        'cart_totals': pricing.total,
+        'payable_price': pricing.payable,
+        'shipping_fee': pricing.shipping,
+    })
+    guest.save(response)
+    return response
+
+def guest_line(request, line_id):
+    """(guest cart, its loaded lines, the line line_id) of the visitor; the line is None when it is not in the cart."""
+    guest = GuestCart.from_request(request)
+    parse_line_key(line_id)
+    items = guest.items()
+    return guest, items, next((line for line in items if line.id == str(line_id)), None)
 
 # create your views here
 @method_decorator(never_cache, name='dispatch')
-class AddToCart(LoginRequiredMixin, generic.View):
-    login_url = reverse_lazy('sign')
+@method_decorator(ensure_csrf_cookie, name='dispatch')
+class MiniCartView(generic.View):
+    """Cart badge and mini-cart of the current visitor, loaded after pages that may be served from a shared cache."""
+    def get(self, request):
+        context = {} if request.user.is_authenticated else get_guest_cart_summary(request)
+        return render(request, 'components/mini_cart.html', context)
+
+@method_decorator(never_cache, name='dispatch')
+class AddToCart(generic.View):
+    """Add to the user's cart, or to the signed-cookie cart of a guest."""
 
     def post(self, request):
         if request.method == "POST":
@@ -46,14 +84,12 @@ class AddToCart(LoginRequiredMixin, generic.View):
                     return JsonResponse({"status": 400, "messages": "Item ID is required!"})
                 product = get_object_or_404(Product, id=product_id)
 
-                # Get variant if applicable (Optimized Query)
-                variant_qs = Variants.objects.filter(
+                # Variant with exactly this size and color, if any
+                variant = Variants.objects.filter(
                     product=product,
                     size_id=size_id if size_id else None,
                     color_id=color_id if color_id else None
-                )
-                
-                variant = list(variant_qs)[0] if variant_qs.exists() else None  # No IndexError
+                ).first()
 
                 if (size_id or color_id) and not variant:
                     return JsonResponse({"status": 400, "messages": "Variant not found!"})
@@ -63,41 +99,37 @@ class AddToCart(LoginRequiredMixin, generic.View):
                 if max_stock <= 0:
                     return JsonResponse({"status": 400, "messages": "Item out of stock!"})
 
-                # Get or create cart (Optimized Query)
-                cart_qs = Cart.objects.filter(user=request.user, paid=False).prefetch_related('items__product', 'items__variant')
-                cart = list(cart_qs)[0] if cart_qs.exists() else Cart.objects.create(user=request.user, paid=False)  # No IndexError
-
-                # Check if product already exists in cart
-                cart_item_qs = cart.items.filter(product=product, variant=variant)
-                if cart_item_qs.exists():
-                    existing_cart_item = list(cart_item_qs)[0]  # No IndexError
-                    new_quantity = existing_cart_item.quantity + quantity
-                    if new_quantity <= max_stock:
-                        existing_cart_item.quantity = new_quantity
-                        existing_cart_item.save()
-                        messages = "Quantity updated successfully!"
-                    else:
-                        return JsonResponse({"status": 400, "messages": f"You can't add more than {max_stock} units!"})
-                else:
-                    if quantity <= max_stock:
-                        CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=quantity)
-                        messages = "Item added to cart successfully!"
-                    else:
-                        return JsonResponse({"status": 400, "messages": f"You can't add more than {max_stock} units!"})
-
-                # Update cart count & total price (Optimized)
-                cart_count = cart.items.count()
-                cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart.items.all())
-
-                # Apply coupon discount if valid
-                if cart.coupon and cart.coupon.is_valid(cart_totals):
-                    cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)
+                if not request.user.is_authenticated:
+                    return self.add_to_guest_cart(request, product, variant, quantity, max_stock)
+
+                cart = Cart.open_for(request.user, create=True)
+
+                variant_id = variant.id if variant else None
+                with transaction.atomic():
+                    # Insert or increment the line; stock is checked again by the write itself
+                    new_quantity = CartItem.add_quantity(cart, product.id, variant_id, quantity)
+                    # Hold the added units until checkout, or give the line back
+                    held = new_quantity is not None and take_hold(cart, product.id, variant_id, quantity)
+                    if not held:
+                        transaction.set_rollback(True)
+                if new_quantity is None:
+                    return JsonResponse({"status": 400, "messages": f"You can't add more than {max_stock} units!"})
+                if not held:
+                    # Read once the rollback is done: nothing may query a transaction marked for rollback
+                    available = get_availability([(product.id, variant_id)])[(product.id, variant_id)]
+                    return JsonResponse({"status": 400, "messages": f"Only {available} units left!" if available else "Item out of stock!"})
+                messages = "Item added to cart successfully!" if new_quantity == quantity else "Quantity updated successfully!"
+
+                # Updated cart count & totals
+                pricing = price_cart(cart_id=cart.id)
 
                 return JsonResponse({
                     'status': 200, 
                     'messages': messages, 
-                    'cart_count': cart_count, 
-                    'cart_totals': cart_totals,
+                    'cart_count': pricing.item_count, 
+                    'cart_totals': pricing.total,
+                    'payable_price': pricing.payable,
+                    'shipping_fee': pricing.shipping,
                 })
 
             except (ValueError, TypeError, json.JSONDecodeError) as e:
@@ -107,9 +139,20 @@ class AddToCart(LoginRequiredMixin, generic.View):
 
         return JsonResponse({'status': 400, 'messages': 'Invalid request'})
 
+    def add_to_guest_cart(self, request, product, variant, quantity, max_stock):
+        guest = GuestCart.from_request(request)
+        variant_id = variant.id if variant else None
+        if guest.is_full(product.id, variant_id):
+            return JsonResponse({"status": 400, "messages": "Your cart is full!"})
+        current = guest.quantity(product.id, variant_id)
+        if current + quantity > max_stock:
+            return JsonResponse({"status": 400, "messages": f"You can't add more than {max_stock} units!"})
+        guest.set(product.id, variant_id, current + quantity)
+        message = "Quantity updated successfully!" if current else "Item added to cart successfully!"
+        return guest_cart_response(guest, guest.items(), {'messages': message})
+
 @method_decorator(never_cache, name='dispatch')
-class QuantityIncDec(LoginRequiredMixin, generic.View):
-    login_url = reverse_lazy('sign')
+class QuantityIncDec(generic.View):
     
     def post(self, request):
         if request.method == "POST":
@@ -123,29 +166,40 @@ class QuantityIncDec(LoginRequiredMixin, generic.View):
                 if not cart_item_id or not action:
                     return JsonResponse({"status": 400, "messages": "Cart item ID and action are required!"})
 
+                if not request.user.is_authenticated:
+                    return self.change_guest_line(request, cart_item_id, action)
+
                 # Get the cart item
-                cart_item = get_object_or_404(CartItem, id=cart_item_id)
+                cart_item = get_object_or_404(CartItem.objects.select_related('product', 'variant'), id=cart_item_id, cart__user=request.user, cart__paid=False)
 
                 # Get product and variant details
                 product = cart_item.product
                 variant = cart_item.variant
                 
-                # Determine max stock
-                max_stock = variant.quantity if variant else product.in_stock_max
+                # Units nobody else holds, plus the ones this line holds
+                option = (product.id, variant.id if variant else None)
+                max_stock = get_availability([option])[option] + cart_item.held_quantity
 
                 # Increase or decrease quantity
                 if action == "increase":
-                    if cart_item.quantity < max_stock:
+                    if cart_item.quantity >= max_stock:
+                        return JsonResponse({"status": 400, "messages": f"Cannot increase beyond {max_stock} units!"})
+                    with transaction.atomic():
                         cart_item.quantity += 1
                         cart_item.save()
-                        message = "Quantity increased successfully!"
-                    else:
-                        return JsonResponse({"status": 400, "messages": f"Cannot increase beyond {max_stock} units!"})
+                        # Another cart took the unit since it was read: give the line back
+                        held = option not in sync_holds(cart_item.cart_id)
+                        if not held:
+                            transaction.set_rollback(True)
+                    if not held:
+                        return JsonResponse({"status": 400, "messages": f"Cannot increase beyond {cart_item.quantity - 1} units!"})
+                    message = "Quantity increased successfully!"
                 
                 elif action == "decrease":
                     if cart_item.quantity > 1:
                         cart_item.quantity -= 1
                         cart_item.save()
+                        sync_holds(cart_item.cart_id)
                         message = "Quantity decreased successfully!"
                     else:
                         return JsonResponse({"status": 400, "messages": "Quantity cannot be less than 1!"})
@@ -153,26 +207,18 @@ class QuantityIncDec(LoginRequiredMixin, generic.View):
                 else:
                     return JsonResponse({"status": 400, "messages": "Invalid action!"})
 
-                # Update cart details
-                cart = cart_item.cart
-                cart_items = list(cart.items.prefetch_related('product', 'variant').all())
-
-                # Calculate cart totals
-                cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart_items)
-
-                # Apply coupon discount if valid
-                if cart.coupon and cart.coupon.is_valid(cart_totals):
-                    cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)
-
+                # Updated cart details
+                pricing = price_cart(cart_id=cart_item.cart_id)
 
                 return JsonResponse({
                     'status': 200,
                     'messages': message, 
                     'quantity': cart_item.quantity,
-                    'item_total_price': cart_item.quantity * (cart_item.variant.price if cart_item.variant else cart_item.product.price),
-                    'cart_count': cart.items.count(),  
-                    'cart_totals': cart_totals,
-                    'payable_price': cart_totals + 150,  
+                    'item_total_price': cart_item.total_price_of_items,
+                    'cart_count': pricing.item_count,  
+                    'cart_totals': pricing.total,
+                    'payable_price': pricing.payable,  
+                    'shipping_fee': pricing.shipping,
                     'id': cart_item.id
                 })
 
@@ -183,9 +229,34 @@ class QuantityIncDec(LoginRequiredMixin, generic.View):
 
         return JsonResponse({"status": 400, "messages": "Invalid request"})
 
+    def change_guest_line(self, request, line_id, action):
+        guest, items, line = guest_line(request, line_id)
+        if line is None:
+            return JsonResponse({"status": 400, "messages": "Item not found in cart!"})
+        option = (line.product.id, line.variant.id if line.variant else None)
+        max_stock = get_availability([option])[option]
+        if action == "increase":
+            if line.quantity >= max_stock:
+                return JsonResponse({"status": 400, "messages": f"Cannot increase beyond {max_stock} units!"})
+            quantity, message = line.quantity + 1, "Quantity increased successfully!"
+        elif action == "decrease":
+            if line.quantity <= 1:
+                return JsonResponse({"status": 400, "messages": "Quantity cannot be less than 1!"})
+            quantity, message = line.quantity - 1, "Quantity decreased successfully!"
+        else:
+            return JsonResponse({"status": 400, "messages": "Invalid action!"})
+        guest.set(line.product.id, line.variant.id if line.variant else None, quantity)
+        line = line._replace(quantity=quantity, line_total=line.unit_price * quantity)
+        items = [line if item.id == line.id else item for item in items]
+        return guest_cart_response(guest, items, {
+            'messages': message,
+            'quantity': quantity,
+            'item_total_price': line.line_total,
+            'id': line.id,
+        })
+
 @method_decorator(never_cache, name='dispatch')
-class RemoveToCart(LoginRequiredMixin, generic.View):
-    login_url = reverse_lazy('sign')
+class RemoveToCart(generic.View):
 
     def post(self, request):
         if request.method == "POST":
@@ -196,25 +267,24 @@ class RemoveToCart(LoginRequiredMixin, generic.View):
                 if not cart_item_id:
                     return JsonResponse({"status": 400, "messages": "Missing cart item ID"})
 
+                if not request.user.is_authenticated:
+                    return self.remove_guest_line(request, cart_item_id)
+
                 # Get and delete the cart item
                 cart_item = get_object_or_404(CartItem, id=cart_item_id, cart__user=request.user, cart__paid=False)
-                cart = cart_item.cart  # Store cart before deleting item
+                cart_id = cart_item.cart_id  # Store cart before deleting item
                 cart_item.delete()  
 
-                # Update cart details
-                cart_items = list(cart.items.prefetch_related('product', 'variant').all())  # Optimized Query
-                cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart_items)
-                
-                # Apply coupon discount if valid
-                if cart.coupon and cart.coupon.is_valid(cart_totals):
-                    cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)    
+                # Updated cart details
+                pricing = price_cart(cart_id=cart_id)
 
                 return JsonResponse({
                     "status": 200, 
                     "messages": "Item removed from cart",
-                    "cart_count": cart.items.count(),  
-                    "cart_totals": cart_totals,
-                    "payable_price": cart_totals + 150,
+                    "cart_count": pricing.item_count,  
+                    "cart_totals": pricing.total,
+                    "payable_price": pricing.payable,
+                    "shipping_fee": pricing.shipping,
                     "id": cart_item_id  # Using stored ID instead of deleted object
                 })
 
@@ -225,6 +295,88 @@ class RemoveToCart(LoginRequiredMixin, generic.View):
 
         return JsonResponse({"status": 400, "messages": "Invalid request"})
 
+    def remove_guest_line(self, request, line_id):
+        guest, items, line = guest_line(request, line_id)
+        if line is None:
+            return JsonResponse({"status": 400, "messages": "Item not found in cart!"})
+        guest.set(line.product.id, line.variant.id if line.variant else None, 0)
+        items = [item for item in items if item.id != line.id]
+        return guest_cart_response(guest, items, {"messages": "Item removed from cart", "id": line.id})
+
+@method_decorator(never_cache, name='dispatch')
+class CartBatchView(generic.View):
+    """Apply a list of add / set / remove operations to the visitor's cart in one request.
+
+    Body: {"operations": [{"op": "add", "product_id", "size_id", "color_id" | "variant_id", "quantity"},
+    {"op": "set", "id", "quantity"}, {"op": "remove", "id"}, ...]}. Either every operation
+    is applied, in one transaction, or none is and the errors name the failing ones.
+    """
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+            operations = parse_operations(data.get("operations") if isinstance(data, dict) else None)
+            if request.user.is_authenticated:
+                return self.apply_to_cart(request, operations)
+            return self.apply_to_guest_cart(request, operations)
+        except BatchError as e:
+            return JsonResponse({"status": 400, "messages": "Cart was not updated!", "errors": e.errors})
+        except (ValueError, TypeError, json.JSONDecodeError) as e:
+            return JsonResponse({"status": 400, "messages": f"Invalid input: {str(e)}"})
+        except Exception as e:
+            return JsonResponse({"status": 400, "messages": f"Something went wrong: {str(e)}"})
+
+    def apply_to_cart(self, request, operations):
+        with transaction.atomic():
+            # Locked so concurrent batches of the same user apply one after the other
+            cart = Cart.objects.select_for_update().get(id=Cart.open_for(request.user, create=True).id)
+            items = {(item.product_id, item.variant_id): item for item in CartItem.objects.filter(cart=cart)}
+            held = {key: item.held_quantity for key, item in items.items()}
+            plan = plan_batch(
+                {key: item.quantity for key, item in items.items()},
+                {str(item.id): key for key, item in items.items()},
+                operations,
+                held,
+            )
+            items = write_cart_lines(cart, items, plan.lines)
+            # Changed lines are held in full, or the whole batch is rolled back
+            short = [key for key in sync_holds(cart.id) if key in plan.touched]
+            if short:
+                available = get_availability(short)
+                raise BatchError(sorted(
+                    (stock_error(plan.touched[key], available[key] + held.get(key, 0)) for key in short),
+                    key=lambda error: error['index'],
+                ))
+        pricing = price_cart(cart_id=cart.id)
+        return JsonResponse({
+            "status": 200,
+            "messages": "Cart updated successfully!",
+            "items": [
+                {"id": item.id, "quantity": item.quantity, "item_total_price": plan.unit_prices.get(key, 0) * item.quantity}
+                for key, item in items.items()
+            ],
+            "cart_count": pricing.item_count,
+            "cart_totals": pricing.total,
+            "payable_price": pricing.payable,
+            "shipping_fee": pricing.shipping,
+            "version": pricing.version,
+        })
+
+    def apply_to_guest_cart(self, request, operations):
+        guest = GuestCart.from_request(request)
+        plan = plan_batch(guest.lines, {line_key(*key): key for key in guest.lines}, operations)
+        if len(plan.lines) > max(len(guest.lines), GUEST_CART_MAX_LINES):
+            raise BatchError([{"index": operations[-1]["index"], "messages": "Your cart is full!"}])
+        guest.lines = {key: quantity for key, quantity in plan.lines.items() if key in plan.unit_prices}
+        items = [
+            GuestLine(line_key(*key), None, None, quantity, plan.unit_prices[key], plan.unit_prices[key] * quantity)
+            for key, quantity in guest.lines.items()
+        ]
+        return guest_cart_response(guest, items, {
+            "messages": "Cart updated successfully!",
+            "items": [{"id": item.id, "quantity": item.quantity, "item_total_price": item.line_total} for item in items],
+        })
+
 @method_decorator(never_cache, name='dispatch')
 class CouponApplyView(LoginRequiredMixin, generic.View):
     login_url = reverse_lazy('sign')
@@ -237,31 +389,33 @@ class CouponApplyView(LoginRequiredMixin, generic.View):
                 if not coupon_code:
                     return JsonResponse({"status": 400, "messages": "Coupon code is required!"})
 
-                # Coupon check 
-                coupon_qs = Coupon.objects.filter(coupon_code=coupon_code, is_expired=False)
-                if not coupon_qs.exists():
+                # Coupon check, against the compiled rules
+                rule = coupon_rules().by_code.get(coupon_code)
+                if rule is None or not rule.is_live():
                     return JsonResponse({"status": 400, "messages": "Invalid or expired coupon!"})
-                coupon = list(coupon_qs)[0]  # IndexError ignored using list()
 
                 # Cart check 
-                cart_qs = Cart.objects.filter(user=request.user, paid=False)
-                if not cart_qs.exists():
+                pricing = price_cart(request.user)
+                if pricing.cart_id is None:
                     return JsonResponse({"status": 400, "messages": "Cart not found!"})
-                cart = list(cart_qs)[0]  # IndexError ignored using list()
 
                 # Coupon valid check 
-                if not coupon.is_valid(cart.total_amount):
+                if not rule.applies(pricing.subtotal):
                     return JsonResponse({"status": 400, "messages": "Coupon cannot be applied!"})
+                if not uses_left(rule, request.user):
+                    return JsonResponse({"status": 400, "messages": "Coupon usage limit reached!"})
 
                 # Coupon apply 
-                cart.coupon = coupon
-                cart.save()
+                Cart.objects.filter(id=pricing.cart_id).update(coupon_id=rule.id, version=F('version') + 1)
+                bump_versions(f'cart:{request.user.id}')
+                pricing = pricing._replace(discount=rule.discount_on(pricing.subtotal))
 
                 return JsonResponse({
                     "status": 200,
                     "messages": "Coupon applied successfully!",
-                    "cart_totals": cart.total_amount,
-                    "payable_price": cart.total_amount + 150
+                    "cart_totals": pricing.total,
+                    "payable_price": pricing.payable,
+                    "shipping_fee": pricing.shipping
                 })
                 
             except (ValueError, TypeError, json.JSONDecodeError) as e:
@@ -273,11 +427,26 @@ class CouponApplyView(LoginRequiredMixin, generic.View):
         return JsonResponse({"status": 400, "messages": "Invalid request"})
 
 @method_decorator(never_cache, name='dispatch')
-class CartView(LoginRequiredMixin, generic.View):
-    login_url = reverse_lazy('sign')
+class CartView(generic.View):
 
     def get(self, request):
-        # Get the user's existing cart
+        # Users' carts come from the context processor, guests' from their cookie
+        context = {} if request.user.is_authenticated else get_guest_cart_summary(request)
 
         # Render the cart page
-        return render(request, 'cart/cart.html', {})    
+        return render(request, 'cart/cart.html', context)    
+
+@method_decorator(never_cache, name='dispatch')
+class StockAvailabilityView(generic.View):
+    """Units of each variant of a product nobody holds, from the cached availability counters."""
+
+    def get(self, request, id):
+        # Variant ids come from the cached variant matrix, so a warm request runs no query
+        matrix = get_variant_matrix(Product(id=id))
+        variant_ids = [cell['variant_id'] for row in matrix['matrix'].values() for cell in row.values()]
+        options = [(id, variant_id) for variant_id in variant_ids] or [(id, None)]
+        available = get_availability(options)
+        return JsonResponse({
+            'status': 200,
+            'available': {str(variant_id or 0): units for (_, variant_id), units in available.items()},
+        })
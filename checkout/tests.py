@@ -1,3 +1,58 @@
-from django.test import TestCase
+import json
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from stories.models import Product
+from cart.models import Cart, CartItem, Coupon, ZERO
+from cart.pricing import price_cart
+from checkout.models import Checkout
 
 # Create your tests here.
+ADDRESS = {
+    'full_name': 'Test Buyer', 'email': 'buyer@example.com', 'country': 'Bangladesh', 'city': 'Dhaka',
+    'home_city': 'Dhaka', 'zip_code': '1207', 'phone': '0123456789', 'address': 'Road 1', 'payment_method': 'Cash',
+}
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class CheckoutCouponTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('buyer', 'buyer@example.com', 'password')
+        cls.product = Product.objects.create(title='Checked out product', price=Decimal('50.00'), in_stock_max=10)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.coupon = Coupon.objects.create(coupon_code='ONCE', coupon_discount=Decimal('10.00'), max_uses_per_user=1)
+        self.cart = Cart.open_for(self.user, create=True)
+        CartItem.add_quantity(self.cart, self.product.id, None, 2)
+        Cart.objects.filter(id=self.cart.id).update(coupon=self.coupon)
+
+    def checkout(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('checkout'), json.dumps(ADDRESS), content_type='application/json').json()
+
+    def test_order_redeems_the_coupon_and_detaches_it(self):
+        self.assertEqual(self.checkout()['status'], 200)
+        self.assertTrue(Checkout.objects.filter(cart=self.cart).exists())
+        self.assertEqual(Coupon.objects.values_list('used_count', flat=True).get(id=self.coupon.id), 1)
+        self.assertIsNone(Cart.objects.values_list('coupon', flat=True).get(id=self.cart.id))
+        # The next order from the cart is priced without the coupon
+        CartItem.add_quantity(self.cart, self.product.id, None, 1)
+        self.assertEqual(price_cart(self.user).discount, ZERO)
+
+    def test_coupon_over_its_limit_is_removed_and_nothing_is_ordered(self):
+        Coupon.objects.filter(id=self.coupon.id).update(max_uses=1, used_count=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Coupon.objects.get(id=self.coupon.id).save()
+        response = self.checkout()
+        self.assertEqual(response['status'], 400)
+        self.assertFalse(Checkout.objects.exists())
+        self.assertIsNone(Cart.objects.values_list('coupon', flat=True).get(id=self.cart.id))
+        self.assertEqual(Product.objects.values_list('in_stock_max', flat=True).get(id=self.product.id), 10)
@@ -5,6 +5,8 @@ from django.http import JsonResponse
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import F
 from django.contrib import messages
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
@@ -14,33 +16,27 @@ from django.urls import reverse
 from paypal.standard.ipn.models import PayPalIPN
 from checkout.models import Checkout, CheckoutItem
 from cart.models import Cart, CartItem
+from cart.pricing import price_cart, priced_items
+from cart.reservations import OutOfStock, commit_cart_stock
+from cart.coupons import CouponLimitReached, coupon_rules, redeem
+from stories.caching import bump_versions
 
 @method_decorator(never_cache, name='dispatch')
 class CheckoutView(LoginRequiredMixin, generic.View):
     def get(self, request):
-        carts = list(Cart.objects.filter(user=request.user, paid=False))
+        pricing = price_cart(request.user)
 
-        if not carts:
+        if pricing.cart_id is None:
             return redirect("cartview")
 
-        cart = carts[0]
-        cart_items = list(CartItem.objects.filter(cart=cart))
-
-        # Calculate total cart price
-        cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart_items)
-
-        # Apply coupon if available
-        if cart.coupon and cart.coupon.is_valid(cart_totals):
-            cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)
-
-        shipping_cost = 150
-        payable_price = cart_totals + shipping_cost  
+        cart_items = list(priced_items(pricing.cart_id))
 
         payment_methods = Checkout._meta.get_field('payment_method').choices  
 
         context = {
-            "cart_totals": cart_totals,
-            "payable_price": payable_price,
+            "cart_totals": pricing.total,
+            "payable_price": pricing.payable,
+            "shipping_fee": pricing.shipping,
             "cart_items": cart_items,
             "payment_methods": payment_methods
         }
@@ -68,24 +64,15 @@ class CheckoutView(LoginRequiredMixin, generic.View):
                     return JsonResponse({'status': 400, 'messages': "Invalid payment method!"})
 
                 # Get user's active cart
-                carts = list(Cart.objects.filter(user=request.user, paid=False))
-                if not carts:
+                pricing = price_cart(request.user)
+                if pricing.cart_id is None:
                     return JsonResponse({'status': 400, 'messages': "Your cart is empty!"})
-
-                cart = carts[0]
-                cart_items = list(CartItem.objects.filter(cart=cart))
-                if not cart_items:
+                if not pricing.item_count:
                     return JsonResponse({'status': 400, 'messages': "No items in cart!"})
 
-                # Calculate total price
-                cart_totals = sum(item.quantity * (item.variant.price if item.variant else item.product.price) for item in cart_items)
-
-                # Apply coupon if available
-                if cart.coupon and cart.coupon.is_valid(cart_totals):
-                    cart_totals -= cart_totals * (cart.coupon.coupon_discount / 100)
-
-                shipping_cost = 150
-                payable_price = cart_totals + shipping_cost  
+                cart = Cart.objects.get(id=pricing.cart_id)
+                cart_items = list(priced_items(cart.id))
+                payable_price = pricing.payable
 
                 # Determine if the checkout is paid (only for online payments)
                 if payment_method == 'Cash':
@@ -104,48 +91,67 @@ class CheckoutView(LoginRequiredMixin, generic.View):
                     }
                     form = PayPalPaymentsForm(initial=paypal_dict)
                     return JsonResponse({'status': 200, 'messages': "Redirecting to PayPal", 'form': form.render()})    
-                # Create checkout record
-                checkout = Checkout.objects.create(
-                    user=request.user,
-                    cart=cart,
-                    total=payable_price,
-                    payment_method=payment_method,
-                    payment=paid,  
-                    full_name=full_name,
-                    email=email,
-                    country=country,
-                    city=city,
-                    home_city=home_city,
-                    zip_code=zip_code,
-                    phone=phone,
-                    address=address,
-                    created_date=timezone.now()
-                )
-
-                # Generate unique payment and tracking IDs
-                checkout.payment_id = f"PAY-{uuid.uuid4().hex[:10].upper()}"
-                checkout.shipping_date = timezone.now()  
-                checkout.invoice_no = f"INV-{uuid.uuid4().hex[:10].upper()}"
-                checkout.tracking_no = f"TRK-{uuid.uuid4().hex[:10].upper()}"
-                checkout.save()
-
-                # Create checkout items
-                for item in cart_items:
-                    CheckoutItem.objects.create(
-                        user=request.user,
-                        checkout=checkout,
-                        product=item.product,
-                        variant=item.variant,
-                        quantity=item.quantity,
-                        total_amount=item.quantity * (item.variant.price if item.variant else item.product.price)
-                    )
-
-                # Update cart payment status based on payment method
-                cart.paid = paid  # If Cash, remains False; otherwise, True
-                cart.save()
-
-                # Clear the cart items only after successful checkout
-                CartItem.objects.filter(cart=cart).delete()
+                try:
+                    with transaction.atomic():
+                        # Holds become stock decrements; a line stock no longer covers aborts the order
+                        commit_cart_stock(cart)
+
+                        # The order counts against the coupon's usage limits
+                        rule = coupon_rules().by_id.get(cart.coupon_id) if pricing.discount else None
+                        if rule:
+                            redeem(rule, request.user)
+
+                        # Create checkout record
+                        checkout = Checkout.objects.create(
+                            user=request.user,
+                            cart=cart,
+                            total=payable_price,
+                            payment_method=payment_method,
+                            payment=paid,  
+                            full_name=full_name,
+                            email=email,
+                            country=country,
+                            city=city,
+                            home_city=home_city,
+                            zip_code=zip_code,
+                            phone=phone,
+                            address=address,
+                            created_date=timezone.now()
+                        )
+
+                        # Generate unique payment and tracking IDs
+                        checkout.payment_id = f"PAY-{uuid.uuid4().hex[:10].upper()}"
+                        checkout.shipping_date = timezone.now()  
+                        checkout.invoice_no = f"INV-{uuid.uuid4().hex[:10].upper()}"
+                        checkout.tracking_no = f"TRK-{uuid.uuid4().hex[:10].upper()}"
+                        checkout.save()
+
+                        # Create checkout items
+                        for item in cart_items:
+                            CheckoutItem.objects.create(
+                                user=request.user,
+                                checkout=checkout,
+                                product=item.product,
+                                variant=item.variant,
+                                quantity=item.quantity,
+                                total_amount=item.line_total
+                            )
+
+                        # Update cart payment status (if Cash, remains False); the coupon went to this
+                        # order, so the cart's next one does not get it again
+                        Cart.objects.filter(id=cart.id).update(paid=paid, coupon=None, version=F('version') + 1, update_date=timezone.now())
+                        bump_versions(f'cart:{request.user.id}')
+
+                        # Clear the cart items only after successful checkout
+                        CartItem.objects.filter(cart=cart).delete()
+                except CouponLimitReached:
+                    # The order is placed at full price on the next try
+                    Cart.objects.filter(id=cart.id).update(coupon=None, version=F('version') + 1)
+                    bump_versions(f'cart:{request.user.id}')
+                    return JsonResponse({'status': 400, 'messages': "Coupon usage limit reached! It was removed from your cart."})
+                except OutOfStock as e:
+                    short = ', '.join(f"{line.item.product.title} ({line.available} left)" for line in e.lines)
+                    return JsonResponse({'status': 400, 'messages': f"Not enough stock for: {short}"})
 
                 # Success message
                 messages.success(request, "Your checkout has been placed successfully!")
@@ -155,10 +161,12 @@ class CheckoutView(LoginRequiredMixin, generic.View):
                 return JsonResponse({'status': 400, 'messages': f"Error: {str(e)}"})
         return JsonResponse({'status': 400, 'messages': "Invalid request method!"})
     
+@method_decorator(never_cache, name='dispatch')
 class PaymentSuccessView(LoginRequiredMixin, generic.View):
     def get(self, request):
         return render(request, 'checkout/payment_success.html')
 
+@method_decorator(never_cache, name='dispatch')
 class PaymentCancelView(LoginRequiredMixin, generic.View):
     def get(self, request):
         return render(request, 'checkout/payment_cancel.html')
\ No newline at end of file
@@ -40,6 +40,7 @@ ALLOWED_HOSTS = []
 
 INSTALLED_APPS = [
     'unfold',
+    'unfold.contrib.filters',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -107,6 +108,24 @@ DATABASES = {
         'PORT': '3306',
     }
 }
+#cache configuration
+#Storefront caches are invalidated through version keys stored in the cache itself,
+#so every worker must share one backend in production: set CACHE_BACKEND to redis or
+#memcached (installing the redis or pymemcache package) and CACHE_LOCATION to its address
+#(e.g. redis://127.0.0.1:6379/1, 127.0.0.1:11211).
+#The default locmem cache is per process and only suits development.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'memcached': 'django.core.cache.backends.memcached.PyMemcacheCache',
+}
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[os.environ.get('CACHE_BACKEND', 'locmem')],
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'e-shop'),
+    }
+}
+
 #messages configuration
 #https://docs.djangoproject.com/en/5.0/ref/contrib/messages/
 
@@ -8,6 +8,7 @@ urlpatterns = [
     path('account/', include('account.urls')),
     path('cart/', include('cart.urls')),
     path('checkout/', include('checkout.urls')),
+    path('api/v1/', include('stories.api')),
     path('api/', include('rest_framework.urls')),
     path('admin/', admin.site.urls),
     path("paypal/", include("paypal.standard.ipn.urls")),
@@ -1,27 +1,146 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from unfold.admin import ModelAdmin
+from unfold.contrib.filters.admin import AutocompleteSelectFilter
 import admin_thumbnails
 
 from stories.models import (
-    Category,Brand,Product, Images,Color,Size,Variants,Slider,Banner,ProductFuture,Review
+    Category,Brand,Product, Images,Color,Size,Variants,Slider,Banner,ProductFuture,Review,
+    Collection, CollectionMembership,
 )
+
+# Unfiltered changelists of tables bigger than this show the planner's row estimate
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+def estimated_row_count(model, using='default'):
+    """Row count from the database statistics, or None where the backend keeps none."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Skips the COUNT(*) of a whole big table; filtered changelists are still counted exactly."""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LoadedAutocompleteSelect(AutocompleteSelect):
+    """Autocomplete select that labels its value from an already loaded object instead of a query."""
+    loaded_choice = None
+
+    def optgroups(self, name, value, attr=None):
+        selected = {str(v) for v in value if str(v) not in self.choices.field.empty_values}
+        if self.loaded_choice is None or selected != {str(self.loaded_choice.pk)}:
+            return super().optgroups(name, value, attr)
+        default = (None, [], 0)
+        if not self.is_required:
+            default[1].append(self.create_option(name, '', '', False, 0))
+        label = self.choices.field.label_from_instance(self.loaded_choice)
+        default[1].append(self.create_option(name, self.loaded_choice.pk, label, True, len(default[1])))
+        return [default]
+
+
+class LoadedChoicesForm(forms.ModelForm):
+    """Changelist form whose autocomplete fields reuse the row's select_related objects."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, field in self.fields.items():
+            widget = getattr(field.widget, 'widget', field.widget)
+            if isinstance(widget, LoadedAutocompleteSelect) and self.instance._meta.get_field(name).is_cached(self.instance):
+                widget.loaded_choice = getattr(self.instance, name)
+
+
+def related_count(queryset, field='product'):
+    """Per-row count of related rows as a correlated subquery, so several counts never multiply joins."""
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(counts), 0)
+
+
+class CatalogModelAdmin(ModelAdmin):
+    """Changelists that stay fast on large tables: estimated totals and query-free autocomplete cells."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_filter_submit = True
+    # Columns the changelist does not show and so does not load; the change form still does
+    list_defer = []
+
+    def get_changelist(self, request, **kwargs):
+        changelist = super().get_changelist(request, **kwargs)
+        if not self.list_defer:
+            return changelist
+        deferred = self.list_defer
+
+        class DeferredChangeList(changelist):
+            def get_queryset(self, request):
+                return super().get_queryset(request).defer(*deferred)
+        return DeferredChangeList
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if 'widget' not in kwargs and db_field.name in self.get_autocomplete_fields(request):
+            kwargs['widget'] = LoadedAutocompleteSelect(db_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def get_changelist_form(self, request, **kwargs):
+        kwargs.setdefault('form', LoadedChoicesForm)
+        return super().get_changelist_form(request, **kwargs)
+
 # Register your models here.
-class CategoryAdmin(ModelAdmin):
+class CategoryAdmin(CatalogModelAdmin):
     show_change_link = True
-    list_display = ['id', 'parent', 'title', 'keyword', 'description', 'image_tag', 'status', 'created_date', 'updated_date']
+    list_display = ['id', 'parent', 'title', 'keyword', 'description', 'image_tag', 'product_count', 'status', 'created_date', 'updated_date']
     list_editable = ['parent',  'status']
     search_fields = ['title', 'keyword', 'description']
-    list_filter = ['parent', 'status']
+    list_filter = [('parent', AutocompleteSelectFilter), 'status']
     readonly_fields = ['id', 'created_date', 'updated_date']
+    list_select_related = ['parent']
+    autocomplete_fields = ['parent']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(product_count=related_count(Product.objects.all(), 'category'))
+
+    @admin.display(description='Products', ordering='product_count')
+    def product_count(self, obj):
+        return obj.product_count
 admin.site.register(Category, CategoryAdmin)
 
-class BrandAdmin(ModelAdmin):
+class BrandAdmin(CatalogModelAdmin):
     show_change_link = True
-    list_display = ['id', 'title', 'keyword', 'description', 'image_tag', 'status', 'created_date', 'updated_date']
+    list_display = ['id', 'title', 'keyword', 'description', 'image_tag', 'product_count', 'status', 'created_date', 'updated_date']
     search_fields = ['title', 'keyword', 'description']
-    list_filter = ['status', 'created_date', 'updated_date', 'title']
+    list_filter = ['status', 'created_date', 'updated_date']
     readonly_fields = ['id', 'image_tag', 'created_date', 'updated_date']
     list_editable = ['status']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(product_count=related_count(Product.objects.all(), 'brand'))
+
+    @admin.display(description='Products', ordering='product_count')
+    def product_count(self, obj):
+        return obj.product_count
 admin.site.register(Brand, BrandAdmin)
 
 @admin_thumbnails.thumbnail('image')
@@ -37,34 +156,82 @@ class ProductVariantsInline(admin.TabularInline):
     extra = 1
     show_change_link = True
 
-class VariantsAdmin(ModelAdmin):
-    list_display = ['id', 'product', 'title', 'color', 'size', 'image_id', 'image_tag', 'quantity', 'price', 'created_date', 'updated_date']
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_images()
+
+class VariantsAdmin(CatalogModelAdmin):
+    list_display = ['id', 'product', 'title', 'color', 'size', 'image_id', 'image_tag', 'quantity', 'reserved', 'price', 'created_date', 'updated_date']
     list_editable = ['title', 'color', 'size', 'image_id', 'quantity', 'price']
     search_fields = ['title']
-    list_filter = ['product', 'color', 'size', 'image_id', 'created_date', 'updated_date']
+    list_filter = [('product', AutocompleteSelectFilter), ('color', AutocompleteSelectFilter), ('size', AutocompleteSelectFilter), 'created_date', 'updated_date']
     readonly_fields = ['id', 'image_tag', 'created_date', 'updated_date']
+    list_select_related = ['product', 'color', 'size']
+    autocomplete_fields = ['product', 'color', 'size']
+
+    def get_queryset(self, request):
+        # image_tag of every row is resolved with one Images query
+        return super().get_queryset(request).with_images()
 
 admin.site.register(Variants, VariantsAdmin)
 
-class ImagesAdmin(ModelAdmin):
+class ImagesAdmin(CatalogModelAdmin):
     list_display = ['id', 'product', 'image_tag', 'created_date', 'updated_date']
-    list_filter = ['product', 'created_date', 'updated_date']
+    list_filter = [('product', AutocompleteSelectFilter), 'created_date', 'updated_date']
     readonly_fields = ['id', 'product', 'image_tag', 'created_date', 'updated_date']
+    list_select_related = ['product']
 
 admin.site.register(Images, ImagesAdmin)
 
-class ProductAdmin(ModelAdmin):
-    inlines = [ProductImagesInline, ProductVariantsInline]  # ImagesAdmin -> ProductImagesInline
-    list_display = ['id', 'category', 'brand', 'variant', 'title', 'model', 'available_in_stock_msg', 'in_stock_max', 
-                    'price', 'old_price', 'discount_title', 'discount', 'offers_deadline', 'keyword', 'description', 'addition_des', 
-                    'return_policy', 'is_timeline', 'deals', 'new_collection', 'latest_collection', 'pick_collection', 'girls_collection', 'men_collection', 'pc_or_laps', 'in_stock', 'status', 'created_date', 'updated_date']
-    list_editable = ['category', 'brand', 'variant', 'is_timeline', 'deals', 'new_collection', 'latest_collection', 'pick_collection', 'girls_collection', 'men_collection', 'pc_or_laps', 'in_stock', 'status']
+class ProductCollectionsInline(admin.TabularInline):
+    model = CollectionMembership
+    fields = ['collection', 'position', 'publish_start', 'publish_end']
+    extra = 0
+
+class ProductAdmin(CatalogModelAdmin):
+    inlines = [ProductImagesInline, ProductVariantsInline, ProductCollectionsInline]  # ImagesAdmin -> ProductImagesInline
+    list_display = ['id', 'category', 'brand', 'variant', 'title', 'model', 'available_in_stock_msg', 'in_stock_max', 'reserved',
+                    'price', 'old_price', 'discount_title', 'discount', 'offers_start', 'offers_deadline', 'variant_count', 'image_count',
+                    'is_timeline', 'deals', 'deal_active', 'in_stock', 'status', 'created_date', 'updated_date']
+    list_editable = ['category', 'brand', 'variant', 'is_timeline', 'deals', 'in_stock', 'status']
     search_fields = ['title', 'keyword', 'description']
-    list_filter = ['category', 'brand', 'variant', 'status', 'created_date', 'updated_date']
+    list_filter = [('category', AutocompleteSelectFilter), ('brand', AutocompleteSelectFilter), 'variant', 'status', 'created_date', 'updated_date']
     readonly_fields = ['id', 'created_date', 'updated_date']
+    list_select_related = ['category', 'brand']
+    autocomplete_fields = ['category', 'brand']
+    list_defer = ['keyword', 'description', 'addition_des', 'return_policy']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            variant_count=related_count(Variants.objects.all()),
+            image_count=related_count(Images.objects.all()),
+        )
+
+    @admin.display(description='Variants', ordering='variant_count')
+    def variant_count(self, obj):
+        return obj.variant_count
+
+    @admin.display(description='Images', ordering='image_count')
+    def image_count(self, obj):
+        return obj.image_count
 
 admin.site.register(Product, ProductAdmin)
 
+class CollectionMembershipInline(admin.TabularInline):
+    model = CollectionMembership
+    fields = ['product', 'position', 'publish_start', 'publish_end']
+    autocomplete_fields = ['product']
+    extra = 1
+
+class CollectionAdmin(ModelAdmin):
+    inlines = [CollectionMembershipInline]
+    list_display = ['id', 'title', 'slug', 'position', 'limit', 'show_on_home', 'status', 'created_date', 'updated_date']
+    list_editable = ['position', 'limit', 'show_on_home', 'status']
+    search_fields = ['title', 'slug']
+    list_filter = ['show_on_home', 'status']
+    prepopulated_fields = {'slug': ['title']}
+    readonly_fields = ['id', 'created_date', 'updated_date']
+admin.site.register(Collection, CollectionAdmin)
+
 class ColorAdmin(ModelAdmin):
     list_display = ['id', 'title','code','color_tag']
     list_editable = ['code']
@@ -81,31 +248,40 @@ class SizeAdmin(ModelAdmin):
     readonly_fields = ['id']
 admin.site.register(Size,SizeAdmin)
 
-class SliderAdmin(ModelAdmin):
+class SliderAdmin(CatalogModelAdmin):
     list_display = ['id', 'product', 'title', 'image_tag', 'created_date', 'updated_date']
     list_editable = ['title']
     search_fields = ['title']
-    list_filter = ['product', 'created_date', 'updated_date']
+    list_filter = [('product', AutocompleteSelectFilter), 'created_date', 'updated_date']
+    list_select_related = ['product']
+    autocomplete_fields = ['product']
     readonly_fields = ['id', 'image_tag', 'created_date', 'updated_date']
 admin.site.register(Slider, SliderAdmin)
 
-class BannerAdmin(ModelAdmin):
+class BannerAdmin(CatalogModelAdmin):
     list_display = ['id', 'product', 'title', 'image_tag', 'side_deals', 'status', 'created_date', 'updated_date']
     list_editable = ['side_deals', 'status']
     search_fields = ['title']
-    list_filter = ['product', 'side_deals', 'status', 'created_date', 'updated_date']
+    list_filter = [('product', AutocompleteSelectFilter), 'side_deals', 'status', 'created_date', 'updated_date']
+    list_select_related = ['product']
+    autocomplete_fields = ['product']
     readonly_fields = ['id', 'image_tag', 'created_date', 'updated_date']
 admin.site.register(Banner, BannerAdmin)
 
-class ProductFutureAdmin(ModelAdmin):
+class ProductFutureAdmin(CatalogModelAdmin):
     list_display = ['id', 'product', 'title', 'hard_disk', 'cpu', 'ram', 'os', 'special_feature',  'graphic',  'status', 'created_date', 'updated_date']
     readonly_fields = ['id', 'created_date', 'updated_date']
     search_fields = ['title', 'hard_disk', 'cpu', 'ram', 'os', 'special_feature',  'graphic']
-    list_filter = ['product', 'status', 'created_date', 'updated_date']
+    list_filter = [('product', AutocompleteSelectFilter), 'status', 'created_date', 'updated_date']
+    list_select_related = ['product']
+    autocomplete_fields = ['product']
 admin.site.register(ProductFuture, ProductFutureAdmin)
 
-class ReviewAdmin(ModelAdmin):
+class ReviewAdmin(CatalogModelAdmin):
     list_display = ['id', 'product', 'user', 'subject','comment', 'rate', 'status','created_date', 'updated_date']
     list_editable = ['status']
+    list_filter = [('product', AutocompleteSelectFilter), 'rate', 'status']
     readonly_fields = ['id', 'created_date', 'updated_date']
+    list_select_related = ['product', 'user']
+    autocomplete_fields = ['product']
 admin.site.register(Review, ReviewAdmin)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import hashlib
+from django.core.cache import cache
+from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.routers import DefaultRouter
+from stories.caching import FRAGMENT_TIMEOUT, get_versions
+from stories.models import Category, Brand, Product, Variants, Review
+from stories.serializers import CategorySerializer, BrandSerializer, ProductSerializer, VariantSerializer, ReviewSerializer
+
+# Resource -> cache versions its responses are built from. catalog and variant-options are
+# bumped by catalog writes and imports, the api: ones by the signals of the rows nested in them,
+# and api alone drops every cached response without touching the rest of the site.
+API_VERSIONS = {
+    'products': ('api', 'catalog', 'deals', 'variant-options', 'api:products'),
+    'variants': ('api', 'variant-options', 'api:variants'),
+    'categories': ('api', 'catalog'),
+    'brands': ('api', 'catalog'),
+    'reviews': ('api', 'api:reviews'),
+}
+
+
+class IdCursorPagination(CursorPagination):
+    """Keyset pages on the primary key: constant cost at any depth and no COUNT(*)."""
+    ordering = 'id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class CatalogViewSet(viewsets.ReadOnlyModelViewSet):
+    """Read-only resource with ?fields= sparse fieldsets, planned querysets and cached responses."""
+    pagination_class = IdCursorPagination
+    # Query parameter -> model lookup used to filter the list
+    filters = {}
+
+    def requested_fields(self):
+        names = self.serializer_class.field_names()
+        requested = self.request.query_params.get('fields')
+        if not requested:
+            return names
+        fields = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = sorted(set(fields) - set(names))
+        if unknown:
+            raise ValidationError({'fields': f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(names)}."})
+        return fields
+
+    def get_queryset(self):
+        queryset = self.queryset.all()
+        for param, lookup in self.filters.items():
+            value = self.request.query_params.get(param)
+            if value:
+                try:
+                    queryset = queryset.filter(**{lookup: int(value)})
+                except ValueError:
+                    raise ValidationError({param: 'A valid integer is required.'})
+        return self.serializer_class.plan_queryset(queryset, self.requested_fields())
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def cached_response(self, build):
+        """Serve the serialized data of this exact request from the cache, built by build() on a miss."""
+        versions = get_versions(*API_VERSIONS[self.basename])
+        # The whole URL: pagination links (and media URLs) in the data are absolute to the scheme and host
+        path = hashlib.md5(self.request.build_absolute_uri().encode(), usedforsecurity=False).hexdigest()
+        key = f"api:{self.basename}:{':'.join(str(versions[name]) for name in API_VERSIONS[self.basename])}:{path}"
+        data = cache.get(key)
+        if data is None:
+            response = build()
+            if response.status_code != 200:
+                return response
+            data = response.data
+            cache.set(key, data, FRAGMENT_TIMEOUT)
+        return Response(data)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(lambda: super(CatalogViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(lambda: super(CatalogViewSet, self).retrieve(request, *args, **kwargs))
+
+
+class ProductViewSet(CatalogViewSet):
+    queryset = Product.objects.filter(status=True)
+    serializer_class = ProductSerializer
+    filters = {'category': 'category_id', 'brand': 'brand_id'}
+
+
+class VariantViewSet(CatalogViewSet):
+    queryset = Variants.objects.filter(product__status=True)
+    serializer_class = VariantSerializer
+    filters = {'product': 'product_id'}
+
+
+class CategoryViewSet(CatalogViewSet):
+    queryset = Category.objects.filter(status=True)
+    serializer_class = CategorySerializer
+    filters = {'parent': 'parent_id'}
+
+
+class BrandViewSet(CatalogViewSet):
+    queryset = Brand.objects.filter(status=True)
+    serializer_class = BrandSerializer
+
+
+class ReviewViewSet(CatalogViewSet):
+    queryset = Review.objects.filter(status=True)
+    serializer_class = ReviewSerializer
+    filters = {'product': 'product_id'}
+
+
+router = DefaultRouter()
+router.register('products', ProductViewSet, basename='products')
+router.register('variants', VariantViewSet, basename='variants')
+router.register('categories', CategoryViewSet, basename='categories')
+router.register('brands', BrandViewSet, basename='brands')
+router.register('reviews', ReviewViewSet, basename='reviews')
+
+urlpatterns = router.urls
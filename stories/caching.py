@@ -0,0 +1,173 @@
+import time
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min, Max, Count, Q
+from django.utils import timezone
+from stories.models import Category, Brand, Product, Review, CollectionMembership
+from stories.facets import category_product_counts
+
+# Cached fragments never need to expire on their own: saving a model bumps the
+# version they are keyed on, so this only bounds how long orphans linger.
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+HOME_SECTIONS = ('sliders', 'banners', 'side_deals', 'deals', 'collections')
+
+RATINGS = (1, 2, 3, 4, 5)
+
+
+def _version_key(name):
+    return f'version:{name}'
+
+
+def _new_version():
+    # Time based, so a version lost to cache eviction never restarts at an old value
+    return int(time.time() * 1000)
+
+
+def get_versions(*names):
+    """Return {name: version} for every name, reading all of them in one cache round-trip."""
+    keys = {_version_key(name): name for name in names}
+    found = cache.get_many(list(keys))
+    versions = {}
+    for key, name in keys.items():
+        if key not in found:
+            cache.add(key, _new_version(), None)
+            found[key] = cache.get(key)
+        versions[name] = found[key]
+    return versions
+
+
+def bump_versions(*names):
+    """Invalidate everything cached under the given names once the current transaction commits."""
+    names = set(names)
+
+    def bump():
+        for name in names:
+            try:
+                cache.incr(_version_key(name))
+            except ValueError:
+                cache.set(_version_key(name), _new_version(), None)
+
+    if names:
+        transaction.on_commit(bump)
+
+
+def _next_deadline(key, next_transition):
+    """Datetime returned by next_transition(), cached under key until it passes; False when there is none."""
+    deadline = cache.get(key)
+    if deadline is None:
+        deadline = next_transition() or False
+        timeout = FRAGMENT_TIMEOUT if not deadline else (deadline - timezone.now()).total_seconds()
+        cache.set(key, deadline, max(int(timeout), 1))
+    return deadline
+
+
+def _timeout_until(key, next_transition):
+    """Seconds until the datetime returned by next_transition() (cached under key), at most FRAGMENT_TIMEOUT."""
+    deadline = _next_deadline(key, next_transition)
+    if not deadline:
+        return FRAGMENT_TIMEOUT
+    return max(min(int((deadline - timezone.now()).total_seconds()), FRAGMENT_TIMEOUT), 1)
+
+
+def _next_collections_transition():
+    now = timezone.now()
+    bounds = CollectionMembership.objects.filter(collection__show_on_home=True).aggregate(
+        start=Min('publish_start', filter=Q(publish_start__gt=now)),
+        end=Min('publish_end', filter=Q(publish_end__gt=now)),
+    )
+    return min((bound for bound in bounds.values() if bound), default=None)
+
+
+def collections_next_transition(version):
+    """When the next publish window of a home rail opens or closes; False when none is scheduled."""
+    return _next_deadline(f'collections:next-transition:{version}', _next_collections_transition)
+
+
+def collections_cache_timeout(version):
+    """Seconds until the next publish window of a home rail opens or closes."""
+    return _timeout_until(f'collections:next-transition:{version}', _next_collections_transition)
+
+
+def get_variant_matrix(product):
+    """Cached Product.build_variant_matrix(), rebuilt when the product's variants or images change."""
+    versions = get_versions(f'variants:{product.id}', 'variant-options')
+    key = f"variant-matrix:{product.id}:{versions[f'variants:{product.id}']}:{versions['variant-options']}"
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = product.build_variant_matrix()
+        cache.set(key, matrix, FRAGMENT_TIMEOUT)
+    return matrix
+
+
+def get_catalog_filters():
+    """Category tree, brands, product count and price bounds, cached until a catalog write."""
+    key = f"catalog-filters:{get_versions('catalog')['catalog']}"
+    filters = cache.get(key)
+    if filters is None:
+        bounds = Product.objects.aggregate(total=Count('id'), price__min=Min('price'), price__max=Max('price'))
+        # The whole active tree comes from one query, annotated with cached subtree product counts
+        categories = Category.objects.filter(status=True).tree()
+        product_counts = category_product_counts()
+        pending = list(categories)
+        while pending:
+            node = pending.pop()
+            node.product_count = product_counts.get(node.id, 0)
+            pending.extend(node.tree_children)
+        filters = {
+            'categories': categories[::-1],
+            'cats': list(Category.objects.filter(status=True).order_by('-id')),
+            'brands': list(Brand.objects.filter(status=True).order_by('-id')),
+            'total_data': bounds['total'],
+            'minPrice': {'price__min': bounds['price__min']},
+            'maxPrice': {'price__max': bounds['price__max']},
+        }
+        cache.set(key, filters, FRAGMENT_TIMEOUT)
+    return filters
+
+
+def _histogram_keys(product_id):
+    return {f'rating-histogram:{product_id}:{rate}': rate for rate in RATINGS}
+
+
+def get_rating_summary(product_id):
+    """Star histogram, count and average of a product's active reviews.
+
+    The histogram is one cache counter per star, built with a single GROUP BY on a miss
+    and then kept current by shift_rating_histogram() instead of being recounted.
+    """
+    keys = _histogram_keys(product_id)
+    found = cache.get_many(list(keys))
+    if len(found) == len(keys):
+        histogram = {rate: found[key] for key, rate in keys.items()}
+    else:
+        counts = dict(Review.objects.filter(product_id=product_id, status=True).values_list('rate').annotate(total=Count('id')).order_by())
+        histogram = {rate: counts.get(rate, 0) for rate in RATINGS}
+        cache.set_many({key: histogram[rate] for key, rate in keys.items()}, FRAGMENT_TIMEOUT)
+    count = sum(histogram.values())
+    return {
+        'histogram': {str(rate): histogram[rate] for rate in reversed(RATINGS)},
+        'count': count,
+        'average': round(sum(rate * total for rate, total in histogram.items()) / count, 2) if count else 0,
+    }
+
+
+def shift_rating_histogram(product_id, rate, delta):
+    """Move one review in (delta=1) or out (delta=-1) of a cached histogram once the transaction commits."""
+    key = f'rating-histogram:{product_id}:{rate}'
+
+    def shift():
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Not cached (or partly evicted): drop the rest so the next read recounts it whole
+            cache.delete_many(list(_histogram_keys(product_id)))
+
+    transaction.on_commit(shift)
+
+
+def forget_rating_summaries(*product_ids):
+    """Drop the cached histograms of products once the transaction commits, so the next read recounts them."""
+    keys = [key for product_id in product_ids for key in _histogram_keys(product_id)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,426 @@
+"""Streaming bulk import and export of the catalog as JSON lines or CSV.
+
+Every record is a flat dict with a "model" key naming its record type. Related
+rows are referenced by their unique titles (a variant names its product, color
+and size), so files can move between databases. JSON lines files mix record
+types; a CSV file holds one record type, named by the file (products.csv).
+"""
+import csv
+import hashlib
+import json
+import os
+import urllib.request
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.utils import timezone
+from stories.caching import HOME_SECTIONS, bump_versions
+from stories.deals import sync_deals
+from stories.facets import sync_product_facets
+from stories.models import Category, Brand, Color, Size, Product, Images, Variants, ProductFuture
+from stories.renditions import get_worker_pool, pregenerate
+from stories.search import index_queryset
+
+# fields: plain model fields; refs: record field -> (model attname, referenced record type);
+# key: model attnames identifying an existing row; uploads: storage prefix of imported image files
+RecordType = namedtuple('RecordType', 'model fields refs key uploads', defaults=((), ('title',), ''))
+
+RECORD_TYPES = {
+    'category': RecordType(Category, ('title', 'keyword', 'description', 'image', 'status'), {'parent': ('parent_id', 'category')}, uploads='categories'),
+    'brand': RecordType(Brand, ('title', 'keyword', 'description', 'image', 'status'), {}, uploads='brands'),
+    'color': RecordType(Color, ('title', 'code'), {}),
+    'size': RecordType(Size, ('title', 'code'), {}),
+    'product': RecordType(Product, (
+        'title', 'variant', 'model', 'available_in_stock_msg', 'in_stock_max', 'price', 'old_price',
+        'discount_title', 'discount', 'offers_start', 'offers_deadline', 'keyword', 'description',
+        'addition_des', 'return_policy', 'is_timeline', 'deals', 'in_stock', 'status',
+    ), {'category': ('category_id', 'category'), 'brand': ('brand_id', 'brand')}),
+    'image': RecordType(Images, ('image',), {'product': ('product_id', 'product')}, key=('product_id', 'image'), uploads='product_images'),
+    'variant': RecordType(Variants, ('title', 'quantity', 'price'), {
+        'product': ('product_id', 'product'), 'color': ('color_id', 'color'), 'size': ('size_id', 'size'), 'image': ('image_id', 'image'),
+    }, key=('product_id', 'color_id', 'size_id')),
+    'feature': RecordType(ProductFuture, ('title', 'hard_disk', 'cpu', 'ram', 'os', 'special_feature', 'graphic', 'status'), {'product': ('product_id', 'product')}),
+}
+
+# Parents before children, so references always resolve within a batch
+IMPORT_ORDER = ('category', 'brand', 'color', 'size', 'product', 'image', 'variant', 'feature')
+
+# Accepted CSV file stems besides the record type itself
+CSV_NAMES = {
+    'categories': 'category', 'brands': 'brand', 'colors': 'color', 'sizes': 'size', 'products': 'product',
+    'images': 'image', 'variants': 'variant', 'features': 'feature', 'productfuture': 'feature',
+}
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def record_type_of(path):
+    """Record type of a CSV file from its name, e.g. products.csv -> product."""
+    stem = Path(path).stem.lower()
+    name = CSV_NAMES.get(stem, stem)
+    if name not in RECORD_TYPES:
+        raise CatalogError(f'Cannot tell the record type of {path}; name it after one of {", ".join(RECORD_TYPES)}.')
+    return name
+
+
+def read_records(path, model=None):
+    """Yield (line number, record) from a .jsonl or .csv file, one line at a time."""
+    with open(path, newline='', encoding='utf-8') as source:
+        if str(path).endswith('.csv'):
+            model = model or record_type_of(path)
+            for line, row in enumerate(csv.DictReader(source), start=2):
+                yield line, {'model': model, **row}
+        else:
+            for line, text in enumerate(source, start=1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except json.JSONDecodeError as error:
+                        yield line, {'model': None, 'error': str(error)}
+
+
+def _to_python(field, value):
+    if value == '' or value is None:
+        if field.null:
+            return None
+        return field.get_default() if not isinstance(field, models.CharField) else ''
+    if isinstance(field, models.FileField):
+        return value
+    return field.to_python(value)
+
+
+class CatalogImporter:
+    """Buffers records and writes them in batches with bulk upserts.
+
+    Categories, brands, colors and sizes are few and kept in title -> id maps for
+    the whole run. Products are looked up per batch, so memory stays flat however
+    large the file is. Image files are fetched and stored on the rendition worker
+    pool, and their renditions are pre-generated there too.
+    """
+
+    def __init__(self, batch_size=1000, images_dir='.', renditions=True):
+        self.batch_size = batch_size
+        self.images_dir = images_dir
+        self.renditions = renditions
+        self.pool = get_worker_pool()
+        self.buffer = {name: [] for name in IMPORT_ORDER}
+        self.buffered = 0
+        # Source value -> stored name of the images of the current batch, for the variants referring to them
+        self.image_names = {}
+        self.maps = {name: dict(RECORD_TYPES[name].model.objects.values_list('title', 'id')) for name in ('category', 'brand', 'color', 'size')}
+        self.created = dict.fromkeys(IMPORT_ORDER, 0)
+        self.updated = dict.fromkeys(IMPORT_ORDER, 0)
+        self.errors = []
+
+    def add(self, line, record):
+        name = record.get('model')
+        if name not in RECORD_TYPES:
+            self.errors.append((line, record.get('error') or f'unknown record type {name!r}'))
+            return
+        self.buffer[name].append((line, record))
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def run(self, records):
+        for line, record in records:
+            self.add(line, record)
+        self.flush()
+        return self.finish()
+
+    # Reference resolution
+
+    def _product_ids(self, titles):
+        titles = {title for title in titles if title}
+        return dict(Product.objects.filter(title__in=titles).values_list('title', 'id')) if titles else {}
+
+    def _resolve(self, name, pending):
+        """(line, record, values) with references replaced by ids; bad records become errors."""
+        spec = RECORD_TYPES[name]
+        products = self._product_ids(record.get('product') for _, record in pending) if 'product' in spec.refs else {}
+        image_refs = {}
+        if name == 'variant':
+            with_images = {products.get(record.get('product')) for _, record in pending if record.get('image')} - {None}
+            image_refs = {
+                (product_id, image): image_id
+                for image_id, product_id, image in Images.objects.filter(product_id__in=with_images).values_list('id', 'product_id', 'image')
+            }
+        resolved = []
+        for line, record in pending:
+            try:
+                values = {}
+                for field_name in spec.fields:
+                    if field_name in record:
+                        values[field_name] = _to_python(spec.model._meta.get_field(field_name), record[field_name])
+                for ref, (attname, target) in spec.refs.items():
+                    title = record.get(ref)
+                    if ref not in record or (name == 'category' and ref == 'parent'):
+                        continue
+                    if not title:
+                        values[attname] = 0 if target == 'image' else None
+                        continue
+                    if target == 'product':
+                        values[attname] = products.get(title)
+                    elif target == 'image':
+                        values[attname] = image_refs.get((values.get('product_id'), self.image_names.get(title, title)))
+                    else:
+                        values[attname] = self.maps[target].get(title)
+                    if values[attname] is None:
+                        raise CatalogError(f'{ref} {title!r} does not exist')
+                if 'title' in spec.key and not values.get('title'):
+                    raise CatalogError('title is required')
+                resolved.append((line, record, values))
+            except (CatalogError, ValueError, TypeError) as error:
+                self.errors.append((line, f'{name}: {error}'))
+        return resolved
+
+    # Image files
+
+    def store_image(self, value, prefix):
+        """Storage name of an image given as a stored name, a URL or a path under images_dir."""
+        if not value or default_storage.exists(value):
+            return value
+        if value.startswith(('http://', 'https://')):
+            with urllib.request.urlopen(value, timeout=30) as response:
+                content = response.read()
+        else:
+            with open(os.path.join(self.images_dir, value), 'rb') as source:
+                content = source.read()
+        # Content addressed, so importing the same file twice stores it once
+        digest = hashlib.sha256(content).hexdigest()
+        name = f'{prefix}/imported/{digest[:2]}/{digest}{Path(value).suffix.lower()}'
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(content))
+        return name
+
+    def _store_images(self, name, resolved):
+        spec = RECORD_TYPES[name]
+        if not spec.uploads:
+            return resolved, []
+        jobs = [(index, values['image']) for index, (_, _, values) in enumerate(resolved) if values.get('image')]
+
+        def store(job):
+            try:
+                return self.store_image(job[1], spec.uploads), None
+            except (OSError, ValueError) as error:
+                return None, error
+
+        failed = set()
+        stored = []
+        for (index, _), (image, error) in zip(jobs, self.pool.map(store, jobs)):
+            if error:
+                failed.add(index)
+                self.errors.append((resolved[index][0], f'{name}: image {resolved[index][2]["image"]!r}: {error}'))
+            else:
+                if name == 'image':
+                    self.image_names[resolved[index][2]['image']] = image
+                resolved[index][2]['image'] = image
+                stored.append(image)
+        return [item for index, item in enumerate(resolved) if index not in failed], stored
+
+    # Writing
+
+    def _upsert(self, name, resolved):
+        """bulk_update the rows whose key exists and bulk_create the others; returns the saved objects."""
+        spec = RECORD_TYPES[name]
+        model = spec.model
+        # The last record wins when a key repeats within the batch
+        by_key = {tuple(values.get(field) for field in spec.key): values for _, _, values in resolved}
+        if spec.key == ('title',):
+            existing = dict(model.objects.filter(title__in=[key[0] for key in by_key]).values_list('title', 'id'))
+            existing = {(title,): pk for title, pk in existing.items()}
+        else:
+            lookup = {f'{spec.key[0]}__in': {key[0] for key in by_key}}
+            existing = {}
+            for row in model.objects.filter(**lookup).values_list('id', *spec.key).order_by('id'):
+                existing.setdefault(tuple(row[1:]), row[0])
+
+        now = timezone.now()
+        new, groups = [], {}
+        for key, values in by_key.items():
+            obj = model(**values)
+            if key in existing:
+                obj.pk = existing[key]
+                obj.updated_date = now
+                # Only the fields a record carries are overwritten
+                groups.setdefault(tuple(sorted(set(values) - set(spec.key) | {'updated_date'})), []).append(obj)
+            else:
+                if model is Product:
+                    obj.deal_active = obj.is_deal_live(now)
+                new.append(obj)
+        model.objects.bulk_create(new, batch_size=500)
+        for fields, objs in groups.items():
+            model.objects.bulk_update(objs, list(fields), batch_size=500)
+        self.created[name] += len(new)
+        self.updated[name] += sum(len(objs) for objs in groups.values())
+
+        if model is not Variants and model is not Images and any(obj.pk is None for obj in new):
+            # bulk_create does not return ids on MySQL
+            ids = dict(model.objects.filter(title__in=[obj.title for obj in new]).values_list('title', 'id'))
+            for obj in new:
+                obj.pk = obj.pk or ids.get(obj.title)
+        return new + [obj for objs in groups.values() for obj in objs]
+
+    def _link_category_parents(self, resolved, saved):
+        ids = {obj.title: obj.pk for obj in saved}
+        self.maps['category'].update(ids)
+        linked = []
+        for line, record, values in resolved:
+            if 'parent' not in record:
+                continue
+            category_id = ids[values['title']]
+            parent_id = self.maps['category'].get(record['parent']) if record['parent'] else None
+            if record['parent'] and parent_id in (None, category_id):
+                self.errors.append((line, f"category: parent {record['parent']!r} does not exist"))
+                continue
+            linked.append(Category(pk=category_id, parent_id=parent_id))
+        Category.objects.bulk_update(linked, ['parent'], batch_size=500)
+        # Paths are needed right away by the facets of this batch's products
+        Category.objects.rebuild_paths()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        product_ids, variant_product_ids, variant_ids, images = set(), set(), set(), []
+        self.image_names = {}
+        with transaction.atomic():
+            for name in IMPORT_ORDER:
+                pending, self.buffer[name] = self.buffer[name], []
+                if not pending:
+                    continue
+                resolved, stored = self._store_images(name, self._resolve(name, pending))
+                images += stored
+                saved = self._upsert(name, resolved)
+                if name == 'category':
+                    self._link_category_parents(resolved, saved)
+                elif name in self.maps:
+                    self.maps[name].update((obj.title, obj.pk) for obj in saved)
+                elif name == 'product':
+                    product_ids.update(obj.pk for obj in saved)
+                elif name in ('variant', 'image'):
+                    variant_product_ids.update(obj.product_id for obj in saved)
+                    if name == 'variant':
+                        variant_ids.update((obj.product_id, obj.pk) for obj in saved if obj.pk)
+        self.buffered = 0
+
+        # Bulk writes send no signals: bring the derived data of this batch up to date
+        touched = product_ids | variant_product_ids
+        if touched:
+            index_queryset(Product.objects.filter(id__in=touched))
+            sync_product_facets(touched)
+            bump_versions(*(f'variants:{product_id}' for product_id in variant_product_ids))
+            self._refresh_carts(touched, variant_ids)
+        if images and self.renditions:
+            pregenerate(images, pool=self.pool)
+
+    def _refresh_carts(self, product_ids, variant_options):
+        """Reprice the open carts holding imported products and forget the cached availability of their stock."""
+        from cart.models import Cart, CartItem
+        from cart.reservations import forget_availability
+        holding = CartItem.objects.filter(product_id__in=product_ids).values('cart_id')
+        Cart.rebuild_totals(Cart.objects.filter(paid=False, id__in=holding))
+        forget_availability(*((product_id, None) for product_id in product_ids), *variant_options)
+
+    def finish(self):
+        sync_deals()
+        bump_versions('catalog', 'variant-options', *HOME_SECTIONS)
+        return {'created': self.created, 'updated': self.updated, 'errors': self.errors}
+
+
+# Export
+
+def stream_rows(queryset, batch_size=2000):
+    """Rows of a values() queryset ordered by id, without holding the table in memory.
+
+    PostgreSQL streams from a server-side cursor; other backends buffer whole
+    result sets client side, so they are read in keyset batches on id instead.
+    """
+    if connection.vendor == 'postgresql':
+        yield from queryset.order_by('id').iterator(chunk_size=batch_size)
+        return
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def export_records(names=None, batch_size=2000):
+    """Yield the records of the given record types (all by default) in import order."""
+    for name in IMPORT_ORDER:
+        if names and name not in names:
+            continue
+        spec = RECORD_TYPES[name]
+        columns = {field: field for field in spec.fields}
+        columns.update({ref: f'{ref}__title' for ref, (attname, target) in spec.refs.items() if target != 'image'})
+        if name == 'variant':
+            columns['image'] = 'image_id'
+        queryset = spec.model.objects.values('id', *columns.values())
+        if name == 'category':
+            # Parents are exported before their children
+            queryset = queryset.order_by('depth', 'id')
+            rows = queryset.iterator(chunk_size=batch_size)
+        else:
+            rows = stream_rows(queryset, batch_size)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield from _export_batch(name, columns, batch)
+                batch = []
+        yield from _export_batch(name, columns, batch)
+
+
+def _export_batch(name, columns, rows):
+    image_names = {}
+    if name == 'variant':
+        image_names = dict(Images.objects.filter(id__in={row['image_id'] for row in rows if row['image_id']}).values_list('id', 'image'))
+    for row in rows:
+        record = {'model': name}
+        for field, column in columns.items():
+            record[field] = image_names.get(row[column], '') if field == 'image' and name == 'variant' else row[column]
+        yield record
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, Decimal)):
+        return value.isoformat() if isinstance(value, date) else str(value)
+    return value
+
+
+def write_jsonl(records, output):
+    count = 0
+    for record in records:
+        output.write(json.dumps(record, cls=DjangoJSONEncoder) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(records, directory):
+    """Write one <record type>.csv per record type into directory; returns the number of records."""
+    os.makedirs(directory, exist_ok=True)
+    files, writers, count = {}, {}, 0
+    try:
+        for record in records:
+            name = record.pop('model')
+            if name not in writers:
+                files[name] = open(os.path.join(directory, f'{name}.csv'), 'w', newline='', encoding='utf-8')
+                writers[name] = csv.DictWriter(files[name], fieldnames=list(record))
+                writers[name].writeheader()
+            writers[name].writerow({field: _csv_value(value) for field, value in record.items()})
+            count += 1
+    finally:
+        for output in files.values():
+            output.close()
+    return count
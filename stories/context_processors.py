@@ -1,20 +1,15 @@
-from django.db.models import Min, Max
-from stories.models import (
-    Category, Brand, Product, Images, Color, Size, Variants,
-)
+from django.utils.functional import SimpleLazyObject
+from stories.caching import get_catalog_filters
 
 def get_filters(request):
-    categories = Category.objects.filter(status=True, parent=None).order_by('-id')
-    cats = Category.objects.filter(status=True).order_by('-id')
-    brands = Brand.objects.filter(status=True).order_by('-id')
-    total_data = Product.objects.count()
-    minPrice = Product.objects.all().aggregate(Min('price'))
-    maxPrice = Product.objects.all().aggregate(Max('price'))
+    # Nothing is read until a template touches one of the values, and then it comes
+    # from the versioned catalog cache rather than six queries per render.
+    catalog = SimpleLazyObject(get_catalog_filters)
     return {
-        'categories': categories,
-        'cats': cats,
-        'brands': brands,
-        'total_data': total_data,
-        'minPrice': minPrice,
-        'maxPrice': maxPrice,
-    }
\ No newline at end of file
+        'categories': SimpleLazyObject(lambda: catalog['categories']),
+        'cats': SimpleLazyObject(lambda: catalog['cats']),
+        'brands': SimpleLazyObject(lambda: catalog['brands']),
+        'total_data': SimpleLazyObject(lambda: catalog['total_data']),
+        'minPrice': SimpleLazyObject(lambda: catalog['minPrice']),
+        'maxPrice': SimpleLazyObject(lambda: catalog['maxPrice']),
+    }
@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+from stories.caching import bump_versions
+from stories.facets import sync_product_facets
+from stories.models import Product
+
+
+def sync_deals(now=None):
+    """Start and end the deals due at now with two bulk UPDATEs; returns (activated_ids, expired_ids).
+
+    Bulk updates send no signals, so the deal facets and the deals fragments are
+    brought up to date here, only when something actually changed.
+    """
+    now = now or timezone.now()
+    live = Product.deal_live_q(now)
+    with transaction.atomic():
+        activated = list(Product.objects.select_for_update().filter(live, deal_active=False).values_list('id', flat=True))
+        expired = list(Product.objects.select_for_update().filter(deal_active=True).exclude(live).values_list('id', flat=True))
+        if activated:
+            Product.objects.filter(id__in=activated).update(deal_active=True)
+        if expired:
+            Product.objects.filter(id__in=expired).update(deal_active=False)
+        if activated or expired:
+            sync_product_facets(activated + expired)
+            bump_versions('deals')
+    return activated, expired
+
+
+def next_deal_transition(now=None):
+    """The next time a scheduled deal starts or a running one ends, or None."""
+    now = now or timezone.now()
+    bounds = Product.objects.filter(deals=True, is_timeline=True, status=True, offers_deadline__gt=now).aggregate(
+        start=Min('offers_start', filter=Q(offers_start__gt=now)),
+        end=Min('offers_deadline'),
+    )
+    return min((bound for bound in bounds.values() if bound), default=None)
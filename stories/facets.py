@@ -0,0 +1,140 @@
+from collections import Counter
+from functools import reduce
+from operator import or_
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from stories.managers import path_ids
+from stories.models import Category, Product, Variants, ProductFacet, FacetCount, CollectionMembership
+
+CATALOG_SCOPE = 0
+
+# Collection facet value of products with an active deal, next to the slugs of CollectionMembership
+DEALS_COLLECTION = 'deals'
+
+# Lower bounds of the price facet buckets; the last one is open ended
+PRICE_BUCKETS = (0, 50, 100, 250, 500, 1000)
+
+
+def price_bucket(price):
+    lower = max(bound for bound in PRICE_BUCKETS if bound <= price) if price >= 0 else 0
+    index = PRICE_BUCKETS.index(lower)
+    return f'{lower}-{PRICE_BUCKETS[index + 1]}' if index + 1 < len(PRICE_BUCKETS) else f'{lower}+'
+
+
+def category_scopes(category_path):
+    """The catalog scope plus the category and all of its ancestors, read from its materialized path."""
+    return [CATALOG_SCOPE] + path_ids(category_path or '')
+
+
+def compute_facets(product_ids):
+    """{product_id: {(scope, dimension, value)}} for the given products, from three queries."""
+    products = Product.objects.filter(id__in=product_ids).values('id', 'status', 'category_id', 'category__path', 'brand_id', 'price', 'deal_active')
+    variants = {}
+    for product_id, color_id, size_id in Variants.objects.filter(product_id__in=product_ids).values_list('product_id', 'color_id', 'size_id'):
+        variants.setdefault(product_id, []).append((color_id, size_id))
+    collections = {}
+    for product_id, slug in CollectionMembership.objects.filter(product_id__in=product_ids, collection__status=True).values_list('product_id', 'collection__slug'):
+        collections.setdefault(product_id, []).append(slug)
+
+    facets = {product_id: set() for product_id in product_ids}
+    for product in products:
+        # Inactive products are not listed, so they contribute no facets
+        if not product['status']:
+            continue
+        values = {('price', price_bucket(product['price']))}
+        if product['category_id']:
+            values.add(('category', str(product['category_id'])))
+        if product['brand_id']:
+            values.add(('brand', str(product['brand_id'])))
+        if product['deal_active']:
+            values.add(('collection', DEALS_COLLECTION))
+        values.update(('collection', slug) for slug in collections.get(product['id'], []))
+        for color_id, size_id in variants.get(product['id'], []):
+            if color_id:
+                values.add(('color', str(color_id)))
+            if size_id:
+                values.add(('size', str(size_id)))
+        facets[product['id']] = {
+            (scope, dimension, value)
+            for scope in category_scopes(product['category__path'])
+            for dimension, value in values
+        }
+    return facets
+
+
+def apply_count_deltas(deltas):
+    """Shift FacetCount rows by {(scope, dimension, value): delta} with one UPDATE per distinct delta."""
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    FacetCount.objects.bulk_create(
+        [FacetCount(scope=scope, dimension=dimension, value=value) for scope, dimension, value in deltas],
+        ignore_conflicts=True,
+        batch_size=1000,
+    )
+    by_delta = {}
+    for key, delta in deltas.items():
+        by_delta.setdefault(delta, []).append(key)
+    for delta, keys in by_delta.items():
+        for start in range(0, len(keys), 500):
+            match = reduce(or_, (Q(scope=scope, dimension=dimension, value=value) for scope, dimension, value in keys[start:start + 500]))
+            FacetCount.objects.filter(match).update(count=F('count') + delta)
+
+
+def sync_product_facets(product_ids):
+    """Bring the facet rows of the given products up to date and adjust the counts by the difference."""
+    product_ids = list({product_id for product_id in product_ids if product_id})
+    if not product_ids:
+        return
+    with transaction.atomic():
+        # Concurrent saves of one product (or of its variants) diff one after the other;
+        # otherwise both would insert the same new rows and one would hit the unique constraint
+        list(Product.objects.select_for_update().filter(id__in=product_ids).order_by('id').values_list('id', flat=True))
+        new = compute_facets(product_ids)
+        old = {}
+        for row in ProductFacet.objects.filter(product_id__in=product_ids).values_list('id', 'product_id', 'scope', 'dimension', 'value'):
+            old.setdefault(row[1], {})[row[2:]] = row[0]
+
+        deltas = Counter()
+        removed_ids = []
+        added = []
+        for product_id in product_ids:
+            current = old.get(product_id, {})
+            for key in current.keys() - new[product_id]:
+                removed_ids.append(current[key])
+                deltas[key] -= 1
+            for key in new[product_id] - current.keys():
+                added.append(ProductFacet(product_id=product_id, scope=key[0], dimension=key[1], value=key[2]))
+                deltas[key] += 1
+
+        ProductFacet.objects.filter(id__in=removed_ids).delete()
+        ProductFacet.objects.bulk_create(added, batch_size=1000)
+        apply_count_deltas(deltas)
+
+
+def remove_product_facets(product_ids):
+    """Take products out of the counts before they are deleted (their rows go with them by cascade)."""
+    deltas = Counter(ProductFacet.objects.filter(product_id__in=product_ids).values_list('scope', 'dimension', 'value'))
+    apply_count_deltas({key: -count for key, count in deltas.items()})
+
+
+def category_subtree_ids(category_id):
+    """The category id and the ids of all of its descendants."""
+    category = Category.objects.filter(pk=category_id).only('path').first()
+    if category is None:
+        return [category_id]
+    return list(Category.objects.descendants_of(category).values_list('id', flat=True))
+
+
+def category_product_counts():
+    """{category_id: active products in its subtree}, summed from the precomputed price facet counts."""
+    rows = FacetCount.objects.filter(dimension='price').exclude(scope=CATALOG_SCOPE).values('scope').annotate(total=Sum('count')).order_by()
+    return {row['scope']: row['total'] for row in rows}
+
+
+def facet_counts(scope=CATALOG_SCOPE):
+    """{dimension: {value: count}} of the precomputed counts within a category scope."""
+    counts = {}
+    for dimension, value, count in FacetCount.objects.filter(scope=scope, count__gt=0).values_list('dimension', 'value', 'count').order_by('dimension', 'value'):
+        counts.setdefault(dimension, {})[value] = count
+    return counts
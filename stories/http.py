@@ -0,0 +1,155 @@
+import hashlib
+from functools import wraps
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from stories.caching import FRAGMENT_TIMEOUT, HOME_SECTIONS, get_versions, collections_next_transition
+from stories.models import Product, Images, Variants, Review
+
+# Browsers reuse anonymous pages for max-age; shared caches (CDN, reverse proxy) for s-maxage.
+# Authenticated pages are private and revalidated on every request instead.
+PAGE_MAX_AGE = getattr(settings, 'STOREFRONT_MAX_AGE', 60)
+PAGE_SHARED_MAX_AGE = getattr(settings, 'STOREFRONT_SHARED_MAX_AGE', 300)
+
+# Whole anonymous pages are keyed on versions, so this only bounds how long orphans linger
+PAGE_CACHE_TIMEOUT = getattr(settings, 'STOREFRONT_PAGE_CACHE_TIMEOUT', FRAGMENT_TIMEOUT)
+
+
+def user_validator(request):
+    """Part of a page's validators that depends on who is asking: their cart badge and coupons."""
+    if not request.user.is_authenticated:
+        return 'anonymous'
+    versions = get_versions(f'cart:{request.user.id}', 'coupons')
+    return f"user:{request.user.id}:{versions[f'cart:{request.user.id}']}:{versions['coupons']}"
+
+
+def cache_policy(validators=None, max_age=PAGE_MAX_AGE, shared_max_age=PAGE_SHARED_MAX_AGE, per_user=True):
+    """View decorator applying the storefront HTTP caching policy.
+
+    validators(request, *args, **kwargs) returns (etag, last_modified) built from cache
+    versions and timestamps the catalog already maintains, or None when the page has
+    none (it is then rendered normally, e.g. to 404). A matching If-None-Match or
+    If-Modified-Since is answered with a 304 before the view runs.
+
+    per_user pages carry the user's cart in their chrome: anonymous responses are
+    public and vary on Cookie, authenticated ones are private and must revalidate.
+    Responses carrying a cookie or a CSRF token are private as well.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            etag = last_modified = None
+            # Pending flash messages are only shown by a full render
+            if validators is not None and not (per_user and len(get_messages(request))):
+                found = validators(request, *args, **kwargs)
+                if found is not None:
+                    etag, last_modified = found
+                    if per_user:
+                        etag = f'{etag}:{user_validator(request)}'
+                        # The cart in a private page can change without the catalog doing so
+                        if request.user.is_authenticated:
+                            last_modified = None
+                    etag = quote_etag(hashlib.md5(etag.encode(), usedforsecurity=False).hexdigest())
+                    last_modified = int(last_modified.timestamp()) if last_modified else None
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified) if etag else None
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if etag and response.status_code == 200:
+                    response.headers.setdefault('ETag', etag)
+                    if last_modified:
+                        response.headers.setdefault('Last-Modified', http_date(last_modified))
+            # A CSRF token or any other cookie ties the page to one browser
+            if (per_user and request.user.is_authenticated) or response.cookies or request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+                patch_cache_control(response, private=True, no_cache=True)
+            else:
+                patch_cache_control(response, public=True, max_age=max_age, s_maxage=shared_max_age)
+            if per_user:
+                patch_vary_headers(response, ['Cookie'])
+            return response
+        return wrapper
+    return decorator
+
+
+def anonymous_page_cache(page_key, timeout=PAGE_CACHE_TIMEOUT):
+    """View decorator caching whole responses for anonymous visitors.
+
+    page_key(request, *args, **kwargs) returns the versions the page is built from, read
+    from the cache only, so a hit is served (or answered with a 304 from the stored
+    validators) without touching the database. Responses that set a cookie, carry a
+    CSRF token or show flash messages are never stored; the cart badge and mini-cart
+    of anonymous pages are loaded from their own endpoint after the page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+            version = page_key(request, *args, **kwargs)
+            key = 'page:' + hashlib.md5(f'{request.get_full_path()}:{version}'.encode(), usedforsecurity=False).hexdigest()
+            response = cache.get(key)
+            if response is not None:
+                last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+                return get_conditional_response(request, etag=response.get('ETag'), last_modified=last_modified, response=response)
+            has_messages = len(get_messages(request))
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not (response.cookies or has_messages or request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+                cache.set(key, response, timeout)
+            return response
+        return wrapper
+    return decorator
+
+
+def home_validators(request):
+    versions = get_versions('catalog', *HOME_SECTIONS)
+    # Rails change on their own when a publish window opens or closes
+    transition = collections_next_transition(versions['collections'])
+    etag = ':'.join(str(versions[name]) for name in sorted(versions))
+    return f'home:{etag}:{transition.timestamp() if transition else 0}', None
+
+
+def _latest_update(model):
+    rows = model.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    return Subquery(rows.annotate(latest=Max('updated_date')).values('latest'))
+
+
+def product_validators(request, id):
+    """Latest change of the product, its images, its variants and its reviews, read in one query."""
+    row = Product.objects.filter(id=id).values('updated_date', 'rating_count', 'rating_sum').annotate(
+        images_updated=_latest_update(Images), variants_updated=_latest_update(Variants), reviews_updated=_latest_update(Review),
+    ).first()
+    if row is None:
+        return None
+    versions = get_versions('catalog', 'deals', 'related-products', 'variant-options', f'variants:{id}')
+    last_modified = max(row[field] for field in ('updated_date', 'images_updated', 'variants_updated', 'reviews_updated') if row[field])
+    # Deleted images, variants and reviews leave no timestamp behind: the versions and rating aggregates move instead
+    etag = ':'.join(str(versions[name]) for name in sorted(versions))
+    return f"product:{id}:{etag}:{row['rating_count']}:{row['rating_sum']}:{last_modified.timestamp()}", last_modified
+
+
+def home_page_key(request):
+    return home_validators(request)[0]
+
+
+def product_page_key(request, id):
+    names = ('catalog', 'deals', 'related-products', 'variant-options', f'variants:{id}', f'reviews:{id}')
+    versions = get_versions(*names)
+    return ':'.join(str(versions[name]) for name in names)
+
+
+def variant_matrix_validators(request, id):
+    versions = get_versions('variant-options', f'variants:{id}')
+    return f"variant-matrix:{id}:{versions['variant-options']}:{versions[f'variants:{id}']}", None
+
+
+def reviews_validators(request, id):
+    row = Product.objects.filter(id=id).values('rating_count', 'rating_sum').annotate(
+        reviews_updated=_latest_update(Review),
+    ).first()
+    if row is None:
+        return None
+    return f"reviews:{id}:{row['rating_count']}:{row['rating_sum']}", row['reviews_updated']
@@ -0,0 +1,61 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from stories.caching import bump_versions
+
+ENDPOINTS = {
+    'products': '/api/v1/products/',
+    'products (sparse)': '/api/v1/products/?fields=id,title,price,category',
+    'variants': '/api/v1/variants/',
+    'categories': '/api/v1/categories/',
+    'brands': '/api/v1/brands/',
+    'reviews': '/api/v1/reviews/',
+}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Measure queries per request and latency percentiles of the read API, with a cold and a warm response cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, action='append', dest='page_sizes', help="Page size to measure (repeatable); 20 and 100 by default.")
+        parser.add_argument('--requests', type=int, default=50, help="Requests per endpoint, page size and cache state.")
+        parser.add_argument('--host', default='localhost', help="Host header of the requests; must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be at least 1.')
+        client = Client(HTTP_HOST=options['host'])
+        self.stdout.write(f"{'endpoint':<20}{'size':>6}{'cache':>7}{'queries':>9}{'p50 ms':>9}{'p99 ms':>9}")
+        for page_size in options['page_sizes'] or [20, 100]:
+            for name, url in ENDPOINTS.items():
+                url = f"{url}{'&' if '?' in url else '?'}page_size={page_size}"
+                for state in ('cold', 'warm'):
+                    queries, timings = self.measure(client, url, options['requests'], cold=state == 'cold')
+                    self.stdout.write(
+                        f"{name:<20}{page_size:>6}{state:>7}{max(queries):>9}"
+                        f"{statistics.median(timings):>9.1f}{percentile(timings, 0.99):>9.1f}"
+                    )
+        self.stdout.write(self.style.SUCCESS("Benchmark finished."))
+
+    def measure(self, client, url, count, cold):
+        queries, timings = [], []
+        for _ in range(count):
+            if cold:
+                # Only the API responses go cold; sessions and the other fragments are left alone
+                bump_versions('api')
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = client.get(url)
+                timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f"{url} answered {response.status_code}.")
+            queries.append(len(captured))
+        return queries, timings
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from stories.recommendations import TOP_NEIGHBORS, rebuild_neighbors
+
+
+class Command(BaseCommand):
+    help = "Rebuild the co-purchase neighbors of every product from the checkout history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=TOP_NEIGHBORS, help="Neighbors kept per product.")
+        parser.add_argument('--partition-size', type=int, default=20000,
+                            help="Products whose co-occurrences are held in memory per pass over the orders.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Checkouts read per query.")
+
+    def handle(self, *args, **options):
+        if min(options['top'], options['partition_size'], options['batch_size']) < 1:
+            raise CommandError('--top, --partition-size and --batch-size must be positive.')
+        products, rows = rebuild_neighbors(options['top'], options['partition_size'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Stored {rows} neighbor(s) for {products} product(s)."))
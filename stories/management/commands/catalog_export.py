@@ -0,0 +1,28 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from stories.catalog import IMPORT_ORDER, export_records, write_csv, write_jsonl
+
+
+class Command(BaseCommand):
+    help = "Stream the catalog to a JSON lines file or to one CSV file per record type."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="A .jsonl file ('-' for stdout), or a directory with --format csv.")
+        parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+        parser.add_argument('--model', action='append', dest='models', choices=IMPORT_ORDER, help="Only export this record type (repeatable).")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+        records = export_records(options['models'], options['batch_size'])
+        if options['format'] == 'csv':
+            if options['output'] == '-':
+                raise CommandError('CSV exports are written to a directory.')
+            count = write_csv(records, options['output'])
+        elif options['output'] == '-':
+            count = write_jsonl(records, sys.stdout)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                count = write_jsonl(records, output)
+        self.stderr.write(self.style.SUCCESS(f"Exported {count} record(s)."))
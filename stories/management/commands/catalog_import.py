@@ -0,0 +1,52 @@
+import os
+from itertools import chain
+from django.core.management.base import BaseCommand, CommandError
+from stories.catalog import IMPORT_ORDER, RECORD_TYPES, CatalogError, CatalogImporter, read_records, record_type_of
+
+
+class Command(BaseCommand):
+    help = "Import catalog records from .jsonl or .csv files (or a directory of CSV files) with bulk upserts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="JSON lines files, CSV files named after their record type, or directories of them.")
+        parser.add_argument('--model', choices=sorted(RECORD_TYPES), help="Record type of CSV files not named after one.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--images-dir', default='.', help="Directory relative image paths are read from.")
+        parser.add_argument('--no-renditions', action='store_true', help="Do not pre-generate renditions of imported images.")
+
+    def files(self, paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files += [os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.csv', '.jsonl'))]
+            elif os.path.exists(path):
+                files.append(path)
+            else:
+                raise CommandError(f'{path} does not exist.')
+        # CSV files of parents go first, so their rows exist when children reference them
+        order = {name: index for index, name in enumerate(IMPORT_ORDER)}
+        try:
+            return sorted(files, key=lambda path: order[record_type_of(path)] if path.endswith('.csv') else -1)
+        except CatalogError as error:
+            raise CommandError(error)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+        files = self.files(options['paths'])
+        importer = CatalogImporter(options['batch_size'], options['images_dir'], renditions=not options['no_renditions'])
+        # Each file is only read when the previous one is done
+        records = chain.from_iterable(
+            ((f'{path}:{line}', record) for line, record in read_records(path, options['model'])) for path in files
+        )
+        result = importer.run(records)
+
+        for location, message in result['errors'][:50]:
+            self.stderr.write(f'{location}: {message}')
+        if len(result['errors']) > 50:
+            self.stderr.write(f"... and {len(result['errors']) - 50} more error(s).")
+        for name in IMPORT_ORDER:
+            if result['created'][name] or result['updated'][name]:
+                self.stdout.write(f"{name}: {result['created'][name]} created, {result['updated'][name]} updated")
+        style = self.style.WARNING if result['errors'] else self.style.SUCCESS
+        self.stdout.write(style(f"Import finished with {len(result['errors'])} error(s)."))
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from stories.models import Category, Brand, Images, Slider, Banner
+from stories.renditions import RENDITION_SIZES, RENDITION_WORKERS, pregenerate
+
+IMAGE_MODELS = (Images, Category, Brand, Slider, Banner)
+
+
+class Command(BaseCommand):
+    help = "Create the missing image renditions of every uploaded image on a pool of workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=RENDITION_WORKERS)
+        parser.add_argument('--size', action='append', dest='sizes', choices=sorted(RENDITION_SIZES),
+                            help="Only create this rendition (repeatable); all sizes by default.")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        def names():
+            for model in IMAGE_MODELS:
+                yield from model.objects.exclude(image='').exclude(image=None).values_list('image', flat=True).order_by('id').iterator()
+
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='renditions') as pool:
+            done, failed = pregenerate(names(), options['sizes'], pool=pool)
+        self.stdout.write(self.style.SUCCESS(f"Created renditions for {done} image(s), {failed} could not be read."))
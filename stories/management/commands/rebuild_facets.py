@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from stories.facets import compute_facets
+from stories.models import Product, ProductFacet, FacetCount
+
+
+class Command(BaseCommand):
+    help = "Recompute every product facet row and the precomputed facet counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            ProductFacet.objects.all().delete()
+            FacetCount.objects.all().delete()
+
+            product_ids = Product.objects.order_by('id').values_list('id', flat=True)
+            batch = []
+            for product_id in product_ids.iterator(chunk_size=batch_size):
+                batch.append(product_id)
+                if len(batch) == batch_size:
+                    self.insert_facets(batch)
+                    batch = []
+            self.insert_facets(batch)
+
+            # Counts come from one GROUP BY over the freshly written rows
+            counts = ProductFacet.objects.values('scope', 'dimension', 'value').annotate(total=Count('id')).order_by()
+            FacetCount.objects.bulk_create(
+                (FacetCount(scope=row['scope'], dimension=row['dimension'], value=row['value'], count=row['total']) for row in counts.iterator()),
+                batch_size=batch_size,
+            )
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {FacetCount.objects.count()} facet count(s)."))
+
+    def insert_facets(self, product_ids):
+        if not product_ids:
+            return
+        ProductFacet.objects.bulk_create(
+            [
+                ProductFacet(product_id=product_id, scope=scope, dimension=dimension, value=value)
+                for product_id, facets in compute_facets(product_ids).items()
+                for scope, dimension, value in facets
+            ],
+            batch_size=1000,
+        )
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum, Count
+from stories.models import Product, Review
+from stories.caching import bump_versions, forget_rating_summaries
+
+
+class Command(BaseCommand):
+    help = "Rebuild the denormalized rating aggregates of every product from its active reviews."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Only report products whose stored aggregates drifted from the live reviews.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        check_only = options['check']
+
+        # One grouped query for the live values, keyed by product id
+        live = {
+            row['product']: (row['total'], row['count'])
+            for row in Review.objects.filter(status=True, product__isnull=False).values('product').annotate(total=Sum('rate'), count=Count('id')).order_by()
+        }
+
+        drifted = []
+        products = Product.objects.only('id', 'title', 'rating_sum', 'rating_count', 'rating_average').order_by('id')
+        for product in products.iterator(chunk_size=batch_size):
+            total, count = live.get(product.id, (0, 0))
+            average = total / count if count else 0.0
+            if (product.rating_sum, product.rating_count) != (total, count) or abs(product.rating_average - average) > 1e-6:
+                if check_only:
+                    self.stdout.write(f"{product.id} {product.title}: stored {product.rating_sum}/{product.rating_count}, live {total}/{count}")
+                product.rating_sum, product.rating_count, product.rating_average = total, count, average
+                drifted.append(product)
+
+        if check_only:
+            if drifted:
+                raise CommandError(f"{len(drifted)} product(s) have drifted rating aggregates.")
+            self.stdout.write(self.style.SUCCESS("Rating aggregates are in sync."))
+            return
+
+        with transaction.atomic():
+            Product.objects.bulk_update(drifted, ['rating_sum', 'rating_count', 'rating_average'], batch_size=batch_size)
+            if drifted:
+                # Histograms were shifted alongside the drifted counters; recount them too
+                forget_rating_summaries(*(product.id for product in drifted))
+                bump_versions('api:products', *(f'reviews:{product.id}' for product in drifted))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates for {len(drifted)} product(s)."))
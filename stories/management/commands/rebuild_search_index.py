@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from stories.models import Product
+from stories.search import get_backend, index_queryset
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = index_queryset(Product.objects.all(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} product(s) with {type(get_backend()).__name__}."))
@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from stories.deals import sync_deals, next_deal_transition
+
+
+class Command(BaseCommand):
+    help = "Start and end deals at their offers_start/offers_deadline, sleeping until the next transition."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Apply the due transitions and exit (for cron).")
+        parser.add_argument('--max-sleep', type=float, default=60,
+                            help="Longest wait in seconds, so deals edited in the meantime are picked up.")
+
+    def handle(self, *args, **options):
+        if options['max_sleep'] <= 0:
+            raise CommandError('--max-sleep must be positive.')
+        while True:
+            activated, expired = sync_deals()
+            if activated or expired or options['verbosity'] > 1:
+                self.stdout.write(f"{timezone.now():%Y-%m-%d %H:%M:%S} started {len(activated)} deal(s), ended {len(expired)}.")
+            if options['once']:
+                return
+            upcoming = next_deal_transition()
+            wait = options['max_sleep'] if upcoming is None else (upcoming - timezone.now()).total_seconds()
+            time.sleep(min(max(wait, 0), options['max_sleep']))
@@ -0,0 +1,129 @@
+from django.db import models
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+# Width of one materialized path segment: zero padded ids keep siblings in id order
+PATH_STEP = 9
+
+
+def path_ids(path):
+    """Category ids along a materialized path, root first."""
+    return [int(segment) for segment in path.split('/') if segment]
+
+
+class CategoryQuerySet(models.QuerySet):
+    def descendants_of(self, category, include_self=True):
+        """The subtree below category, as one indexed prefix query on path."""
+        queryset = self.filter(path__startswith=category.path)
+        return queryset if include_self else queryset.exclude(pk=category.pk)
+
+    def ancestors_of(self, category, include_self=False):
+        """Ancestors of category ordered from the root, looked up by the ids in its path."""
+        ids = path_ids(category.path)
+        if not include_self:
+            ids = ids[:-1]
+        return self.filter(id__in=ids).order_by('path')
+
+    def tree(self):
+        """Root categories with their whole subtree attached as tree_children, from a single query."""
+        roots = []
+        nodes = {}
+        for category in self.order_by('path'):
+            category.tree_children = []
+            nodes[category.path] = category
+            parent = nodes.get(category.path[:-PATH_STEP])
+            if parent is not None:
+                parent.tree_children.append(category)
+            elif category.parent_id is None:
+                roots.append(category)
+        return roots
+
+    def rebuild_paths(self):
+        """Recompute path and depth of every category from parent_id, for writes that bypass save().
+
+        Returns the number of categories whose path changed.
+        """
+        categories = {category.id: category for category in self.model.objects.only('id', 'parent_id', 'path', 'depth')}
+        paths = {}
+
+        def path_of(category_id, seen=()):
+            if category_id not in paths:
+                parent_id = categories[category_id].parent_id
+                prefix = path_of(parent_id, seen + (category_id,)) if parent_id in categories and parent_id not in seen else ''
+                paths[category_id] = f'{prefix}{category_id:0{PATH_STEP - 1}d}/'
+            return paths[category_id]
+
+        changed = []
+        for category in categories.values():
+            path = path_of(category.id)
+            if category.path != path:
+                category.path, category.depth = path, path.count('/') - 1
+                changed.append(category)
+        self.model.objects.bulk_update(changed, ['path', 'depth'], batch_size=1000)
+        return len(changed)
+
+
+class CategoryManager(models.Manager.from_queryset(CategoryQuerySet)):
+    pass
+
+
+class VariantsQuerySet(models.QuerySet):
+    _resolve_images = False
+
+    def with_images(self):
+        """Resolve the Images row of every fetched variant with one extra query, like prefetch_related."""
+        clone = self._chain()
+        clone._resolve_images = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._resolve_images = self._resolve_images
+        return clone
+
+    def _fetch_all(self):
+        fetching = self._result_cache is None
+        super()._fetch_all()
+        if fetching and self._resolve_images and self._iterable_class is models.query.ModelIterable:
+            self.model.resolve_images(self._result_cache)
+
+
+class VariantsManager(models.Manager.from_queryset(VariantsQuerySet)):
+    pass
+
+
+class CollectionMembershipQuerySet(models.QuerySet):
+    def published(self, now=None):
+        """Memberships whose publish window contains now."""
+        now = now or timezone.now()
+        return self.filter(
+            Q(publish_start__isnull=True) | Q(publish_start__lte=now),
+            Q(publish_end__isnull=True) | Q(publish_end__gt=now),
+        )
+
+    def home_rails(self, now=None):
+        """Active home collections in position order, each with its first products as rail_products.
+
+        One query: a window function numbers the published products of every
+        collection along the (collection, position) index and keeps each
+        collection's first `limit` of them.
+        """
+        memberships = (
+            self.published(now)
+            .filter(collection__status=True, collection__show_on_home=True, product__status=True)
+            .annotate(rail_row=Window(RowNumber(), partition_by=F('collection_id'), order_by=[F('position').asc(), F('product_id').asc()]))
+            .filter(rail_row__lte=F('collection__limit'))
+            .select_related('collection', 'product__category', 'product__brand')
+            .prefetch_related('product__products_images', 'product__product_variants__color', 'product__product_variants__size')
+            .order_by('collection__position', 'collection_id', 'rail_row')
+        )
+        rails = {}
+        for membership in memberships:
+            rail = rails.setdefault(membership.collection_id, membership.collection)
+            rail.__dict__.setdefault('rail_products', []).append(membership.product)
+        return list(rails.values())
+
+
+class CollectionMembershipManager(models.Manager.from_queryset(CollectionMembershipQuerySet)):
+    pass
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('stories', 'Product')
+    Review = apps.get_model('stories', 'Review')
+    totals = Review.objects.filter(status=True, product__isnull=False).values('product').annotate(total=models.Sum('rate'), count=models.Count('id'))
+    for row in totals.order_by().iterator():
+        Product.objects.filter(id=row['product']).update(
+            rating_sum=row['total'],
+            rating_count=row['count'],
+            rating_average=row['total'] / row['count'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_average',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
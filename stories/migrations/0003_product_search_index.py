@@ -0,0 +1,54 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_fulltext_index(apps, schema_editor):
+    # The FULLTEXT index only exists on MySQL; other databases use the SearchTerm table
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE stories_productsearchdocument ADD FULLTEXT INDEX stories_psd_document_ft (document)')
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE stories_productsearchdocument DROP INDEX stories_psd_document_ft')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0002_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='stories.product')),
+                ('document', models.TextField(blank=True)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': '13. Search Documents',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=40)),
+                ('weight', models.PositiveSmallIntegerField(default=1)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='stories.product')),
+            ],
+            options={
+                'verbose_name_plural': '12. Search Terms',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchterm',
+            constraint=models.UniqueConstraint(fields=('term', 'product'), name='unique_search_term_product'),
+        ),
+        migrations.RunPython(add_fulltext_index, drop_fulltext_index),
+    ]
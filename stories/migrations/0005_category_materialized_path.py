@@ -0,0 +1,41 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:18
+
+from django.db import migrations, models
+
+
+def backfill_category_paths(apps, schema_editor):
+    Category = apps.get_model('stories', 'Category')
+    parents = dict(Category.objects.values_list('id', 'parent_id'))
+    paths = {}
+
+    def path_of(category_id, seen=()):
+        if category_id not in paths:
+            parent_id = parents.get(category_id)
+            prefix = path_of(parent_id, seen + (category_id,)) if parent_id and parent_id not in seen else ''
+            paths[category_id] = f'{prefix}{category_id:08d}/'
+        return paths[category_id]
+
+    for category_id in parents:
+        path = path_of(category_id)
+        Category.objects.filter(id=category_id).update(path=path, depth=path.count('/') - 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0004_product_facets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_category_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0005_category_materialized_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField(default=0)),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbor_of', to='stories.product')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='stories.product')),
+            ],
+            options={
+                'verbose_name_plural': '16. Product Neighbors',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productneighbor',
+            constraint=models.UniqueConstraint(fields=('product', 'rank'), name='unique_product_neighbor_rank'),
+        ),
+    ]
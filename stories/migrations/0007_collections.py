@@ -0,0 +1,114 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Former Product flag -> (slug, title, position, show_on_home) of the collection replacing it
+FLAG_COLLECTIONS = {
+    'new_collection': ('new', 'NEW COLLECTIONS', 1, True),
+    'girls_collection': ('girls', 'GIRLS COLLECTIONS', 2, True),
+    'men_collection': ('men', 'MEN COLLECTIONS', 3, True),
+    'latest_collection': ('latest', 'Latest Products', 4, True),
+    'pick_collection': ('picked-for-you', 'Picked For You', 5, True),
+    'pc_or_laps': ('pc-or-laps', 'PCs & Laptops', 6, False),
+}
+
+
+def flags_to_memberships(apps, schema_editor):
+    Product = apps.get_model('stories', 'Product')
+    Collection = apps.get_model('stories', 'Collection')
+    CollectionMembership = apps.get_model('stories', 'CollectionMembership')
+    for flag, (slug, title, rail_position, show_on_home) in FLAG_COLLECTIONS.items():
+        collection, _ = Collection.objects.get_or_create(
+            slug=slug, defaults={'title': title, 'position': rail_position, 'show_on_home': show_on_home},
+        )
+        # Positions follow the id order the rails used to be sorted by
+        product_ids = Product.objects.filter(**{flag: True}).order_by('id').values_list('id', flat=True).iterator()
+        CollectionMembership.objects.bulk_create(
+            (CollectionMembership(collection=collection, product_id=product_id, position=position) for position, product_id in enumerate(product_ids)),
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+def memberships_to_flags(apps, schema_editor):
+    Product = apps.get_model('stories', 'Product')
+    CollectionMembership = apps.get_model('stories', 'CollectionMembership')
+    for flag, (slug, *_) in FLAG_COLLECTIONS.items():
+        product_ids = CollectionMembership.objects.filter(collection__slug=slug).values('product_id')
+        Product.objects.filter(id__in=product_ids).update(**{flag: True})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0006_product_neighbors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Collection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=150, unique=True)),
+                ('slug', models.SlugField(max_length=150, unique=True)),
+                ('position', models.PositiveSmallIntegerField(default=0, help_text='Order of the rail on the home page.')),
+                ('limit', models.PositiveSmallIntegerField(default=4, help_text='Products shown in the home page rail.')),
+                ('show_on_home', models.BooleanField(default=True)),
+                ('status', models.BooleanField(default=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': '17. Collections',
+                'ordering': ['position', 'id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CollectionMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('publish_start', models.DateTimeField(blank=True, null=True)),
+                ('publish_end', models.DateTimeField(blank=True, null=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='stories.collection')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='stories.product')),
+            ],
+            options={
+                'verbose_name_plural': '18. Collection Memberships',
+                'ordering': ['collection', 'position', 'id'],
+                'indexes': [models.Index(fields=['collection', 'position', 'product'], name='collection_rail')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='collectionmembership',
+            constraint=models.UniqueConstraint(fields=('collection', 'product'), name='unique_collection_product'),
+        ),
+        migrations.RunPython(flags_to_memberships, memberships_to_flags),
+        migrations.RemoveField(
+            model_name='product',
+            name='girls_collection',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='latest_collection',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='men_collection',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='new_collection',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='pc_or_laps',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='pick_collection',
+        ),
+    ]
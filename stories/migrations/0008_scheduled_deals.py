@@ -0,0 +1,34 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:27
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def activate_running_deals(apps, schema_editor):
+    Product = apps.get_model('stories', 'Product')
+    Product.objects.filter(deals=True, is_timeline=True, status=True, offers_deadline__gt=timezone.now()).update(deal_active=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0007_collections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='deal_active',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='offers_start',
+            field=models.DateTimeField(blank=True, help_text='Optional start of the deal; it starts right away when empty.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['deal_active', 'offers_deadline'], name='product_active_deals'),
+        ),
+        migrations.RunPython(activate_running_deals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0008_scheduled_deals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'status', '-id'], name='review_product_page'),
+        ),
+    ]
@@ -1,15 +1,36 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils.html import mark_safe
 from django.utils.text import slugify
 from django.contrib.auth import get_user_model
 from django.utils import timezone
-from django.db.models import Avg
+from django.db.models import Avg, Case, When, F, Q, Value, FloatField
+from django.db.models.functions import Cast
 from decimal import Decimal
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.core.exceptions import ValidationError
+from django.db.models.functions import Concat, Substr
+from stories.managers import CategoryManager, VariantsManager, CollectionMembershipManager, PATH_STEP
+from stories.renditions import rendition_url
 
 User = get_user_model()
 
 
+def without_counters(instance, counters, update_fields):
+    """update_fields for saving instance so that its counter columns are left alone.
+
+    Counters are moved by F() UPDATEs elsewhere; a full save of an existing row
+    would write back the value loaded with the instance. Counters named in
+    update_fields are still saved.
+    """
+    if update_fields is not None or instance._state.adding:
+        return update_fields
+    deferred = instance.get_deferred_fields()
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in counters and field.attname not in deferred
+    ]
+
+
 class Category(models.Model):
     parent = models.ForeignKey('self', related_name='children', on_delete=models.CASCADE, null=True, blank=True)
     title = models.CharField(max_length=150, unique=True)
@@ -17,18 +38,59 @@ class Category(models.Model):
     description = models.CharField(max_length=150, null=True, blank=True)
     image = models.ImageField(upload_to='categories/%Y/%m/%d/', null=True, blank=True)
     status = models.BooleanField(default=True)
+    # Materialized path of zero padded ids from the root ("00000001/00000004/"), kept by save()
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
     created_date = models.DateTimeField(auto_now_add=True)
     updated_date = models.DateTimeField(auto_now=True)
 
+    objects = CategoryManager()
+
     class Meta:
         ordering = ['id']
         verbose_name_plural = '01. Categories'
 
+    def clean(self):
+        if self.pk and self.parent_id:
+            parent_path = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True).first() or ''
+            if self.parent_id == self.pk or (self.path and parent_path.startswith(self.path)):
+                raise ValidationError({'parent': 'A category cannot be moved below itself.'})
+
+    def tree_path(self, parent_path):
+        return f'{parent_path}{self.pk:0{PATH_STEP - 1}d}/'
+
+    def save(self, *args, **kwargs):
+        """Save the category and keep the materialized paths of it and its subtree in step."""
+        with transaction.atomic():
+            parent_path = ''
+            if self.parent_id:
+                parent_path = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True).first() or ''
+            if self.pk is None:
+                super().save(*args, **kwargs)
+                self.path = self.tree_path(parent_path)
+                self.depth = self.path.count('/') - 1
+                Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+                return
+
+            old = Category.objects.filter(pk=self.pk).values('path', 'depth').first()
+            new_path = self.tree_path(parent_path)
+            if old and old['path'] and new_path != old['path']:
+                if parent_path.startswith(old['path']):
+                    raise ValueError('A category cannot be moved below itself.')
+                # Re-root the whole subtree with one UPDATE before the signals of this save run
+                Category.objects.filter(path__startswith=old['path']).exclude(pk=self.pk).update(
+                    path=Concat(Value(new_path), Substr('path', len(old['path']) + 1)),
+                    depth=F('depth') + (new_path.count('/') - old['path'].count('/')),
+                )
+            self.path = new_path
+            self.depth = new_path.count('/') - 1
+            super().save(*args, **kwargs)
+
     @property
     def image_tag(self):
         try:
-            return mark_safe(f'<img src="{self.image.url}" width="50" height="50"/>')
-        except AttributeError:
+            return mark_safe(f'<img src="{rendition_url(self.image, "thumb")}" width="50" height="50"/>')
+        except (AttributeError, ValueError):
             return mark_safe('<span>No Image</span>')
 
     def __str__(self):
@@ -50,8 +112,8 @@ class Brand(models.Model):
     @property
     def image_tag(self):
         try:
-            return mark_safe(f'<img src="{self.image.url}" width="50" height="50"/>')
-        except AttributeError:
+            return mark_safe(f'<img src="{rendition_url(self.image, "thumb")}" width="50" height="50"/>')
+        except (AttributeError, ValueError):
             return mark_safe('<span>No Image</span>')
 
     def __str__(self):
@@ -65,11 +127,14 @@ class Product(models.Model):
     model = models.CharField(max_length=150, null=True, blank=True)
     available_in_stock_msg = models.CharField(max_length=150, null=True, blank=True)
     in_stock_max = models.PositiveIntegerField(default=1)
+    # Units held by carts (see cart.reservations); available = in_stock_max - reserved
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     old_price = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     discount_title = models.CharField(max_length=150, null=True, blank=True)
     discount = models.PositiveIntegerField(default=0)
     # Time of the off_time field
+    offers_start = models.DateTimeField(blank=True, null=True, help_text='Optional start of the deal; it starts right away when empty.')
     offers_deadline  = models.DateTimeField(auto_now_add=False, blank=True, null=True)  
     keyword = models.CharField(max_length=150, default='N/A')
     description = models.CharField(max_length=150, default='N/A')
@@ -77,21 +142,49 @@ class Product(models.Model):
     return_policy = models.TextField(default='N/A')
     is_timeline = models.BooleanField(default=False)
     deals = models.BooleanField(default=False)
-    new_collection = models.BooleanField(default=False)
-    latest_collection = models.BooleanField(default=False)
-    pick_collection = models.BooleanField(default=False)
-    girls_collection = models.BooleanField(default=False)
-    men_collection = models.BooleanField(default=False)
-    pc_or_laps = models.BooleanField(default=False)
+    # Whether the deal is running now; flipped on save and at offers_start/offers_deadline by the deals scheduler
+    deal_active = models.BooleanField(default=False, editable=False)
     in_stock = models.BooleanField(default=True)
     status = models.BooleanField(default=True)
+    # Denormalized rating aggregates, maintained by Review.save() / Review deletion
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_average = models.FloatField(default=0, editable=False)
     created_date = models.DateTimeField(auto_now_add=True)
     updated_date = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['id']
         verbose_name_plural = '03. Products'
-        
+        indexes = [
+            models.Index(fields=['deal_active', 'offers_deadline'], name='product_active_deals'),
+        ]
+
+    @staticmethod
+    def deal_live_q(now):
+        """Q matching the products whose deal runs at now."""
+        return Q(deals=True, is_timeline=True, status=True, offers_deadline__gt=now) & (Q(offers_start__isnull=True) | Q(offers_start__lte=now))
+
+    def is_deal_live(self, now=None):
+        now = now or timezone.now()
+        return bool(
+            self.deals and self.is_timeline and self.status
+            and self.offers_deadline and self.offers_deadline > now
+            and (self.offers_start is None or self.offers_start <= now)
+        )
+
+    # Maintained by apply_rating_delta() and cart.reservations; never written by a save() that does not name them
+    COUNTER_FIELDS = ('rating_sum', 'rating_count', 'rating_average', 'reserved')
+
+    def save(self, *args, **kwargs):
+        self.deal_active = self.is_deal_live()
+        update_fields = without_counters(self, self.COUNTER_FIELDS, kwargs.get('update_fields'))
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        if update_fields is not None and 'deal_active' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'deal_active']
+        super().save(*args, **kwargs)
+
     @property 
     def is_offers_deadline_active(self):
         return self.offers_deadline and self.offers_deadline > timezone.now()
@@ -105,13 +198,58 @@ class Product(models.Model):
     
     @property    
     def average_review(self):
-        reviews = Review.objects.filter(product=self, status=True).aggregate(average=Avg('rate'))
-        return float(reviews["average"] or 0)
+        return float(self.rating_average or 0)
     
     @property
     def count_review(self):
-        return Review.objects.filter(product=self, status=True).count()
-    
+        return self.rating_count
+
+    @classmethod
+    def apply_rating_delta(cls, product_id, sum_delta, count_delta):
+        """Shift the stored rating aggregates of one product in a single UPDATE."""
+        if not product_id or (not sum_delta and not count_delta):
+            return
+        new_sum = F('rating_sum') + sum_delta
+        new_count = F('rating_count') + count_delta
+        # rating_average is assigned first: MySQL evaluates SET clauses left to right
+        # against already-updated columns, so it must be computed from the old values.
+        cls.objects.filter(id=product_id).update(
+            rating_average=Case(
+                When(rating_count__lte=-count_delta, then=Value(0.0)),
+                default=Cast(new_sum, FloatField()) / Cast(new_count, FloatField()),
+                output_field=FloatField(),
+            ),
+            rating_sum=new_sum,
+            rating_count=new_count,
+        )
+
+    def build_variant_matrix(self):
+        """Size x color matrix of this product's variants, as plain JSON-serializable data.
+
+        Sizes and colors are keyed by id ("0" when a variant has none) and every
+        cell carries the variant id, price, stock quantity and image URL.
+        """
+        variants = Variants.objects.filter(product=self).select_related('size', 'color').with_images().order_by('size_id', 'color_id', 'id')
+        sizes, colors, matrix = {}, {}, {}
+        for variant in variants:
+            if variant.size:
+                sizes[variant.size.id] = {'id': variant.size.id, 'title': variant.size.title, 'code': variant.size.code}
+            if variant.color:
+                colors[variant.color.id] = {'id': variant.color.id, 'title': variant.color.title, 'code': variant.color.code}
+            image = variant.image_object
+            matrix.setdefault(str(variant.size_id or 0), {}).setdefault(str(variant.color_id or 0), {
+                'variant_id': variant.id,
+                'price': str(variant.price),
+                'quantity': variant.quantity,
+                'image': rendition_url(image.image, 'detail') if image and image.image else '',
+            })
+        return {
+            'product_id': self.id,
+            'sizes': list(sizes.values()),
+            'colors': list(colors.values()),
+            'matrix': matrix,
+        }
+
     def __str__(self):
         return f'{self.title} - {"Active" if self.status else "Inactive"}'
 
@@ -128,8 +266,8 @@ class Images(models.Model):
     @property
     def image_tag(self):
         try:
-            return mark_safe(f'<img src="{self.image.url}" width="50" height="50"/>')
-        except AttributeError:
+            return mark_safe(f'<img src="{rendition_url(self.image, "thumb")}" width="50" height="50"/>')
+        except (AttributeError, ValueError):
             return mark_safe('<span>No Image</span>')
 
     def __str__(self):
@@ -175,33 +313,59 @@ class Variants(models.Model):
     size = models.ForeignKey(Size, on_delete=models.SET_NULL, null=True, blank=True)
     image_id = models.PositiveIntegerField(blank=True, null=True, default=0)
     quantity = models.PositiveIntegerField(default=1)
+    # Units held by carts (see cart.reservations); available = quantity - reserved
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     created_date = models.DateTimeField(auto_now_add=True)
     updated_date = models.DateTimeField(auto_now=True)
 
+    objects = VariantsManager()
+
     class Meta:
         ordering = ['id']
         verbose_name_plural = '07. Product Variants'
 
+    # Maintained by cart.reservations; never written by a save() that does not name it
+    COUNTER_FIELDS = ('reserved',)
+
+    def save(self, *args, **kwargs):
+        update_fields = without_counters(self, self.COUNTER_FIELDS, kwargs.get('update_fields'))
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.title if self.title else f"Variant {self.id} of {self.product.title}"
 
+    @classmethod
+    def resolve_images(cls, variants):
+        """Attach the Images row referenced by each variant, loading all of them in one query."""
+        variants = list(variants)
+        images = Images.objects.in_bulk({variant.image_id for variant in variants if variant.image_id})
+        for variant in variants:
+            variant._image_cache = (variant.image_id, images.get(variant.image_id))
+        return variants
+
+    @property
+    def image_object(self):
+        """The Images row of image_id, or None; resolved in bulk by Variants.objects.with_images()."""
+        cached = getattr(self, '_image_cache', None)
+        if cached is None or cached[0] != self.image_id:
+            self.resolve_images([self])
+        return self._image_cache[1]
+
     @property
     def image(self):
-        try:
-            img = Images.objects.get(id=self.image_id)
-            return img.image.url if img.image else "No Image"
-        except Images.DoesNotExist:
-            return "No Image"
+        img = self.image_object
+        return img.image.url if img and img.image else "No Image"
     
     @property
     def image_tag(self):
         """Safely return an image tag or a placeholder if not found."""
-        try:
-            img = Images.objects.get(id=self.image_id)
-            return mark_safe(f'<img src="{img.image.url}" width="50" height="50"/>')
-        except Images.DoesNotExist:
-            return mark_safe('<span>No Image</span>')
+        img = self.image_object
+        if img and img.image:
+            return mark_safe(f'<img src="{rendition_url(img.image, "thumb")}" width="50" height="50"/>')
+        return mark_safe('<span>No Image</span>')
 
 class Slider(models.Model):
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True, related_name='top_sliders')
@@ -218,8 +382,8 @@ class Slider(models.Model):
     @property
     def image_tag(self):
         try:
-            return mark_safe(f'<img src="{self.image.url}" width="50" height="50"/>')
-        except AttributeError:
+            return mark_safe(f'<img src="{rendition_url(self.image, "thumb")}" width="50" height="50"/>')
+        except (AttributeError, ValueError):
             return mark_safe('<span>No Image</span>')
 
     def __str__(self):
@@ -242,8 +406,8 @@ class Banner(models.Model):
     @property
     def image_tag(self):
         try:
-            return mark_safe(f'<img src="{self.image.url}" width="50" height="50"/>')
-        except AttributeError:
+            return mark_safe(f'<img src="{rendition_url(self.image, "thumb")}" width="50" height="50"/>')
+        except (AttributeError, ValueError):
             return mark_safe('<span>No Image</span>')
 
     def __str__(self):
@@ -282,6 +446,182 @@ class Review(models.Model):
     class Meta:
         ordering = ['id']
         verbose_name_plural = '11. Reviews'
+        indexes = [
+            # Keyset pages of a product's active reviews, newest first
+            models.Index(fields=['product', 'status', '-id'], name='review_product_page'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._rating_snapshot = instance.rating_contribution()
+        return instance
+
+    def rating_contribution(self):
+        """(product_id, rate) this review counts towards, or None if it is not active."""
+        if not self.__dict__.get('status') or not self.__dict__.get('product_id'):
+            return None
+        return (self.product_id, self.rate)
+
+    @staticmethod
+    def move_rating(contribution, delta):
+        """Add (delta=1) or remove (delta=-1) a (product_id, rate) contribution from the product aggregates and histogram."""
+        from stories.caching import shift_rating_histogram
+        product_id, rate = contribution
+        Product.apply_rating_delta(product_id, delta * rate, delta)
+        shift_rating_histogram(product_id, rate, delta)
+
+    def save(self, *args, **kwargs):
+        """Save the review and move its rating between product aggregates in the same transaction."""
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            previous = getattr(self, '_rating_snapshot', None)
+            current = self.rating_contribution()
+            if previous != current:
+                if previous:
+                    self.move_rating(previous, -1)
+                if current:
+                    self.move_rating(current, 1)
+            self._rating_snapshot = current
 
     def __str__(self):
         return self.subject if self.subject else f"Review by {self.user.username} on {self.product.title}"
+
+class SearchTerm(models.Model):
+    """Inverted index entry: one weighted term of one product (built-in search backend)."""
+    term = models.CharField(max_length=40)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_terms')
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = '12. Search Terms'
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'product'], name='unique_search_term_product'),
+        ]
+
+    def __str__(self):
+        return f'{self.term} -> {self.product_id} ({self.weight})'
+
+class ProductSearchDocument(models.Model):
+    """Weighted search text of one product, carrying a FULLTEXT index under MySQL."""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    document = models.TextField(blank=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = '13. Search Documents'
+
+    def __str__(self):
+        return f'Search document of {self.product_id}'
+
+
+class ProductFacet(models.Model):
+    """One facet value of one product, repeated for every category scope the product is listed in.
+
+    scope is the id of the product's category or one of its ancestors, or 0 for the
+    whole catalog; rows are kept in sync by stories.facets.sync_product_facets().
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='facets')
+    scope = models.PositiveIntegerField(default=0)
+    dimension = models.CharField(max_length=20)
+    value = models.CharField(max_length=50)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = '14. Product Facets'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'scope', 'dimension', 'value'], name='unique_product_facet'),
+        ]
+        indexes = [
+            models.Index(fields=['scope', 'dimension', 'value'], name='product_facet_lookup'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id}: {self.dimension}={self.value} (scope {self.scope})'
+
+class FacetCount(models.Model):
+    """Precomputed number of active products per facet value within a category scope (0 = catalog)."""
+    scope = models.PositiveIntegerField(default=0)
+    dimension = models.CharField(max_length=20)
+    value = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = '15. Facet Counts'
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'dimension', 'value'], name='unique_facet_count'),
+        ]
+
+    def __str__(self):
+        return f'{self.dimension}={self.value}: {self.count} (scope {self.scope})'
+
+
+class ProductNeighbor(models.Model):
+    """Top-N products bought together with a product, rebuilt by the build_related_products command."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbors')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbor_of')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = '16. Product Neighbors'
+        constraints = [
+            # Also the index the product page reads its neighbors in rank order from
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_product_neighbor_rank'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} -> {self.neighbor_id} (#{self.rank}, {self.score:.3f})'
+
+
+class Collection(models.Model):
+    """A merchandised product rail, e.g. "New Collections"; rails are added without schema changes."""
+    title = models.CharField(max_length=150, unique=True)
+    slug = models.SlugField(max_length=150, unique=True)
+    position = models.PositiveSmallIntegerField(default=0, help_text='Order of the rail on the home page.')
+    limit = models.PositiveSmallIntegerField(default=4, help_text='Products shown in the home page rail.')
+    show_on_home = models.BooleanField(default=True)
+    status = models.BooleanField(default=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['position', 'id']
+        verbose_name_plural = '17. Collections'
+
+    def __str__(self):
+        return f'{self.title} - {"Active" if self.status else "Inactive"}'
+
+
+class CollectionMembership(models.Model):
+    """A product placed in a collection at a position, optionally only within a publish window."""
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='memberships')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='memberships')
+    position = models.PositiveIntegerField(default=0)
+    publish_start = models.DateTimeField(null=True, blank=True)
+    publish_end = models.DateTimeField(null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    objects = CollectionMembershipManager()
+
+    class Meta:
+        ordering = ['collection', 'position', 'id']
+        verbose_name_plural = '18. Collection Memberships'
+        constraints = [
+            models.UniqueConstraint(fields=['collection', 'product'], name='unique_collection_product'),
+        ]
+        indexes = [
+            # Rails read each collection in position order
+            models.Index(fields=['collection', 'position', 'product'], name='collection_rail'),
+        ]
+
+    def clean(self):
+        if self.publish_start and self.publish_end and self.publish_end <= self.publish_start:
+            raise ValidationError({'publish_end': 'The publish window must end after it starts.'})
+
+    def __str__(self):
+        return f'{self.product} in {self.collection.title} (#{self.position})'
@@ -0,0 +1,110 @@
+import heapq
+import math
+from collections import Counter
+from itertools import combinations
+from django.db import transaction
+from django.db.models import Count
+from checkout.models import Checkout, CheckoutItem
+from stories.caching import bump_versions
+from stories.models import Product, ProductNeighbor
+
+TOP_NEIGHBORS = 10
+
+# Baskets with more distinct products than this are wholesale orders and say
+# little about affinity, while costing a quadratic number of pairs
+MAX_BASKET_SIZE = 50
+
+EXCLUDED_STATUSES = ('Cancelled',)
+
+
+def _checkout_items():
+    return CheckoutItem.objects.exclude(product=None).exclude(checkout__status__in=EXCLUDED_STATUSES)
+
+
+def iter_baskets(batch_size=5000):
+    """Distinct product ids of every checkout, read in keyset batches of checkouts.
+
+    Each batch is one query bounded by a checkout id range, so memory stays flat
+    however many order lines there are.
+    """
+    last_id = 0
+    while True:
+        ids = list(Checkout.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        baskets = {}
+        lines = _checkout_items().filter(checkout_id__gt=last_id, checkout_id__lte=ids[-1]).values_list('checkout_id', 'product_id')
+        for checkout_id, product_id in lines.order_by():
+            baskets.setdefault(checkout_id, set()).add(product_id)
+        yield from baskets.values()
+        last_id = ids[-1]
+
+
+def purchase_counts():
+    """{product_id: number of checkouts containing it}, aggregated by the database."""
+    rows = _checkout_items().values('product_id').annotate(checkouts=Count('checkout_id', distinct=True)).order_by()
+    return {row['product_id']: row['checkouts'] for row in rows}
+
+
+def co_purchase_neighbors(product_ids, counts, top=TOP_NEIGHBORS, batch_size=5000):
+    """{product_id: [(neighbor_id, score)]} for a partition of products, best first.
+
+    Co-occurrences are accumulated only for products of the partition, so memory
+    is bounded by the partition rather than the whole catalog. Scores are the
+    cosine similarity of the two products' checkout sets.
+    """
+    product_ids = set(product_ids)
+    pairs = {}
+    for basket in iter_baskets(batch_size):
+        if len(basket) > MAX_BASKET_SIZE or not basket & product_ids:
+            continue
+        for first, second in combinations(basket, 2):
+            if first in product_ids:
+                pairs.setdefault(first, Counter())[second] += 1
+            if second in product_ids:
+                pairs.setdefault(second, Counter())[first] += 1
+
+    neighbors = {}
+    for product_id, together in pairs.items():
+        scored = ((other, count / math.sqrt(counts[product_id] * counts[other])) for other, count in together.items())
+        neighbors[product_id] = heapq.nlargest(top, scored, key=lambda item: (item[1], -item[0]))
+    return neighbors
+
+
+def rebuild_neighbors(top=TOP_NEIGHBORS, partition_size=20000, batch_size=5000):
+    """Recompute the ProductNeighbor table partition by partition; returns (products, rows) written."""
+    counts = purchase_counts()
+    all_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    products = rows = 0
+    for start in range(0, len(all_ids), partition_size):
+        partition = all_ids[start:start + partition_size]
+        purchased = [product_id for product_id in partition if product_id in counts]
+        neighbors = co_purchase_neighbors(purchased, counts, top, batch_size) if purchased else {}
+        with transaction.atomic():
+            ProductNeighbor.objects.filter(product_id__gte=partition[0], product_id__lte=partition[-1]).delete()
+            ProductNeighbor.objects.bulk_create(
+                [
+                    ProductNeighbor(product_id=product_id, neighbor_id=neighbor_id, rank=rank, score=score)
+                    for product_id, ranked in neighbors.items()
+                    for rank, (neighbor_id, score) in enumerate(ranked, start=1)
+                ],
+                batch_size=1000,
+            )
+        products += len(neighbors)
+        rows += sum(len(ranked) for ranked in neighbors.values())
+    bump_versions('related-products')
+    return products, rows
+
+
+def related_products(product, limit=4, queryset=None):
+    """Products most often bought with product, topped up with the newest of its category.
+
+    The neighbors come from one read of the (product, rank) index joined to Product;
+    the category query only runs when there are fewer than limit of them.
+    """
+    queryset = queryset if queryset is not None else Product.objects.all()
+    queryset = queryset.filter(status=True).exclude(id=product.id)
+    related = list(queryset.filter(neighbor_of__product=product).order_by('neighbor_of__rank')[:limit])
+    if len(related) < limit and product.category_id:
+        related += queryset.filter(category_id=product.category_id).exclude(id__in=[item.id for item in related]).order_by('-id')[:limit - len(related)]
+    return related
@@ -0,0 +1,133 @@
+import hashlib
+import io
+import logging
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Rendition name -> bounding box; images are fit inside it and never upscaled
+RENDITION_SIZES = getattr(settings, 'IMAGE_RENDITIONS', {
+    'thumb': (100, 100),
+    'card': (400, 400),
+    'detail': (900, 900),
+    'banner': (1600, 800),
+})
+RENDITION_QUALITY = getattr(settings, 'IMAGE_RENDITION_QUALITY', 80)
+RENDITION_WORKERS = getattr(settings, 'IMAGE_RENDITION_WORKERS', 4)
+RENDITION_DIR = 'renditions'
+
+# Source names are immutable (uploads never overwrite), so renditions are named after
+# them and this only bounds stale entries
+URL_TIMEOUT = 60 * 60 * 24 * 7
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _source_name(source):
+    """Storage name of a FieldFile or of a plain name; raises ValueError when there is no file."""
+    name = getattr(source, 'name', source)
+    if not name:
+        raise ValueError('The image has no file associated with it.')
+    return name
+
+
+def _url_key(name, size):
+    return f"rendition:{size}:{hashlib.sha1(name.encode()).hexdigest()}"
+
+
+def rendition_name(name, size):
+    """Storage name of a rendition, derived from the source name alone so it is known without reading the source."""
+    width, height = RENDITION_SIZES[size]
+    key = hashlib.sha256(f'{name}:{width}x{height}:q{RENDITION_QUALITY}'.encode()).hexdigest()
+    return f'{RENDITION_DIR}/{key[:2]}/{key[2:4]}/{key}.webp'
+
+
+def render(image, size):
+    """WebP bytes of an opened PIL image fit inside the box of the given size."""
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    image.thumbnail(RENDITION_SIZES[size], Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'WEBP', quality=RENDITION_QUALITY, method=4)
+    return output.getvalue()
+
+
+def generate_renditions(source, sizes=None):
+    """Create the missing renditions of an image and return {size: url}; {} if it cannot be read.
+
+    The source is only opened when one of the renditions does not exist yet.
+    """
+    name = _source_name(source)
+    sizes = list(sizes or RENDITION_SIZES)
+    targets = {size: rendition_name(name, size) for size in sizes}
+    try:
+        missing = [size for size, target in targets.items() if not default_storage.exists(target)]
+        if missing:
+            with default_storage.open(name, 'rb') as source_file, Image.open(source_file) as image:
+                image.load()
+                for size in missing:
+                    default_storage.save(targets[size], ContentFile(render(image, size)))
+    except (OSError, ValueError, SuspiciousFileOperation):
+        logger.warning('Could not create renditions of %s', name, exc_info=True)
+        return {}
+    urls = {size: default_storage.url(target) for size, target in targets.items()}
+    cache.set_many({_url_key(name, size): url for size, url in urls.items()}, URL_TIMEOUT)
+    return urls
+
+
+def rendition_url(source, size):
+    """URL of a rendition; until it exists, the URL of the view that creates it on first request."""
+    name = _source_name(source)
+    if size not in RENDITION_SIZES:
+        raise ValueError(f'Unknown image rendition {size!r}.')
+    return cache.get(_url_key(name, size)) or reverse('rendition', args=[size, name])
+
+
+def has_renditions(source, sizes=None):
+    keys = [_url_key(_source_name(source), size) for size in sizes or RENDITION_SIZES]
+    return len(cache.get_many(keys)) == len(keys)
+
+
+def get_worker_pool():
+    """Process-wide thread pool kept warm between batches; Pillow releases the GIL while resizing."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=RENDITION_WORKERS, thread_name_prefix='renditions')
+        return _pool
+
+
+def schedule_renditions(source):
+    """Create the renditions of a freshly uploaded image in the background."""
+    if getattr(source, 'name', source) and not has_renditions(source):
+        get_worker_pool().submit(generate_renditions, _source_name(source))
+
+
+def pregenerate(sources, sizes=None, pool=None, chunk_size=500):
+    """Create renditions for many images on the worker pool; returns (done, failed) counts.
+
+    Sources are submitted in chunks so a large iterator is never held in memory at once.
+    """
+    pool = pool or get_worker_pool()
+    done = failed = 0
+    sources = iter(sources)
+    while True:
+        chunk = list(islice(sources, chunk_size))
+        if not chunk:
+            return done, failed
+        for urls in pool.map(lambda source: generate_renditions(source, sizes), chunk):
+            if urls:
+                done += 1
+            else:
+                failed += 1
@@ -0,0 +1,145 @@
+import re
+from functools import reduce
+from operator import or_
+from django.db import connection, transaction
+from django.db.models import Q, Sum, Count, Case, When, Value, IntegerField
+from django.db.models.expressions import RawSQL
+from stories.models import SearchTerm, ProductSearchDocument
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 40
+MAX_WEIGHT = 100
+STOP_WORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it',
+    'of', 'on', 'or', 'the', 'to', 'with',
+})
+
+# How much a term found in each field counts towards a product's relevance
+PRODUCT_FIELD_WEIGHTS = (
+    ('title', 5),
+    ('keyword', 3),
+    ('model', 3),
+    ('description', 1),
+    ('addition_des', 1),
+)
+RELATED_FIELD_WEIGHTS = (
+    ('title', 2),
+    ('keyword', 2),
+)
+
+
+def tokenize(text):
+    """Lowercase word tokens of text, without stop words and single letters."""
+    return [
+        token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall((text or '').lower())
+        if token not in STOP_WORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+def product_terms(product):
+    """{term: weight} for a product, including the title/keyword of its category and brand."""
+    weights = {}
+    for field, weight in PRODUCT_FIELD_WEIGHTS:
+        for term in tokenize(getattr(product, field)):
+            weights[term] = weights.get(term, 0) + weight
+    for related in (product.category, product.brand):
+        if related:
+            for field, weight in RELATED_FIELD_WEIGHTS:
+                for term in tokenize(getattr(related, field)):
+                    weights[term] = weights.get(term, 0) + weight
+    return {term: min(weight, MAX_WEIGHT) for term, weight in weights.items()}
+
+
+def _product_lookups(filters):
+    return {f'product__{lookup}': value for lookup, value in (filters or {}).items()}
+
+
+class InvertedIndexBackend:
+    """Built-in inverted index over SearchTerm rows, used where FULLTEXT is unavailable (SQLite)."""
+
+    def index(self, products):
+        products = list(products)
+        with transaction.atomic():
+            SearchTerm.objects.filter(product__in=products).delete()
+            SearchTerm.objects.bulk_create(
+                [SearchTerm(term=term, product=product, weight=weight) for product in products for term, weight in product_terms(product).items()],
+                batch_size=1000,
+            )
+
+    def search(self, tokens, filters, limit, offset):
+        # Every query token is a prefix: an index range scan on (term, product)
+        matches = [Q(term__gte=token, term__lt=token + '\uffff') for token in tokens]
+        matched_token = Case(*[When(match, then=Value(i)) for i, match in enumerate(matches)], output_field=IntegerField())
+        rows = (
+            SearchTerm.objects.filter(reduce(or_, matches), **_product_lookups(filters))
+            .values('product_id')
+            .annotate(score=Sum('weight'), matched=Count(matched_token, distinct=True))
+            .filter(matched=len(tokens))
+            .order_by('-score', 'product_id')
+            .values_list('product_id', 'score')
+        )
+        return list(rows[offset:offset + limit])
+
+
+class MySQLFullTextBackend:
+    """MATCH ... AGAINST over ProductSearchDocument.document, which has a FULLTEXT index on MySQL.
+
+    Field weights are encoded by repeating a term in the document. Tokens shorter than
+    innodb_ft_min_token_size (3 by default) are ignored by MySQL.
+    """
+
+    def index(self, products):
+        ProductSearchDocument.objects.bulk_create(
+            [ProductSearchDocument(product=product, document=self.document(product)) for product in products],
+            update_conflicts=True,
+            update_fields=['document', 'updated_date'],
+            batch_size=1000,
+        )
+
+    def document(self, product):
+        return ' '.join(' '.join([term] * min(weight, 10)) for term, weight in product_terms(product).items())
+
+    def search(self, tokens, filters, limit, offset):
+        boolean_query = ' '.join(f'+{token}*' for token in tokens)
+        table = connection.ops.quote_name(ProductSearchDocument._meta.db_table)
+        rows = (
+            ProductSearchDocument.objects.filter(**_product_lookups(filters))
+            .annotate(score=RawSQL(f'MATCH ({table}.document) AGAINST (%s IN BOOLEAN MODE)', (boolean_query,)))
+            .filter(score__gt=0)
+            .order_by('-score', 'product_id')
+            .values_list('product_id', 'score')
+        )
+        return list(rows[offset:offset + limit])
+
+
+def get_backend():
+    return MySQLFullTextBackend() if connection.vendor == 'mysql' else InvertedIndexBackend()
+
+
+def index_products(products):
+    """(Re)index products; category and brand should be select_related to avoid per-product queries."""
+    products = [product for product in products if product.pk]
+    if products:
+        get_backend().index(products)
+
+
+def index_queryset(products, batch_size=1000):
+    """Reindex a Product queryset in batches with flat memory; returns the number indexed."""
+    total = 0
+    batch = []
+    for product in products.select_related('category', 'brand').order_by('id').iterator(chunk_size=batch_size):
+        batch.append(product)
+        if len(batch) == batch_size:
+            index_products(batch)
+            total += len(batch)
+            batch = []
+    index_products(batch)
+    return total + len(batch)
+
+
+def search_products(query, filters=None, limit=20, offset=0):
+    """Ranked [(product_id, score)] for query, restricted by Product lookups in filters."""
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return []
+    return get_backend().search(tokens, filters, limit, offset)
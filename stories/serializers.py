@@ -0,0 +1,173 @@
+from collections import namedtuple
+from django.db.models import Prefetch
+from django.urls import reverse
+from rest_framework import serializers
+from stories.models import Category, Brand, Product, Images, Variants, Review
+from stories.renditions import rendition_url
+
+# What the queryset needs for one serialized field: columns to load (for .only()),
+# relations to join and relations to prefetch.
+Plan = namedtuple('Plan', 'only select prefetch', defaults=((), (), ()))
+
+
+def image_url(image, size):
+    try:
+        return rendition_url(image, size)
+    except ValueError:
+        return None
+
+
+class SparseFieldsetSerializer(serializers.ModelSerializer):
+    """ModelSerializer limited to a requested subset of its fields.
+
+    Every field has a Plan in Meta.plans; plan_queryset() loads exactly what the
+    requested fields read, so no combination of fields can trigger per-row queries.
+    Fields without a plan read only their own column.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def field_names(cls):
+        return list(cls.Meta.fields)
+
+    @classmethod
+    def plan_queryset(cls, queryset, fields):
+        plans = getattr(cls.Meta, 'plans', {})
+        only, select, prefetch = {'id'}, set(), []
+        for name in fields:
+            plan = plans.get(name, Plan(only=(name,)))
+            only.update(plan.only)
+            select.update(plan.select)
+            prefetch.extend(plan.prefetch)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset.only(*only)
+
+
+class RelatedTitleSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    title = serializers.CharField()
+
+
+class CategorySerializer(SparseFieldsetSerializer):
+    parent = serializers.IntegerField(source='parent_id', allow_null=True)
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Category
+        fields = ['id', 'title', 'parent', 'path', 'depth', 'keyword', 'description', 'image']
+        plans = {
+            'parent': Plan(only=('parent_id',)),
+        }
+
+    def get_image(self, category):
+        return image_url(category.image, 'card') if category.image else None
+
+
+class BrandSerializer(SparseFieldsetSerializer):
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Brand
+        fields = ['id', 'title', 'keyword', 'description', 'image']
+
+    def get_image(self, brand):
+        return image_url(brand.image, 'card') if brand.image else None
+
+
+class VariantSerializer(SparseFieldsetSerializer):
+    product = serializers.IntegerField(source='product_id', allow_null=True)
+    color = serializers.SerializerMethodField()
+    size = serializers.SerializerMethodField()
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Variants
+        fields = ['id', 'product', 'title', 'color', 'size', 'price', 'quantity', 'image']
+        plans = {
+            'product': Plan(only=('product_id',)),
+            'color': Plan(only=('color__id', 'color__title', 'color__code'), select=('color',)),
+            'size': Plan(only=('size__id', 'size__title', 'size__code'), select=('size',)),
+            'image': Plan(only=('image_id',)),
+        }
+
+    @classmethod
+    def plan_queryset(cls, queryset, fields):
+        queryset = super().plan_queryset(queryset, fields)
+        # Variant images are resolved for the whole page in one query
+        return queryset.with_images() if 'image' in fields else queryset
+
+    def get_color(self, variant):
+        return {'id': variant.color.id, 'title': variant.color.title, 'code': variant.color.code} if variant.color_id else None
+
+    def get_size(self, variant):
+        return {'id': variant.size.id, 'title': variant.size.title, 'code': variant.size.code} if variant.size_id else None
+
+    def get_image(self, variant):
+        image = variant.image_object
+        return image_url(image.image, 'detail') if image and image.image else None
+
+
+class ProductSerializer(SparseFieldsetSerializer):
+    category = serializers.SerializerMethodField()
+    brand = serializers.SerializerMethodField()
+    average_review = serializers.FloatField(source='rating_average')
+    review_count = serializers.IntegerField(source='rating_count')
+    images = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = [
+            'id', 'title', 'model', 'variant', 'price', 'old_price', 'discount_title', 'discount', 'in_stock', 'in_stock_max',
+            'deal_active', 'offers_deadline', 'keyword', 'description', 'average_review', 'review_count', 'category', 'brand',
+            'images', 'variants', 'url',
+        ]
+        plans = {
+            'average_review': Plan(only=('rating_average',)),
+            'review_count': Plan(only=('rating_count',)),
+            'category': Plan(only=('category__id', 'category__title'), select=('category',)),
+            'brand': Plan(only=('brand__id', 'brand__title'), select=('brand',)),
+            'images': Plan(prefetch=(Prefetch('products_images', queryset=Images.objects.only('id', 'product_id', 'image')),)),
+            'variants': Plan(prefetch=(Prefetch(
+                'product_variants',
+                queryset=VariantSerializer.plan_queryset(Variants.objects.all(), VariantSerializer.field_names()),
+            ),)),
+            'url': Plan(),
+        }
+
+    def get_category(self, product):
+        return RelatedTitleSerializer(product.category).data if product.category_id else None
+
+    def get_brand(self, product):
+        return RelatedTitleSerializer(product.brand).data if product.brand_id else None
+
+    def get_images(self, product):
+        return [image_url(image.image, 'card') for image in product.products_images.all() if image.image]
+
+    def get_variants(self, product):
+        return VariantSerializer(product.product_variants.all(), many=True).data
+
+    def get_url(self, product):
+        return reverse('singleproductview', args=[product.id])
+
+
+class ReviewSerializer(SparseFieldsetSerializer):
+    product = serializers.IntegerField(source='product_id', allow_null=True)
+    user = serializers.CharField(source='user.username')
+
+    class Meta:
+        model = Review
+        fields = ['id', 'product', 'user', 'subject', 'comment', 'rate', 'created_date', 'updated_date']
+        plans = {
+            'product': Plan(only=('product_id',)),
+            'user': Plan(only=('user__id', 'user__username'), select=('user',)),
+        }
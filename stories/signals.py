@@ -0,0 +1,242 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from stories.caching import bump_versions
+from stories.models import Category, Brand, Product, Images, Color, Size, Variants, Slider, Banner, Review, Collection, CollectionMembership
+from stories.search import index_products, index_queryset
+from stories.facets import sync_product_facets, remove_product_facets, category_subtree_ids
+from stories.renditions import schedule_renditions
+
+
+def product_home_sections(product_id, include_banners=True):
+    """Home sections currently showing the given product."""
+    if not product_id:
+        return set()
+    sections = set()
+    if Product.objects.filter(id=product_id, deal_active=True).exists():
+        sections.add('deals')
+    if CollectionMembership.objects.filter(product_id=product_id, collection__show_on_home=True).exists():
+        sections.add('collections')
+    if include_banners:
+        if Slider.objects.filter(product_id=product_id).exists():
+            sections.add('sliders')
+        for side_deals in Banner.objects.filter(product_id=product_id).values_list('side_deals', flat=True).distinct():
+            sections.add('side_deals' if side_deals else 'banners')
+    return sections
+
+
+# Products: both the flags before and after the save decide which rails change
+@receiver(pre_save, sender=Product)
+def remember_product_sections(sender, instance, **kwargs):
+    instance._home_sections_before = product_home_sections(instance.pk, include_banners=False)
+
+
+@receiver(post_save, sender=Product)
+def invalidate_product_sections(sender, instance, **kwargs):
+    sections = getattr(instance, '_home_sections_before', set())
+    sections |= product_home_sections(instance.pk)
+    bump_versions(*sections)
+
+
+@receiver(post_delete, sender=Product)
+def invalidate_deleted_product_sections(sender, instance, **kwargs):
+    # Sliders and banners lose their product through SET_NULL, which sends no signal;
+    # rails are invalidated by the deletion of the product's collection memberships
+    bump_versions('sliders', 'banners', 'side_deals', *(['deals'] if instance.deal_active else []))
+
+
+# Images, variants and reviews render inside the cards of their product
+@receiver(pre_save, sender=Images)
+@receiver(pre_save, sender=Variants)
+@receiver(pre_save, sender=Review)
+def remember_previous_product(sender, instance, **kwargs):
+    instance._product_id_before = sender.objects.filter(pk=instance.pk).values_list('product_id', flat=True).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Images)
+@receiver(post_save, sender=Variants)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Images)
+@receiver(post_delete, sender=Variants)
+@receiver(post_delete, sender=Review)
+def invalidate_product_card(sender, instance, **kwargs):
+    # Only variants carry data (prices) shown on sliders and banners
+    include_banners = sender is Variants
+    sections = product_home_sections(instance.product_id, include_banners)
+    previous = getattr(instance, '_product_id_before', None)
+    if previous and previous != instance.product_id:
+        sections |= product_home_sections(previous, include_banners)
+    bump_versions(*sections)
+
+
+# Reviews render on their product page, which anonymous visitors get from the page cache
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_product_reviews(sender, instance, **kwargs):
+    product_ids = {instance.product_id, getattr(instance, '_product_id_before', None)} - {None}
+    bump_versions(*(f'reviews:{product_id}' for product_id in product_ids))
+
+
+# Ratings: a deleted review leaves its product's aggregates (also covers cascades and bulk deletes)
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, **kwargs):
+    previous = getattr(instance, '_rating_snapshot', instance.rating_contribution())
+    if previous:
+        Review.move_rating(previous, -1)
+
+
+# Rows nested in the responses of the read API
+API_RESOURCES = {Images: ('products', 'variants'), Variants: ('products', 'variants'), Review: ('products', 'reviews')}
+
+
+@receiver(post_save, sender=Images)
+@receiver(post_save, sender=Variants)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Images)
+@receiver(post_delete, sender=Variants)
+@receiver(post_delete, sender=Review)
+def invalidate_api_responses(sender, instance, **kwargs):
+    bump_versions(*(f'api:{resource}' for resource in API_RESOURCES[sender]))
+
+
+@receiver(post_save, sender=Slider)
+@receiver(post_delete, sender=Slider)
+def invalidate_sliders(sender, instance, **kwargs):
+    bump_versions('sliders')
+
+
+@receiver(post_save, sender=Banner)
+@receiver(post_delete, sender=Banner)
+def invalidate_banners(sender, instance, **kwargs):
+    bump_versions('banners', 'side_deals')
+
+
+@receiver(post_save, sender=Images)
+@receiver(post_save, sender=Variants)
+@receiver(post_delete, sender=Images)
+@receiver(post_delete, sender=Variants)
+def invalidate_variant_matrix(sender, instance, **kwargs):
+    product_ids = {instance.product_id, getattr(instance, '_product_id_before', None)} - {None}
+    bump_versions(*(f'variants:{product_id}' for product_id in product_ids))
+
+
+@receiver(post_save, sender=Color)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Color)
+@receiver(post_delete, sender=Size)
+def invalidate_variant_options(sender, instance, **kwargs):
+    bump_versions('variant-options')
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+@receiver(post_save, sender=CollectionMembership)
+@receiver(post_delete, sender=CollectionMembership)
+def invalidate_collections(sender, instance, **kwargs):
+    bump_versions('collections')
+
+
+# Search index: products are reindexed after commit, deletions cascade to their index rows
+@receiver(post_save, sender=Product)
+def reindex_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: index_products([instance]))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Brand)
+def reindex_related_products(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    lookup = 'category' if sender is Category else 'brand'
+    transaction.on_commit(lambda: index_queryset(Product.objects.filter(**{lookup: instance})))
+
+
+# Facets: rows and counts follow products, their variants and the category tree
+@receiver(post_save, sender=Product)
+def sync_saved_product_facets(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_product_facets([instance.pk])
+
+
+@receiver(pre_delete, sender=Product)
+def remove_deleted_product_facets(sender, instance, **kwargs):
+    remove_product_facets([instance.pk])
+
+
+@receiver(post_save, sender=Variants)
+@receiver(post_delete, sender=Variants)
+def sync_variant_product_facets(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_product_facets([instance.product_id, getattr(instance, '_product_id_before', None)])
+
+
+@receiver(pre_save, sender=CollectionMembership)
+def remember_membership_product(sender, instance, **kwargs):
+    instance._product_id_before = CollectionMembership.objects.filter(pk=instance.pk).values_list('product_id', flat=True).first() if instance.pk else None
+
+
+@receiver(post_save, sender=CollectionMembership)
+@receiver(post_delete, sender=CollectionMembership)
+def sync_membership_product_facets(sender, instance, raw=False, **kwargs):
+    # After commit: when a product is deleted its memberships go first, and it is already out of the counts
+    if not raw:
+        product_ids = [instance.product_id, getattr(instance, '_product_id_before', None)]
+        transaction.on_commit(lambda: sync_product_facets(product_ids))
+
+
+@receiver(pre_save, sender=Collection)
+def remember_collection_facet(sender, instance, **kwargs):
+    instance._facet_before = Collection.objects.filter(pk=instance.pk).values_list('slug', 'status').first() if instance.pk else None
+
+
+@receiver(post_save, sender=Collection)
+def sync_renamed_collection_facets(sender, instance, created, raw=False, **kwargs):
+    # Collection facet values are slugs of active collections
+    before = getattr(instance, '_facet_before', None)
+    if not raw and before and before != (instance.slug, instance.status):
+        product_ids = list(instance.memberships.values_list('product_id', flat=True))
+        transaction.on_commit(lambda: sync_product_facets(product_ids))
+
+
+@receiver(pre_save, sender=Category)
+def remember_category_parent(sender, instance, **kwargs):
+    instance._parent_id_before = Category.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Category)
+def sync_moved_category_facets(sender, instance, created, raw=False, **kwargs):
+    # Moving a category changes the scopes of every product below it
+    if not raw and not created and instance.parent_id != getattr(instance, '_parent_id_before', None):
+        product_ids = Product.objects.filter(category_id__in=category_subtree_ids(instance.pk)).values_list('id', flat=True)
+        sync_product_facets(list(product_ids))
+
+
+@receiver(pre_delete, sender=Category)
+def sync_orphaned_product_facets(sender, instance, **kwargs):
+    # Products lose their category through SET_NULL, which sends no signal
+    product_ids = list(Product.objects.filter(category_id__in=category_subtree_ids(instance.pk)).values_list('id', flat=True))
+    transaction.on_commit(lambda: sync_product_facets(product_ids))
+
+
+# Catalog-wide values of the global context processor
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Brand)
+def invalidate_catalog_filters(sender, instance, **kwargs):
+    bump_versions('catalog')
+
+
+# Image renditions: new uploads are resized in the background once committed
+@receiver(post_save, sender=Images)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Slider)
+@receiver(post_save, sender=Banner)
+def create_image_renditions(sender, instance, raw=False, **kwargs):
+    if not raw and instance.image:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_renditions(name))
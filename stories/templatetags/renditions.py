@@ -0,0 +1,22 @@
+from django import template
+from stories.renditions import RENDITION_SIZES, rendition_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def rendition(image, size):
+    """{% rendition product_image.image 'card' %} -> URL of the resized WebP, '' without an image."""
+    try:
+        return rendition_url(image, size)
+    except ValueError:
+        return ''
+
+
+@register.simple_tag
+def rendition_srcset(image, *sizes):
+    """{% rendition_srcset image 'card' 'detail' %} -> "url 400w, url 900w" for an <img srcset>."""
+    try:
+        return ', '.join(f'{rendition_url(image, size)} {RENDITION_SIZES[size][0]}w' for size in sizes or RENDITION_SIZES)
+    except ValueError:
+        return ''
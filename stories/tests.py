@@ -1,3 +1,211 @@
-from django.test import TestCase
+import io
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from stories.models import (
+    Category, Brand, Product, Images, Color, Size, Variants, Slider, Banner, ProductFuture, Review,
+)
+from stories.caching import get_rating_summary
+from stories.http import product_validators
+from stories.catalog import CatalogImporter
+from cart.models import Cart, CartItem
+from cart.reservations import get_availability
+from PIL import Image
 
 # Create your tests here.
+# Session, user, count and results, plus a few filter or lookup-table queries;
+# anything per row would blow past this with ROWS rows on the page
+MAX_CHANGELIST_QUERIES = 10
+ROWS = 30
+
+
+class AdminChangelistQueriesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        parent = Category.objects.create(title='Computers')
+        colors = [Color.objects.create(title=f'Color {i}', code=f'#00000{i}') for i in range(3)]
+        sizes = [Size.objects.create(title=f'Size {i}', code=f's{i}') for i in range(3)]
+        for i in range(ROWS):
+            category = Category.objects.create(title=f'Category {i}', parent=parent)
+            brand = Brand.objects.create(title=f'Brand {i}')
+            product = Product.objects.create(title=f'Product {i}', category=category, brand=brand, price=10 + i)
+            image = Images.objects.create(product=product, image=f'product_images/product-{i}.png')
+            Variants.objects.create(product=product, title=f'Variant {i}', color=colors[i % 3], size=sizes[i % 3], image_id=image.id)
+            Slider.objects.create(product=product, title=f'Slider {i}')
+            Banner.objects.create(product=product, title=f'Banner {i}')
+            ProductFuture.objects.create(product=product, title=f'Feature {i}')
+            Review.objects.create(product=product, user=cls.admin, subject=f'Review {i}', rate=1 + i % 5)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertChangelistQueries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), MAX_CHANGELIST_QUERIES, f'{url} ran {len(queries)} queries')
+
+    def test_changelists(self):
+        for model in ('category', 'brand', 'product', 'images', 'variants', 'color', 'size', 'slider', 'banner', 'productfuture', 'review'):
+            with self.subTest(model=model):
+                self.assertChangelistQueries(f'/admin/stories/{model}/')
+
+    def test_filtered_changelists(self):
+        product = Product.objects.get(title='Product 1')
+        self.assertChangelistQueries(f'/admin/stories/product/?category__id__exact={product.category_id}')
+        self.assertChangelistQueries(f'/admin/stories/variants/?product__id__exact={product.id}')
+        self.assertChangelistQueries(f'/admin/stories/images/?product__id__exact={product.id}')
+
+
+class RatingAggregatesTest(TestCase):
+
+    def test_product_save_keeps_aggregates_moved_by_reviews(self):
+        user = get_user_model().objects.create_user('reviewer', 'reviewer@example.com', 'password')
+        product = Product.objects.create(title='Rated product', price=10)
+        # The admin or the deals scheduler still holds the row as it was before the review
+        stale = Product.objects.get(id=product.id)
+        Review.objects.create(product=product, user=user, subject='Good', rate=4)
+        stale.title = 'Renamed product'
+        stale.save()
+        product.refresh_from_db()
+        self.assertEqual(product.title, 'Renamed product')
+        self.assertEqual((product.rating_sum, product.rating_count, product.rating_average), (4, 1, 4.0))
+
+    def test_counters_named_in_update_fields_are_saved(self):
+        product = Product.objects.create(title='Counted product', price=10)
+        product.rating_sum, product.rating_count, product.rating_average = 9, 2, 4.5
+        product.save(update_fields=['rating_sum', 'rating_count', 'rating_average'])
+        product.refresh_from_db()
+        self.assertEqual((product.rating_sum, product.rating_count), (9, 2))
+
+    def test_rebuild_ratings_recounts_cached_histogram(self):
+        cache.clear()
+        user = get_user_model().objects.create_user('rebuilder', 'rebuilder@example.com', 'password')
+        product = Product.objects.create(title='Drifted product', price=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            review = Review.objects.create(product=product, user=user, subject='Good', rate=4)
+        self.assertEqual(get_rating_summary(product.id)['histogram']['4'], 1)
+        # A queryset update moves neither the aggregates nor the cached histogram
+        Review.objects.filter(id=review.id).update(rate=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_ratings', stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.rating_sum, 2)
+        summary = get_rating_summary(product.id)
+        self.assertEqual((summary['histogram']['4'], summary['histogram']['2'], summary['average']), (0, 1, 2))
+
+
+class RenditionViewTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name, ALLOWED_HOSTS=['testserver'])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        source = io.BytesIO()
+        Image.new('RGB', (1200, 800), 'red').save(source, 'PNG')
+        self.name = default_storage.save('images/source.png', ContentFile(source.getvalue()))
+
+    def test_existing_rendition_is_served_without_reading_the_source(self):
+        url = reverse('rendition', args=['card', self.name])
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 302)
+        cache.clear()
+        with mock.patch.object(default_storage, 'open', side_effect=AssertionError('source was read')):
+            second = self.client.get(url)
+        self.assertEqual(second['Location'], first['Location'])
+
+    def test_missing_source_is_not_found(self):
+        with self.assertLogs('stories.renditions', 'WARNING'):
+            response = self.client.get(reverse('rendition', args=['card', 'images/missing.png']))
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductValidatorsTest(TestCase):
+
+    def test_image_change_moves_etag_and_last_modified(self):
+        product = Product.objects.create(title='Pictured product', price=10)
+        Product.objects.filter(id=product.id).update(updated_date=timezone.now() - timedelta(days=1))
+        etag, last_modified = product_validators(None, product.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Images.objects.create(product=product)
+        new_etag, new_last_modified = product_validators(None, product.id)
+        self.assertNotEqual(new_etag, etag)
+        self.assertGreater(new_last_modified, last_modified)
+
+
+class CatalogImportTest(TestCase):
+
+    def test_import_reprices_open_carts_and_refreshes_availability(self):
+        cache.clear()
+        user = get_user_model().objects.create_user('importer', 'importer@example.com', 'password')
+        product = Product.objects.create(title='Imported product', price=30, in_stock_max=5)
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=product, quantity=2)
+        self.assertEqual(get_availability([(product.id, None)]), {(product.id, None): 5})
+        importer = CatalogImporter(renditions=False)
+        importer.add(1, {'model': 'product', 'title': 'Imported product', 'price': '50', 'in_stock_max': '8'})
+        with self.captureOnCommitCallbacks(execute=True):
+            importer.flush()
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(Cart.objects.values_list('subtotal', flat=True).get(id=cart.id), 100)
+        self.assertEqual(get_availability([(product.id, None)]), {(product.id, None): 8})
+
+    def test_variant_refers_to_an_image_of_the_same_batch_by_its_source(self):
+        media, files = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.addCleanup(files.cleanup)
+        with open(f'{files.name}/front.png', 'wb') as source:
+            Image.new('RGB', (40, 40), 'blue').save(source, 'PNG')
+        product = Product.objects.create(title='Pictured product', price=30)
+        importer = CatalogImporter(images_dir=files.name, renditions=False)
+        importer.add(1, {'model': 'image', 'product': 'Pictured product', 'image': 'front.png'})
+        importer.add(2, {'model': 'variant', 'product': 'Pictured product', 'title': 'Blue', 'image': 'front.png', 'price': '30'})
+        with override_settings(MEDIA_ROOT=media.name), self.captureOnCommitCallbacks(execute=True):
+            importer.flush()
+        self.assertEqual(importer.errors, [])
+        image = Images.objects.get(product=product)
+        self.assertEqual(Variants.objects.values_list('image_id', flat=True).get(product=product), image.id)
+
+
+@override_settings(ALLOWED_HOSTS=['shop.example.com', 'api.example.com'])
+class ApiResponseCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_pages_link_to_the_host_they_are_served_from(self):
+        Brand.objects.create(title='First brand')
+        Brand.objects.create(title='Second brand')
+        for host in ('shop.example.com', 'api.example.com'):
+            data = self.client.get('/api/v1/brands/?page_size=1', HTTP_HOST=host).json()
+            self.assertTrue(data['next'].startswith(f'http://{host}/'))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class SearchViewTest(TestCase):
+
+    def test_hits_gone_since_the_index_was_read_are_left_out(self):
+        listed = Product.objects.create(title='Listed lamp', price=30)
+        hidden = Product.objects.create(title='Hidden lamp', price=30, status=False)
+        hits = [(listed.id, 2.0), (hidden.id, 1.5), (listed.id + hidden.id, 1.0)]
+        with mock.patch('stories.views.search_products', return_value=hits):
+            data = self.client.get(reverse('search'), {'q': 'lamp'}).json()
+        self.assertEqual(data['status'], 200)
+        self.assertEqual([result['id'] for result in data['results']], [listed.id])
@@ -1,11 +1,16 @@
 from django.urls import path
 from stories.views import(
-    HomeView, SingleProductView,ReviewsView, GetColorsBySize, 
+    HomeView, SingleProductView,ReviewsView, ReviewListView, GetColorsBySize, VariantMatrixView, SearchView, ProductListView, RenditionView,
 )
 
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
     path('singleproductview/<int:id>/', SingleProductView.as_view(), name='singleproductview'),
     path('getcolorsbysize/', GetColorsBySize.as_view(), name='getcolorsbysize'),
+    path('variantmatrix/<int:id>/', VariantMatrixView.as_view(), name='variantmatrix'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('products/', ProductListView.as_view(), name='products'),
+    path('rendition/<str:size>/<path:name>', RenditionView.as_view(), name='rendition'),
     path('reviewsview/', ReviewsView.as_view(), name='reviewsview'),
+    path('reviews/<int:id>/', ReviewListView.as_view(), name='reviews'),
 ]
@@ -1,75 +1,144 @@
 from django.shortcuts import render,redirect, get_object_or_404
 from django.template.loader import render_to_string
+from django.templatetags.static import static
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.views import generic
 from django.utils import timezone
-from django.http import HttpResponseRedirect, JsonResponse, HttpResponse, HttpResponseBadRequest
-from django.db.models import Min, Max
+from django.http import HttpResponseRedirect, JsonResponse, HttpResponse, HttpResponseBadRequest, Http404
+from django.db.models import Min, Max, Exists, OuterRef
+from decimal import Decimal, InvalidOperation
 import json
 from stories.models import (
-    Category,Brand,Product, Images,Color,Size,Variants,Slider,Banner,ProductFuture,Review
+    Category,Brand,Product, Images,Color,Size,Variants,Slider,Banner,ProductFuture,Review,
+    Collection, CollectionMembership,
 )
+from stories.search import search_products
+from stories.caching import FRAGMENT_TIMEOUT, HOME_SECTIONS, get_versions, collections_cache_timeout, get_variant_matrix, get_rating_summary
+from stories.facets import CATALOG_SCOPE, DEALS_COLLECTION, facet_counts
+from stories.recommendations import related_products as related_products_for
+from stories.http import (
+    anonymous_page_cache, cache_policy, home_page_key, home_validators, product_page_key, product_validators,
+    variant_matrix_validators, reviews_validators,
+)
+from stories.renditions import RENDITION_DIR, RENDITION_SIZES, generate_renditions, rendition_url
 # from cart.forms import CartForm
 
+
+def product_card(product):
+    """JSON summary of a product for listing endpoints; expects products_images to be prefetched."""
+    image = next(iter(product.products_images.all()), None)
+    return {
+        'id': product.id,
+        'title': product.title,
+        'price': str(product.price),
+        'old_price': str(product.old_price),
+        'category': product.category.title if product.category else '',
+        'brand': product.brand.title if product.brand else '',
+        'average_review': product.average_review,
+        'image': rendition_url(image.image, 'card') if image and image.image else '',
+        'url': reverse('singleproductview', args=[product.id]),
+    }
+
+REVIEWS_PAGE_SIZE = 10
+MAX_REVIEWS_PAGE_SIZE = 50
+
+
+def review_card(review):
+    """JSON representation of a review; expects user to be selected."""
+    return {
+        'id': review.id,
+        'user': review.user.username,
+        'user_id': review.user_id,
+        'subject': review.subject,
+        'comment': review.comment,
+        'rate': review.rate,
+        'updated_date': review.updated_date.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def reviews_page(product_id, before=None, limit=REVIEWS_PAGE_SIZE):
+    """Newest active reviews of a product with ids below before, plus the cursor of the next page.
+
+    Keyset pagination on the (product, status, -id) index: every page is one bounded
+    range read however deep it is, where an OFFSET would scan all the skipped rows.
+    """
+    reviews = Review.objects.filter(product_id=product_id, status=True).select_related('user').order_by('-id')
+    if before:
+        reviews = reviews.filter(id__lt=before)
+    reviews = list(reviews[:limit + 1])
+    return {
+        'reviews': [review_card(review) for review in reviews[:limit]],
+        'next': reviews[limit - 1].id if len(reviews) > limit else None,
+    }
+
 # Create your views here.
-@method_decorator(never_cache, name='dispatch')
+@method_decorator(anonymous_page_cache(home_page_key), name='dispatch')
+@method_decorator(cache_policy(home_validators), name='dispatch')
 class HomeView(generic.View):
     def get(self, request):
+        # Querysets stay lazy: each section is rendered from a fragment cached under its
+        # version, so they only hit the database when that version was bumped.
+        home_versions = get_versions(*HOME_SECTIONS)
         context = {
+            'home_versions': home_versions,
+            'fragment_timeout': FRAGMENT_TIMEOUT,
+            'collections_timeout': collections_cache_timeout(home_versions['collections']),
             'sliders': Slider.objects.filter(status=True).select_related('product').prefetch_related('product__product_variants').order_by('id'),
             'banners': Banner.objects.filter(status=True).select_related('product').prefetch_related('product__product_variants').order_by('id')[:3],
             'side_deals_banners': Banner.objects.filter(status=True, side_deals=True, side_deals_is_active=True).select_related('product').prefetch_related('product__product_variants').order_by('id')[:1],
-            'deals_products': Product.objects.filter(offers_deadline__isnull=False,  is_timeline=True, deals=True, status=True).select_related('category', 'brand').prefetch_related('product_variants').order_by("id")[:6],
+            'deals_products': Product.objects.filter(deal_active=True).select_related('category', 'brand').prefetch_related('products_images', 'product_variants').order_by("id")[:6],
             'current_time': timezone.now(),
-            'new_collections': Product.objects.filter(status=True, new_collection=True).select_related('category', 'brand').prefetch_related('product_variants__color', 'product_variants__size').order_by('id')[:4],
-            'girls_collections': Product.objects.filter(status=True, girls_collection=True).select_related('category', 'brand').prefetch_related('product_variants__color', 'product_variants__size').order_by('id')[:4],
-            'men_collections': Product.objects.filter(status=True, men_collection=True).select_related('category', 'brand').prefetch_related('product_variants__color', 'product_variants__size').order_by('id')[:4],
-            'latest_collections': Product.objects.filter(status=True, latest_collection=True).select_related('category', 'brand').prefetch_related('product_variants__color', 'product_variants__size').order_by('id')[:4],
-            'pick_collections': Product.objects.filter(status=True, pick_collection=True).select_related('category', 'brand').prefetch_related('product_variants__color', 'product_variants__size').order_by('id')[:4],   
+            # Called by the template only when the rails fragment is not cached
+            'home_rails': CollectionMembership.objects.home_rails,
         }
         return render(request, 'stories/home.html', context)
 
-@method_decorator(never_cache, name='dispatch')
+@method_decorator(anonymous_page_cache(product_page_key), name='dispatch')
+@method_decorator(cache_policy(product_validators), name='dispatch')
 class SingleProductView(generic.View):
     def get(self, request, id):
         product = get_object_or_404(Product.objects.prefetch_related('product_variants'), id=id)
 
-        related_products = Product.objects.filter(category=product.category).exclude(id=product.id).select_related('category').prefetch_related('product_variants__color', 'product_variants__size').order_by('-id')[:4]
+        related_products = related_products_for(product, 4, Product.objects.select_related('category').prefetch_related('products_images', 'product_variants__color', 'product_variants__size'))
 
-        reviews = Review.objects.filter(product=product, status=True).select_related('user').prefetch_related('product')
-        reviews_total = reviews.count()
+        # Only the first page is embedded; the rest is fetched from ReviewListView
+        reviews = reviews_page(product.id)
+        rating_summary = get_rating_summary(product.id)
 
-        variants = Variants.objects.filter(product=product).select_related('size', 'color')
-
-        size_variants = variants.filter(size__isnull=False).order_by('size')
-        color_variants = variants.filter(color__isnull=False).order_by('color')
+        # Every size/color combination is resolved client side from this matrix
+        variant_matrix = get_variant_matrix(product)
+        no_image = static('img/no-image.jpg')
 
         # Creating unique size and color dictionaries
-        unique_sizes = {variant.size.id: {'size': variant.size, 'image': variant.image or 'No Image Available', 'price': variant.price} for variant in size_variants}
-        unique_colors = {variant.color.id: {'color': variant.color, 'image': variant.image or 'No Image Available', 'price': variant.price} for variant in color_variants}
-
-        # Selecting the size_variants[0] size and color variant for default selection
-        if size_variants.exists():
-            selected_size_variant = size_variants[0]
-            selected_size_id = selected_size_variant.size_id
-            selected_size_title = selected_size_variant.size.title
-            selected_size_image = selected_size_variant.image or 'No Image Available'
-            selected_price = selected_size_variant.price
+        unique_sizes = {}
+        for size in variant_matrix['sizes']:
+            cell = next(iter(variant_matrix['matrix'][str(size['id'])].values()))
+            unique_sizes[size['id']] = {'size': size, 'image': cell['image'] or no_image, 'price': cell['price']}
+        unique_colors = {}
+        for color in variant_matrix['colors']:
+            cell = next(row[str(color['id'])] for row in variant_matrix['matrix'].values() if str(color['id']) in row)
+            unique_colors[color['id']] = {'color': color, 'image': cell['image'] or no_image, 'price': cell['price']}
+
+        # Selecting the first size and color variant for default selection
+        if unique_sizes:
+            selected_size_id, selected_size = next(iter(unique_sizes.items()))
+            selected_size_title = selected_size['size']['title']
+            selected_size_image = selected_size['image']
+            selected_price = selected_size['price']
         else:
             selected_size_id = None
             selected_size_title = "No Size Selected"
             selected_size_image = 'No Image Available'
             selected_price = None
 
-        if color_variants.exists():
-            selected_color_variant = color_variants[0]
-            selected_color_id = selected_color_variant.color_id
-            selected_color_title = selected_color_variant.color.title
-            selected_color_image = selected_color_variant.image or 'No Image Available'
+        if unique_colors:
+            selected_color_id, selected_color = next(iter(unique_colors.items()))
+            selected_color_title = selected_color['color']['title']
+            selected_color_image = selected_color['image']
         else:
             selected_color_id = None
             selected_color_title = "No Color Selected"
@@ -78,10 +147,11 @@ class SingleProductView(generic.View):
         context = {
             'product': product,
             'related_products': related_products,
-            'reviews': reviews,
-            'reviews_total': reviews_total,
+            'reviews_page': dict(reviews, summary=rating_summary),
+            'rating_summary': rating_summary,
             'average_review': product.average_review,
             'count_review': product.count_review,
+            'variant_matrix': variant_matrix,
             'unique_sizes': unique_sizes,
             'unique_colors': unique_colors,
             'selected_size_title': selected_size_title,
@@ -94,7 +164,24 @@ class SingleProductView(generic.View):
         }
         return render(request, 'stories/single.html', context)
 
-@method_decorator(never_cache, name='dispatch')
+@method_decorator(cache_policy(variant_matrix_validators, per_user=False), name='dispatch')
+class VariantMatrixView(generic.View):
+    def get(self, request, id):
+        product = get_object_or_404(Product.objects.only('id'), id=id)
+        return JsonResponse({'status': 200, 'variant_matrix': get_variant_matrix(product)})
+
+class RenditionView(generic.View):
+    """Creates a rendition on its first request and redirects to the stored file."""
+
+    def get(self, request, size, name):
+        if size not in RENDITION_SIZES or name.startswith(f'{RENDITION_DIR}/'):
+            raise Http404
+        url = generate_renditions(name, [size]).get(size)
+        if not url:
+            raise Http404
+        return HttpResponseRedirect(url)
+
+@method_decorator(cache_policy(per_user=False), name='dispatch')
 class GetColorsBySize(generic.View):
     def get(self, request):
         size_id = request.GET.get('size_id')
@@ -111,32 +198,34 @@ class GetColorsBySize(generic.View):
         except (ValueError, TypeError):
             return JsonResponse({'status': 400, 'messages': 'Invalid size ID, color ID or product ID'})
 
-        # Filter conditions based on product_id and optionally size_id  
-        filter_conditions = {'product_id': product_id}
+        # Served from the cached variant matrix instead of querying Variants
+        variant_matrix = get_variant_matrix(Product(id=product_id))
+        sizes = {size['id']: size for size in variant_matrix['sizes']}
+        colors_by_id = {color['id']: color for color in variant_matrix['colors']}
         if size_id:
-            filter_conditions['size_id'] = size_id
-
-        variants = list(Variants.objects.filter(**filter_conditions).select_related('size', 'color'))
+            rows = [variant_matrix['matrix'][str(size_id)]] if str(size_id) in variant_matrix['matrix'] else []
+        else:
+            rows = list(variant_matrix['matrix'].values())
 
-        if not variants:
+        if not rows:
             return JsonResponse({'status': 404, 'messages': 'No variants available'})
 
         # Extract available colors
         colors = [
             {
-                'id': variant.color.id,
-                'title': variant.color.title,
-                'code': variant.color.code,
-                'image': variant.image if variant.image else '',
-                'price': str(variant.price)
+                'id': int(key),
+                'title': colors_by_id[int(key)]['title'],
+                'code': colors_by_id[int(key)]['code'],
+                'image': cell['image'],
+                'price': cell['price']
             }
-            for variant in variants if variant.color
+            for row in rows for key, cell in row.items() if key != '0'
         ]
 
         # **Size Available but No Color**
         if size_id and not colors:
-            selected_size_title = variants[0].size.title if variants and variants[0].size else None
-            selected_price = str(variants[0].price) if variants else "0.00"
+            selected_size_title = sizes[size_id]['title'] if size_id in sizes else None
+            selected_price = next(iter(rows[0].values()))['price']
 
             return JsonResponse({
                 'status': 200,
@@ -164,7 +253,7 @@ class GetColorsBySize(generic.View):
 
         # **Both Size and Color Available**
         if colors:
-            selected_size_title = variants[0].size.title if size_id and variants else ""
+            selected_size_title = sizes[size_id]['title'] if size_id in sizes else ""
             selected_color = next((color for color in colors if color['id'] == color_id), None) if color_id else (colors[0] if colors else None)
             selected_color_title = selected_color['title'] if selected_color else ""
             selected_price = selected_color['price'] if selected_color else "0.00"
@@ -180,6 +269,136 @@ class GetColorsBySize(generic.View):
 
         return JsonResponse({'status': 404, 'messages': 'No variants available'})
 
+@method_decorator(cache_policy(per_user=False), name='dispatch')
+class SearchView(generic.View):
+    per_page = 20
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'status': 400, 'messages': 'Search query is required'})
+
+        try:
+            page = max(int(request.GET.get('page') or 1), 1)
+            category_id = int(request.GET['category']) if request.GET.get('category') else None
+            brand_id = int(request.GET['brand']) if request.GET.get('brand') else None
+            min_price = Decimal(request.GET['min_price']) if request.GET.get('min_price') else None
+            max_price = Decimal(request.GET['max_price']) if request.GET.get('max_price') else None
+        except (ValueError, TypeError, InvalidOperation):
+            return JsonResponse({'status': 400, 'messages': 'Invalid page, category, brand or price'})
+
+        filters = {'status': True}
+        if category_id:
+            category = Category.objects.filter(pk=category_id).only('path').first()
+            if category is None:
+                return JsonResponse({'status': 404, 'messages': 'Category not found'})
+            filters['category__path__startswith'] = category.path
+        if brand_id:
+            filters['brand_id'] = brand_id
+        if min_price is not None:
+            filters['price__gte'] = min_price
+        if max_price is not None:
+            filters['price__lte'] = max_price
+
+        # One extra hit tells whether there is a next page without counting every match
+        hits = search_products(query, filters, limit=self.per_page + 1, offset=(page - 1) * self.per_page)
+        has_next = len(hits) > self.per_page
+        hits = hits[:self.per_page]
+        products = Product.objects.filter(status=True).select_related('category', 'brand').prefetch_related('products_images').in_bulk([product_id for product_id, _ in hits])
+
+        # Products deleted or deactivated since the index was read are left out
+        results = [dict(product_card(products[product_id]), score=score) for product_id, score in hits if product_id in products]
+
+        return JsonResponse({
+            'status': 200,
+            'query': query,
+            'page': page,
+            'has_next': has_next,
+            'results': results,
+        })
+
+@method_decorator(cache_policy(per_user=False), name='dispatch')
+class ProductListView(generic.View):
+    per_page = 20
+    sort_fields = {'id': 'id', 'newest': '-id', 'price': 'price', '-price': '-price'}
+
+    def get(self, request):
+        try:
+            page = max(int(request.GET.get('page') or 1), 1)
+            category_id = int(request.GET['category']) if request.GET.get('category') else None
+            brand_ids = [int(value) for value in request.GET.getlist('brand') if value]
+            color_ids = [int(value) for value in request.GET.getlist('color') if value]
+            size_ids = [int(value) for value in request.GET.getlist('size') if value]
+            min_price = Decimal(request.GET['min_price']) if request.GET.get('min_price') else None
+            max_price = Decimal(request.GET['max_price']) if request.GET.get('max_price') else None
+        except (ValueError, TypeError, InvalidOperation):
+            return JsonResponse({'status': 400, 'messages': 'Invalid page, category, brand, color, size or price'})
+
+        collections = set(request.GET.getlist('collection'))
+        slugs = collections - {DEALS_COLLECTION}
+        if len(slugs) != Collection.objects.filter(slug__in=slugs, status=True).count():
+            return JsonResponse({'status': 400, 'messages': 'Invalid collection'})
+        sort = self.sort_fields.get(request.GET.get('sort'), 'id')
+
+        products = Product.objects.filter(status=True)
+        if category_id:
+            category = Category.objects.filter(pk=category_id).only('path').first()
+            if category is None:
+                return JsonResponse({'status': 404, 'messages': 'Category not found'})
+            products = products.filter(category__path__startswith=category.path)
+        if brand_ids:
+            products = products.filter(brand_id__in=brand_ids)
+        if min_price is not None:
+            products = products.filter(price__gte=min_price)
+        if max_price is not None:
+            products = products.filter(price__lte=max_price)
+        if color_ids:
+            products = products.filter(Exists(Variants.objects.filter(product=OuterRef('pk'), color_id__in=color_ids)))
+        if size_ids:
+            products = products.filter(Exists(Variants.objects.filter(product=OuterRef('pk'), size_id__in=size_ids)))
+        if DEALS_COLLECTION in collections:
+            products = products.filter(deal_active=True)
+        for slug in slugs:
+            products = products.filter(Exists(CollectionMembership.objects.filter(product=OuterRef('pk'), collection__slug=slug)))
+
+        offset = (page - 1) * self.per_page
+        products = list(products.select_related('category', 'brand').prefetch_related('products_images').order_by(sort, 'id')[offset:offset + self.per_page + 1])
+
+        return JsonResponse({
+            'status': 200,
+            'page': page,
+            'has_next': len(products) > self.per_page,
+            'results': [product_card(product) for product in products[:self.per_page]],
+            'facets': self.facets(category_id or CATALOG_SCOPE),
+        })
+
+    def facets(self, scope):
+        """Precomputed facet counts of the category scope, labelled with one query per dimension."""
+        counts = facet_counts(scope)
+        labels = {
+            'category': {str(c.id): {'title': c.title} for c in Category.objects.filter(id__in=counts.get('category', {}))},
+            'brand': {str(b.id): {'title': b.title} for b in Brand.objects.filter(id__in=counts.get('brand', {}))},
+            'color': {str(c.id): {'title': c.title, 'code': c.code} for c in Color.objects.filter(id__in=counts.get('color', {}))},
+            'size': {str(s.id): {'title': s.title, 'code': s.code} for s in Size.objects.filter(id__in=counts.get('size', {}))},
+        }
+        return {
+            dimension: [
+                dict(labels.get(dimension, {}).get(value, {'title': value}), value=value, count=count)
+                for value, count in values.items()
+            ]
+            for dimension, values in counts.items()
+        }
+
+@method_decorator(cache_policy(reviews_validators, per_user=False), name='dispatch')
+class ReviewListView(generic.View):
+    def get(self, request, id):
+        try:
+            before = int(request.GET['before']) if request.GET.get('before') else None
+            limit = min(max(int(request.GET.get('limit', REVIEWS_PAGE_SIZE)), 1), MAX_REVIEWS_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'status': 400, 'messages': 'Invalid cursor or limit'})
+        return JsonResponse({'status': 200, **reviews_page(id, before, limit), 'summary': get_rating_summary(id)})
+
 @method_decorator(never_cache, name='dispatch')
 class ReviewsView(LoginRequiredMixin, generic.View):
     login_url = reverse_lazy('sign')
@@ -231,6 +450,7 @@ class ReviewsView(LoginRequiredMixin, generic.View):
                     "comment": review.comment,
                     "rate": review.rate,  
                     "updated_date": review.updated_date.strftime('%Y-%m-%d %H:%M:%S'),
+                    "summary": get_rating_summary(review.product_id),
                     "messages": "Review added successfully"
                 })
             except Review.DoesNotExist: